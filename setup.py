@@ -32,6 +32,10 @@ setup(
     author_email='pere@hungry.com',
     url='https://gitlab.com/petterreinholdtsen/valutakrambod',
     install_requires=REQUIREMENTS,
+    extras_require={
+        'ladder': ['numpy'],
+        'export': ['numpy'],
+    },
     tests_require=[
     ],
     packages=find_packages(),
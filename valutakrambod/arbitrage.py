@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Detect arbitrage opportunities between and within services, net of
+the estimated trading fees.
+
+"""
+
+import time
+import unittest
+
+from decimal import Decimal
+
+from valutakrambod.bestprice import BestPrices
+from valutakrambod.services import Orderbook
+from valutakrambod.services import Trading
+
+class ArbitrageDetector(object):
+    """Look for arbitrage opportunities every time a rate change, and call
+the subscribers with a dict describing each profitable opportunity.
+
+Cross service opportunities, buying a pair on one service and selling
+it on another, are found by checking the changed rate against the
+best opposite prices from a BestPrices index, instead of comparing all
+pairs of services.  Triangular opportunities within one service, like
+EUR to BTC to USD and back to EUR, are checked for the triangles added
+using addtriangle() which include the changed pair.
+
+The volume is limited to the crossing part of the order books, and
+opportunities below the minimum_order() limits or not profitable after
+the fees from estimatefee() are skipped.  The fees and limits are
+taken from service.trading(), or from the base Trading class for
+services without trading access, unless a Trading object is given in
+traders for the service name.
+
+Cross service opportunities are passed on as
+
+  {
+    'kind': 'cross',
+    'pair': ('BTC', 'EUR'),
+    'buy': 'Kraken',
+    'sell': 'Bitstamp',
+    'volume': Decimal('0.5'),
+    'buyprice': Decimal('5001'),     # average price
+    'sellprice': Decimal('5020'),    # average price
+    'fee': Decimal('5.1'),
+    'profit': Decimal('4.4'),        # in the quote currency
+    'when': 1546030831.3,
+  }
+
+while triangular opportunities have kind 'triangle', the service name
+in 'service', the list of (pair, side) legs traded in 'legs', the
+start currency in 'currency', the start amount in 'volume' and the
+profit in the start currency.
+
+    """
+    def __init__(self, services = (), traders = None, minprofit = Decimal(0),
+                 candidates = 3):
+        self.prices = BestPrices()
+        self.services = {}
+        self.traders = traders or {}
+        self.minprofit = minprofit
+        self.candidates = candidates
+        # Map (servicename, pair) to the triangles including it
+        self.triangles = {}
+        self.subscribers = []
+        for service in services:
+            self.add(service)
+    def add(self, service):
+        """Look for opportunities using the given service."""
+        servicename = service.servicename()
+        self.services[servicename] = service
+        if servicename not in self.traders:
+            trader = service.trading()
+            if trader is None:
+                trader = Trading(service)
+            self.traders[servicename] = trader
+        # The index is subscribed first, to be up to date when
+        # _rateupdated() is called.
+        self.prices.add(service)
+        service.subscribe(self._rateupdated)
+    def addtriangle(self, servicename, currency, pairs):
+        """Check the triangle starting and ending in currency, trading the
+three given pairs on one service in the given order.
+
+        """
+        legs = []
+        cur = currency
+        for pair in pairs:
+            if pair[1] == cur:
+                legs.append((pair, Orderbook.SIDE_BID))
+                cur = pair[0]
+            elif pair[0] == cur:
+                legs.append((pair, Orderbook.SIDE_ASK))
+                cur = pair[1]
+            else:
+                raise ValueError('pair %s/%s do not trade %s' %
+                                 (pair[0], pair[1], cur))
+        if cur != currency:
+            raise ValueError('triangle end in %s, not %s' % (cur, currency))
+        triangle = (servicename, currency, tuple(legs))
+        for pair in pairs:
+            key = (servicename, pair)
+            if key not in self.triangles:
+                self.triangles[key] = []
+            self.triangles[key].append(triangle)
+    def subscribe(self, callback):
+        """Call callback(detector, opportunity) for every opportunity
+found.
+
+        """
+        self.subscribers.append(callback)
+    def _emit(self, opportunity):
+        for s in self.subscribers:
+            s(self, opportunity)
+    def _rateupdated(self, service, pair, changed):
+        if not changed:
+            return
+        servicename = service.servicename()
+        self.checkcross(servicename, pair)
+        for triangle in self.triangles.get((servicename, pair), ()):
+            opportunity = self.checktriangle(*triangle)
+            if opportunity is not None:
+                self._emit(opportunity)
+    def checkcross(self, servicename, pair):
+        """Check buying on the given service and selling on the services
+with the best bids, and the other way around.  Return the list of
+opportunities found, which are also passed on to the subscribers.
+
+        """
+        found = []
+        for price, other in self.prices.top(pair, 'bid', self.candidates):
+            if other != servicename:
+                opportunity = self.evaluate(pair, servicename, other)
+                if opportunity is not None:
+                    found.append(opportunity)
+        for price, other in self.prices.top(pair, 'ask', self.candidates):
+            if other != servicename:
+                opportunity = self.evaluate(pair, other, servicename)
+                if opportunity is not None:
+                    found.append(opportunity)
+        for opportunity in found:
+            self._emit(opportunity)
+        return found
+    def _book(self, servicename, pair):
+        service = self.services.get(servicename)
+        if service is None or pair in service.stale:
+            # Restored books are not live, and can not be traded on
+            return None
+        return service.orderbooks.get(pair)
+    def evaluate(self, pair, buyservice, sellservice):
+        """Return the opportunity of buying pair on buyservice and selling
+on sellservice, or None if it is not profitable.
+
+        """
+        buybook = self._book(buyservice, pair)
+        sellbook = self._book(sellservice, pair)
+        if buybook is None or sellbook is None:
+            return None
+        askprice, askvolume, bidprice, bidvolume = buybook.top()
+        if askprice is None:
+            return None
+        bidprice = sellbook.top()[2]
+        if bidprice is None or bidprice <= askprice:
+            return None
+        volume = self._crossvolume(buybook, sellbook)
+        if not volume:
+            return None
+        buytrader = self.traders[buyservice]
+        selltrader = self.traders[sellservice]
+        for trader in (buytrader, selltrader):
+            minvolume, minvalue = trader.minimum_order(pair)
+            if volume < minvolume or volume * askprice < minvalue:
+                return None
+        cost = buybook.cost_to_fill(Orderbook.SIDE_ASK, volume)
+        proceeds = sellbook.cost_to_fill(Orderbook.SIDE_BID, volume)
+        if cost is None or proceeds is None:
+            return None
+        buyprice = cost / volume
+        sellprice = proceeds / volume
+        # We place a bid to buy and an ask to sell
+        fee = buytrader.estimatefee(Orderbook.SIDE_BID, buyprice, volume) \
+            + selltrader.estimatefee(Orderbook.SIDE_ASK, sellprice, volume)
+        profit = proceeds - cost - fee
+        if profit <= self.minprofit:
+            return None
+        return {
+            'kind': 'cross',
+            'pair': pair,
+            'buy': buyservice,
+            'sell': sellservice,
+            'volume': volume,
+            'buyprice': buyprice,
+            'sellprice': sellprice,
+            'fee': fee,
+            'profit': profit,
+            'when': time.time(),
+        }
+    def _crossvolume(self, buybook, sellbook):
+        """Return the volume where the asks of buybook are below the bids
+of sellbook, walking the crossing price levels of both books.
+
+        """
+        volume = Decimal(0)
+        asks = iter(buybook.ask.items())
+        bids = iter(sellbook.bid.items())
+        askprice, askvolume = next(asks, (None, None))
+        bidprice, bidvolume = next(bids, (None, None))
+        while askprice is not None and bidprice is not None \
+              and askprice < bidprice:
+            step = min(askvolume, bidvolume)
+            volume += step
+            askvolume -= step
+            bidvolume -= step
+            if not askvolume:
+                askprice, askvolume = next(asks, (None, None))
+            if not bidvolume:
+                bidprice, bidvolume = next(bids, (None, None))
+        return volume
+    def checktriangle(self, servicename, currency, legs):
+        """Return the opportunity of trading the given legs on the given
+service, starting and ending with currency, or None if it is not
+profitable.
+
+        """
+        trader = self.traders[servicename]
+        # First pass find the volume traded in each leg per unit of the
+        # start currency, to limit the start amount to the volume at
+        # the best price of each leg.
+        tops = []
+        units = Decimal(1)
+        start = None
+        for pair, side in legs:
+            book = self._book(servicename, pair)
+            if book is None:
+                return None
+            askprice, askvolume, bidprice, bidvolume = book.top()
+            if Orderbook.SIDE_BID == side:
+                # Hold the quote currency, buy the base currency
+                if not askprice:
+                    return None
+                price, volume = askprice, askvolume
+                units = units / price
+                limit = volume / units
+            else:
+                # Hold the base currency, sell it
+                if not bidprice:
+                    return None
+                price, volume = bidprice, bidvolume
+                limit = volume / units
+                units = units * price
+            tops.append(price)
+            if start is None or limit < start:
+                start = limit
+        if not start:
+            return None
+        amount = start
+        for (pair, side), price in zip(legs, tops):
+            if Orderbook.SIDE_BID == side:
+                volume = amount / price
+                value = amount
+            else:
+                volume = amount
+                value = amount * price
+            minvolume, minvalue = trader.minimum_order(pair)
+            if volume < minvolume or value < minvalue:
+                return None
+            fee = trader.estimatefee(side, price, volume)
+            # The fee is in the quote currency
+            if Orderbook.SIDE_BID == side:
+                amount = (value - fee) / price
+            else:
+                amount = value - fee
+        profit = amount - start
+        if profit <= self.minprofit:
+            return None
+        return {
+            'kind': 'triangle',
+            'service': servicename,
+            'currency': currency,
+            'legs': list(legs),
+            'volume': start,
+            'profit': profit,
+            'when': time.time(),
+        }
+
+class TestArbitrageDetector(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def setUp(self):
+        from valutakrambod.service.dummyservice import DummyService
+        self.s1 = DummyService()
+        self.s2 = DummyService()
+        self.found = []
+        self.d = ArbitrageDetector([self.s1, self.s2])
+        self.d.subscribe(lambda detector, o: self.found.append(o))
+    def testCross(self):
+        pair = ('BTC', 'EUR')
+        self.s1.updateOrderbook(pair, self.s1.newOrderbook(
+            pair,
+            [(Decimal('100'), Decimal('1')), (Decimal('101'), Decimal('1'))],
+            [(Decimal('99'), Decimal('1'))]))
+        self.assertEqual([], self.found)
+        self.s2.updateOrderbook(pair, self.s2.newOrderbook(
+            pair,
+            [(Decimal('110'), Decimal('1'))],
+            [(Decimal('105'), Decimal('0.5')), (Decimal('100.5'), Decimal('2'))]))
+        self.assertEqual(1, len(self.found))
+        o = self.found[0]
+        self.assertEqual(self.s1.servicename(), o['buy'])
+        self.assertEqual(self.s2.servicename(), o['sell'])
+        # Only the 1 BTC at 100 is below the bids of s2
+        self.assertEqual(Decimal('1'), o['volume'])
+        self.assertEqual(Decimal('100'), o['buyprice'])
+        self.assertEqual(Decimal('102.75'), o['sellprice'])
+        fee = Decimal('100') * Decimal('0.0026') + Decimal('0.01') \
+            + Decimal('102.75') * Decimal('0.0026') + Decimal('0.01')
+        self.assertEqual(Decimal('2.75') - fee, o['profit'])
+        # Stale books, like restored ones, are not traded on
+        buy, sell = self.s1.servicename(), self.s2.servicename()
+        self.s2.stale.add(pair)
+        self.assertIsNone(self.d.evaluate(pair, buy, sell))
+        self.s2.stale.discard(pair)
+        self.assertIsNotNone(self.d.evaluate(pair, buy, sell))
+        # Fees eat a one cent difference
+        self.found.clear()
+        self.s2.updateOrderbook(pair, self.s2.newOrderbook(
+            pair,
+            [(Decimal('110'), Decimal('1'))],
+            [(Decimal('100.01'), Decimal('1'))]))
+        self.assertEqual([], self.found)
+    def testTriangle(self):
+        name = self.s1.servicename()
+        self.d.addtriangle(name, 'EUR', [('BTC', 'EUR'), ('BTC', 'USD'), ('EUR', 'USD')])
+        self.s1.updateOrderbook(('BTC', 'USD'), self.s1.newOrderbook(
+            ('BTC', 'USD'), [(Decimal('125'), Decimal('1'))],
+            [(Decimal('124'), Decimal('1'))]))
+        self.s1.updateOrderbook(('EUR', 'USD'), self.s1.newOrderbook(
+            ('EUR', 'USD'), [(Decimal('1.1'), Decimal('1000'))],
+            [(Decimal('1.09'), Decimal('1000'))]))
+        self.assertEqual([], self.found)
+        # Buy BTC for 100 EUR, sell for 124 USD, buy 112.7 EUR
+        self.s1.updateOrderbook(('BTC', 'EUR'), self.s1.newOrderbook(
+            ('BTC', 'EUR'), [(Decimal('100'), Decimal('0.5'))],
+            [(Decimal('99'), Decimal('1'))]))
+        self.assertEqual(1, len(self.found))
+        o = self.found[0]
+        self.assertEqual('triangle', o['kind'])
+        self.assertEqual(Decimal('50'), o['volume'])
+        self.assertTrue(Decimal('5') < o['profit'] < Decimal('6.4'))
+
+if __name__ == '__main__':
+    t = TestArbitrageDetector()
+    unittest.main()
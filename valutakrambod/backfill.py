@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Fetch historical rates from the services, cache them on disk and
+look up the rate at any given time.
+
+"""
+
+import array
+import bisect
+import os
+import simplejson
+import tempfile
+import time
+import unittest
+
+import tornado.gen
+import tornado.ioloop
+import tornado.locks
+
+from decimal import Decimal
+
+class RateSeries(object):
+    """Sorted times and mid prices of a service and pair, kept as arrays
+of doubles, which is also the format of the cache file.
+
+    """
+    __slots__ = ('times', 'prices')
+    def __init__(self):
+        self.times = array.array('d')
+        self.prices = array.array('d')
+    def __len__(self):
+        return len(self.times)
+    def merge(self, points):
+        """Add the given (when, price) points, replacing existing prices at
+the same time.
+
+        """
+        merged = dict(zip(self.times, self.prices))
+        merged.update((float(when), float(price)) for when, price in points)
+        when = sorted(merged)
+        self.times = array.array('d', when)
+        self.prices = array.array('d', (merged[t] for t in when))
+    def lookup(self, when, interpolate = True):
+        """Return the price at the given time, interpolated between the
+surrounding points, or the latest price at or before the time if
+interpolate is false.  Return None outside the known range.
+
+        """
+        times = self.times
+        i = bisect.bisect_right(times, when)
+        if 0 == i:
+            return None
+        if times[i - 1] == when or not interpolate:
+            return self.prices[i - 1]
+        if i == len(times):
+            return None
+        t0 = times[i - 1]
+        p0 = self.prices[i - 1]
+        return p0 + (self.prices[i] - p0) * (when - t0) / (times[i] - t0)
+    def save(self, path):
+        with open(path + '.tmp', 'wb') as f:
+            array.array('Q', [len(self.times)]).tofile(f)
+            self.times.tofile(f)
+            self.prices.tofile(f)
+        os.replace(path + '.tmp', path)
+    def load(self, path):
+        with open(path, 'rb') as f:
+            count = array.array('Q')
+            count.fromfile(f, 1)
+            self.times = array.array('d')
+            self.times.fromfile(f, count[0])
+            self.prices = array.array('d')
+            self.prices.fromfile(f, count[0])
+
+class Backfill(object):
+    """Fetch the historical rates of services using fetchHistory(), with
+at most concurrency requests running at once, and cache the mid prices
+in the given directory.  The requested range is split into chunks of
+service.historychunk seconds, aligned to whole chunks, and the chunks
+completed are recorded as checkpoints, so an interrupted backfill is
+resumed where it stopped and ranges already fetched are not fetched
+again.  Chunks reaching into the future, chunks without any rates and
+chunks starting before service.historyoldest() are not complete, and
+are fetched again next time.  The start is moved forward to
+historyoldest(), as older rates are not available.
+
+Use lookup() to find the rate at a given time, for example the EUR/NOK
+rate from Norgesbank to value a trade.  The cache files use the host
+byte order.
+
+    """
+    def __init__(self, directory, concurrency = 4):
+        self.directory = directory
+        self.semaphore = tornado.locks.Semaphore(concurrency)
+        # Map (servicename, pair) to RateSeries and set of completed
+        # chunk starts
+        self.series = {}
+        self.checkpoints = {}
+    def _path(self, servicename, pair, suffix):
+        return os.path.join(self.directory, '%s-%s%s%s' % (
+            servicename, pair[0], pair[1], suffix))
+    def _load(self, servicename, pair):
+        key = (servicename, pair)
+        if key not in self.series:
+            series = RateSeries()
+            path = self._path(servicename, pair, '.rates')
+            if os.path.exists(path):
+                series.load(path)
+            self.series[key] = series
+            path = self._path(servicename, pair, '.json')
+            checkpoints = set()
+            if os.path.exists(path):
+                with open(path) as f:
+                    checkpoints = set(simplejson.load(f))
+            self.checkpoints[key] = checkpoints
+        return self.series[key], self.checkpoints[key]
+    def _save(self, servicename, pair):
+        key = (servicename, pair)
+        self.series[key].save(self._path(servicename, pair, '.rates'))
+        path = self._path(servicename, pair, '.json')
+        with open(path + '.tmp', 'w') as f:
+            simplejson.dump(sorted(self.checkpoints[key]), f)
+        os.replace(path + '.tmp', path)
+    async def backfill(self, service, pair, start, end = None):
+        """Fetch and cache the rates of the pair on the given service from
+start up to end, by default now.  Return the number of chunks fetched.
+
+        """
+        if end is None:
+            end = time.time()
+        oldest = service.historyoldest(pair)
+        if oldest is not None and start < oldest:
+            start = oldest
+        servicename = service.servicename()
+        series, checkpoints = self._load(servicename, pair)
+        chunk = service.historychunk
+        first = int(start // chunk) * chunk
+        chunks = [c for c in range(first, int(end), chunk)
+                  if c not in checkpoints]
+        await tornado.gen.multi([self._fetchchunk(service, pair, c, c + chunk,
+                                                  oldest)
+                                 for c in chunks])
+        return len(chunks)
+    async def _fetchchunk(self, service, pair, start, end, oldest):
+        async with self.semaphore:
+            # Fetch before asking for the time, to not mark a chunk
+            # ending while waiting as completed.
+            rates = await service.fetchHistory(pair, start, end)
+        now = time.time()
+        servicename = service.servicename()
+        series, checkpoints = self._load(servicename, pair)
+        series.merge((when, (ask + bid) / 2) for when, ask, bid in rates)
+        if end <= now and 0 < len(rates) and (oldest is None or oldest <= start):
+            checkpoints.add(start)
+        self._save(servicename, pair)
+    def lookup(self, servicename, pair, when, interpolate = True):
+        """Return the cached mid price of the pair on the given service at
+the given time as a float, interpolated between the known rates, or
+the last known rate before the time if interpolate is false.  If only
+the inverse pair is cached, the inverse rate is used.  Return None if
+the time is outside the cached range.
+
+        """
+        series, checkpoints = self._load(servicename, pair)
+        if 0 < len(series):
+            return series.lookup(when, interpolate)
+        series, checkpoints = self._load(servicename, (pair[1], pair[0]))
+        price = series.lookup(when, interpolate)
+        if not price:
+            return None
+        return 1 / price
+
+class TestBackfill(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def testBackfill(self):
+        from valutakrambod.service.dummyservice import DummyService
+        day = 24 * 60 * 60
+        s = DummyService()
+        s.historychunk = 10 * day
+        calls = []
+        running = [0, 0]
+        async def fetchHistory(pair, start, end):
+            calls.append(start)
+            running[0] += 1
+            running[1] = max(running)
+            await tornado.gen.sleep(0.01)
+            running[0] -= 1
+            # One rate per day, rising by one each day
+            return [(t, Decimal(t // day) + 1, Decimal(t // day) - 1)
+                    for t in range(start, end, day)]
+        s.fetchHistory = fetchHistory
+        pair = ('EUR', 'NOK')
+        ioloop = tornado.ioloop.IOLoop.current()
+        with tempfile.TemporaryDirectory() as d:
+            b = Backfill(d, concurrency = 2)
+            self.assertEqual(5, ioloop.run_sync(
+                lambda: b.backfill(s, pair, 3 * day, 45 * day)))
+            self.assertEqual([0, 10 * day, 20 * day, 30 * day, 40 * day],
+                             sorted(calls))
+            # No more than two requests at once
+            self.assertEqual(2, running[1])
+            name = s.servicename()
+            self.assertEqual(12.0, b.lookup(name, pair, 12 * day))
+            self.assertEqual(12.25, b.lookup(name, pair, 12.25 * day))
+            self.assertEqual(12.0, b.lookup(name, pair, 12.25 * day,
+                                            interpolate = False))
+            self.assertEqual(1 / 12.5, b.lookup(name, ('NOK', 'EUR'), 12.5 * day))
+            self.assertEqual(None, b.lookup(name, pair, -1))
+
+            # Resume from the checkpoints and the cache on disk
+            b = Backfill(d)
+            self.assertEqual(1, ioloop.run_sync(
+                lambda: b.backfill(s, pair, 0, 55 * day)))
+            self.assertEqual(50 * day, calls[-1])
+            self.assertEqual(59.0, b.lookup(name, pair, 59 * day))
+    def testIncomplete(self):
+        from valutakrambod.service.dummyservice import DummyService
+        day = 24 * 60 * 60
+        s = DummyService()
+        s.historychunk = 10 * day
+        calls = []
+        oldest = [None]
+        async def fetchHistory(pair, start, end):
+            calls.append(start)
+            # Like Kraken, nothing is returned for old chunks
+            start = max(start, 20 * day)
+            return [(t, Decimal(1), Decimal(1))
+                    for t in range(start, end, day)]
+        s.fetchHistory = fetchHistory
+        s.historyoldest = lambda pair: oldest[0]
+        pair = ('BTC', 'EUR')
+        ioloop = tornado.ioloop.IOLoop.current()
+        with tempfile.TemporaryDirectory() as d:
+            b = Backfill(d)
+            self.assertEqual(3, ioloop.run_sync(
+                lambda: b.backfill(s, pair, 0, 30 * day)))
+            # The empty chunks are fetched again
+            self.assertEqual(2, ioloop.run_sync(
+                lambda: b.backfill(s, pair, 0, 30 * day)))
+            self.assertEqual([0, 10 * day], sorted(calls[3:]))
+            # Nothing before the oldest time is fetched, and the chunk
+            # with the oldest time is not complete
+            oldest[0] = 25 * day
+            del calls[:]
+            self.assertEqual(1, ioloop.run_sync(
+                lambda: b.backfill(s, pair, 0, 40 * day)))
+            self.assertEqual([30 * day], calls)
+            oldest[0] = 15 * day
+            self.assertEqual(1, ioloop.run_sync(
+                lambda: b.backfill(s, pair, 0, 40 * day)))
+            self.assertEqual(10 * day, calls[-1])
+
+if __name__ == '__main__':
+    t = TestBackfill()
+    unittest.main()
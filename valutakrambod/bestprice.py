@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Index of the best ask and bid prices across services.
+
+"""
+
+import time
+import unittest
+
+from decimal import Decimal
+from sortedcontainers import SortedList
+
+class BestPrices(object):
+    """Keep the ask and bid prices of every service sorted per pair, to
+find the best prices, the best services and the consolidated spread
+in O(log n) time.  The index is updated from the rate updates of the
+services given to add().
+
+If maxage is given, rates not confirmed by the service during the last
+maxage seconds are dropped from the index, based on the stored time of
+the rate.  Rates with a missing or NaN price are left out, and so are
+rates flagged as stale by the service, like rates restored from a
+snapshot, until the service update them.
+
+    """
+    def __init__(self, services = (), maxage = None):
+        self.maxage = maxage
+        # Per pair, asks as (price, servicename) and bids as (-price,
+        # servicename), best first.
+        self.asks = {}
+        self.bids = {}
+        # Map (servicename, pair) to the indexed (ask, bid, stored)
+        self.entries = {}
+        self.bystored = SortedList()
+        for service in services:
+            self.add(service)
+    def add(self, service):
+        """Index the rates of the given service."""
+        service.subscribe(self._rateupdated)
+        for pair in list(service.rates.keys()):
+            self._rateupdated(service, pair, True)
+    def _rateupdated(self, service, pair, changed):
+        if pair in service.stale:
+            self.remove(service.servicename(), pair)
+            return
+        rate = service.rates[pair]
+        self.update(service.servicename(), pair, rate.ask, rate.bid, rate.stored)
+    def update(self, servicename, pair, ask, bid, stored = None):
+        """Index the given rate of a service.  Called automatically for the
+services given to add().
+
+        """
+        if stored is None:
+            stored = time.time()
+        key = (servicename, pair)
+        old = self.entries.get(key)
+        if old is not None:
+            self.bystored.remove((old[2], servicename, pair))
+            if old[0] == ask and old[1] == bid:
+                self.entries[key] = (ask, bid, stored)
+                self.bystored.add((stored, servicename, pair))
+                return
+            self._unindex(key, old)
+        if pair not in self.asks:
+            self.asks[pair] = SortedList()
+            self.bids[pair] = SortedList()
+        # NaN is not equal to itself
+        if ask is not None and ask == ask:
+            self.asks[pair].add((ask, servicename))
+        else:
+            ask = None
+        if bid is not None and bid == bid:
+            self.bids[pair].add((-bid, servicename))
+        else:
+            bid = None
+        self.entries[key] = (ask, bid, stored)
+        self.bystored.add((stored, servicename, pair))
+    def remove(self, servicename, pair):
+        """Remove the rate of a service from the index."""
+        key = (servicename, pair)
+        old = self.entries.get(key)
+        if old is None:
+            return
+        self.bystored.remove((old[2], servicename, pair))
+        self._unindex(key, old)
+    def _unindex(self, key, entry):
+        servicename, pair = key
+        ask, bid, stored = entry
+        if ask is not None:
+            self.asks[pair].remove((ask, servicename))
+        if bid is not None:
+            self.bids[pair].remove((-bid, servicename))
+        del self.entries[key]
+    def expire(self, now = None):
+        """Drop rates older than maxage seconds."""
+        if self.maxage is None:
+            return
+        if now is None:
+            now = time.time()
+        limit = now - self.maxage
+        while 0 < len(self.bystored) and self.bystored[0][0] < limit:
+            stored, servicename, pair = self.bystored[0]
+            self.remove(servicename, pair)
+    def best(self, pair, side, now = None):
+        """Return the best price on the given side ('ask' or 'bid') for the
+pair as (price, servicename), or None if no service has a price.
+
+        """
+        top = self.top(pair, side, 1, now)
+        if 0 == len(top):
+            return None
+        return top[0]
+    def top(self, pair, side, count, now = None):
+        """Return a list of up to count (price, servicename) tuples with the
+best prices on the given side ('ask' or 'bid') for the pair, best
+first.
+
+        """
+        self.expire(now)
+        if 'ask' == side:
+            return list(self.asks.get(pair, [])[:count])
+        return [(-price, servicename)
+                for price, servicename in self.bids.get(pair, [])[:count]]
+    def spread(self, pair, now = None):
+        """Return the consolidated spread for the pair as (ask, askservice,
+bid, bidservice, spread), where the spread is the lowest ask minus the
+highest bid across all services, or None if the ask or the bid is
+missing.
+
+        """
+        ask = self.best(pair, 'ask', now)
+        bid = self.best(pair, 'bid', now)
+        if ask is None or bid is None:
+            return None
+        return (ask[0], ask[1], bid[0], bid[1], ask[0] - bid[0])
+
+class TestBestPrices(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def testIndex(self):
+        from valutakrambod.service.dummyservice import DummyService
+        pair = ('BTC', 'EUR')
+        s1 = DummyService()
+        s2 = DummyService()
+        s3 = DummyService()
+        n1, n2, n3 = [s.servicename() for s in (s1, s2, s3)]
+        s1.updateRates(pair, Decimal('101'), Decimal('99'), 10)
+        b = BestPrices([s1, s2, s3], maxage=60)
+        s2.updateRates(pair, Decimal('100.5'), Decimal('98'), 10)
+        s3.updateRates(pair, Decimal('nan'), Decimal('99.5'), 10)
+        now = time.time()
+        self.assertEqual((Decimal('100.5'), n2), b.best(pair, 'ask', now))
+        self.assertEqual([(Decimal('99.5'), n3), (Decimal('99'), n1)],
+                         b.top(pair, 'bid', 2, now))
+        self.assertEqual((Decimal('100.5'), n2, Decimal('99.5'), n3,
+                          Decimal('1.0')), b.spread(pair, now))
+        s2.updateRates(pair, Decimal('102'), Decimal('98'), 11)
+        self.assertEqual((Decimal('101'), n1), b.best(pair, 'ask', now))
+        self.assertEqual(None, b.best(('BTC', 'USD'), 'ask', now))
+
+        # s1 confirm its rate, the others go stale
+        b.update(n1, pair, Decimal('101'), Decimal('99'), now + 50)
+        self.assertEqual([(Decimal('99'), n1)], b.top(pair, 'bid', 5, now + 100))
+        self.assertEqual(1, len(b.entries))
+    def testStale(self):
+        from valutakrambod.service.dummyservice import DummyService
+        pair = ('BTC', 'EUR')
+        s1 = DummyService()
+        s2 = DummyService()
+        s1.updateRates(pair, Decimal('101'), Decimal('99'), 10)
+        s2.restore(s1.snapshot())
+        b = BestPrices([s2])
+        self.assertEqual(None, b.best(pair, 'ask'))
+        s2.updateRates(pair, Decimal('102'), Decimal('99'), 11)
+        self.assertEqual((Decimal('102'), s2.servicename()), b.best(pair, 'ask'))
+
+if __name__ == '__main__':
+    t = TestBestPrices()
+    unittest.main()
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Aggregate rate updates into OHLC candles at several resolutions.
+
+"""
+
+import time
+import unittest
+
+from decimal import Decimal
+
+class Candle(object):
+    """Open, high, low and close mid price for the period starting at
+start, with the spread at the close and the number of updates seen.
+
+    """
+    __slots__ = ('start', 'open', 'high', 'low', 'close', 'spread', 'count')
+    def __init__(self, start, open, high, low, close, spread, count):
+        self.start = start
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.spread = spread
+        self.count = count
+    def __repr__(self):
+        return 'Candle(%s, %s, %s, %s, %s, %s, %s)' % (
+            self.start, self.open, self.high, self.low, self.close,
+            self.spread, self.count)
+    def copy(self, start = None):
+        if start is None:
+            start = self.start
+        return Candle(start, self.open, self.high, self.low, self.close,
+                      self.spread, self.count)
+    def merge(self, later):
+        """Include the later candle in this one."""
+        if later.high > self.high:
+            self.high = later.high
+        if later.low < self.low:
+            self.low = later.low
+        self.close = later.close
+        self.spread = later.spread
+        self.count += later.count
+
+class CandleRing(object):
+    """Fixed size ring of candles with the given resolution in seconds,
+indexed by period so the candle for a given time is found in constant
+time.  Older candles are overwritten when the ring wrap around.
+
+    """
+    __slots__ = ('resolution', 'size', 'slots')
+    def __init__(self, resolution, size):
+        self.resolution = resolution
+        self.size = size
+        self.slots = [None] * size
+    def get(self, start):
+        c = self.slots[int(start // self.resolution) % self.size]
+        if c is not None and c.start == start:
+            return c
+        return None
+    def put(self, candle):
+        self.slots[int(candle.start // self.resolution) % self.size] = candle
+
+class CandleSeries(object):
+    """Candles for one service and pair.  Only the candle of the finest
+resolution is updated per rate update.  When it close, it is merged
+into the candle of the next resolution, which in turn is merged into
+the next one when it close.  The candles in progress are merged when
+a coarser candle is looked up.
+
+    """
+    def __init__(self, resolutions, size):
+        resolutions = sorted(resolutions)
+        for finer, coarser in zip(resolutions, resolutions[1:]):
+            if coarser % finer:
+                raise ValueError('resolution %s is not a multiple of %s' %
+                                 (coarser, finer))
+        self.resolutions = resolutions
+        self.levels = dict((resolution, level)
+                           for level, resolution in enumerate(resolutions))
+        self.rings = [CandleRing(resolution, size) for resolution in resolutions]
+        # The candle in progress per level, not yet merged into the
+        # next level
+        self.current = [None] * len(resolutions)
+    def update(self, price, spread, when):
+        resolution = self.resolutions[0]
+        start = when // resolution * resolution
+        c = self.current[0]
+        if c is not None:
+            # Late updates are counted in the current candle
+            if start <= c.start:
+                if price > c.high:
+                    c.high = price
+                elif price < c.low:
+                    c.low = price
+                c.close = price
+                c.spread = spread
+                c.count += 1
+                return
+            self._close(0)
+        c = Candle(start, price, price, price, price, spread, 1)
+        self.current[0] = c
+        self.rings[0].put(c)
+    def _close(self, level):
+        c = self.current[level]
+        self.current[level] = None
+        level += 1
+        if level == len(self.resolutions):
+            return
+        resolution = self.resolutions[level]
+        start = c.start // resolution * resolution
+        parent = self.current[level]
+        if parent is not None:
+            if parent.start == start:
+                parent.merge(c)
+                return
+            self._close(level)
+        parent = c.copy(start)
+        self.current[level] = parent
+        self.rings[level].put(parent)
+    def candle(self, resolution, when):
+        """Return the candle with the given resolution covering the given
+time, or None if no updates are seen during the period.
+
+        """
+        level = self.levels[resolution]
+        start = when // resolution * resolution
+        c = self.rings[level].get(start)
+        if c is not None and 0 < level:
+            c = c.copy()
+        for finer in range(level - 1, -1, -1):
+            child = self.current[finer]
+            if child is not None and start <= child.start < start + resolution:
+                if c is None:
+                    c = child.copy(start)
+                else:
+                    c.merge(child)
+        return c
+
+class CandleAggregator(object):
+    """Build OHLC candles of the mid price per service and pair at
+several resolutions at once, from the rate updates of the services
+given to add().  Order book updates moving the best prices update the
+rates and are included.  The candles are based on the time the rates
+are stored, and the last size candles are kept for each resolution.
+Each resolution must be a multiple of the finer ones.
+
+    """
+    def __init__(self, services = (), resolutions = (1, 60, 300, 3600),
+                 size = 1024):
+        self.resolutions = resolutions
+        self.size = size
+        # Map (servicename, pair) to CandleSeries
+        self.series = {}
+        for service in services:
+            self.add(service)
+    def add(self, service):
+        """Aggregate the rates of the given service."""
+        service.subscribe(self._rateupdated)
+    def _rateupdated(self, service, pair, changed):
+        # Restored rates are not used until the service confirm them
+        if pair in service.stale:
+            return
+        rate = service.rates[pair]
+        self.update(service.servicename(), pair, rate.ask, rate.bid, rate.stored)
+    def update(self, servicename, pair, ask, bid, when = None):
+        """Include the given rate.  Called automatically for the services
+given to add().  Rates with a missing or NaN price are ignored.
+
+        """
+        # NaN is not equal to itself
+        if ask is None or bid is None or ask != ask or bid != bid:
+            return
+        if when is None:
+            when = time.time()
+        key = (servicename, pair)
+        series = self.series.get(key)
+        if series is None:
+            series = CandleSeries(self.resolutions, self.size)
+            self.series[key] = series
+        series.update((ask + bid) / 2, ask - bid, when)
+    def candle(self, servicename, pair, resolution, when = None):
+        """Return the Candle with the given resolution covering the given
+time, by default the current one, or None if there were no updates.
+
+        """
+        series = self.series.get((servicename, pair))
+        if series is None:
+            return None
+        if when is None:
+            when = time.time()
+        return series.candle(resolution, when)
+    def candles(self, servicename, pair, resolution, count, when = None):
+        """Return the candles of the last count periods with the given
+resolution up to the given time, oldest first, skipping periods
+without updates.
+
+        """
+        if when is None:
+            when = time.time()
+        res = []
+        for i in range(min(count, self.size) - 1, -1, -1):
+            c = self.candle(servicename, pair, resolution,
+                            when - i * resolution)
+            if c is not None:
+                res.append(c)
+        return res
+
+class TestCandles(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def testAggregate(self):
+        from valutakrambod.service.dummyservice import DummyService
+        s = DummyService()
+        name = s.servicename()
+        pair = ('BTC', 'EUR')
+        a = CandleAggregator([s], resolutions=(1, 60, 300), size=16)
+        s.updateRates(pair, Decimal('101'), Decimal('99'), None)
+        self.assertEqual(Decimal('100'), a.candle(name, pair, 60).close)
+        # Restored rates wait for the service
+        s.stale.add(pair)
+        s.rates[pair].ask = Decimal('201')
+        a._rateupdated(s, pair, True)
+        self.assertEqual(Decimal('100'), a.candle(name, pair, 60).close)
+
+        a = CandleAggregator(resolutions=(1, 60, 300), size=16)
+        ticks = [
+            (0.1, 101, 99),   # mid 100
+            (0.5, 103, 101),  # mid 102
+            (30, 98, 96),     # mid 97
+            (61, 106, 104),   # mid 105
+            (61.5, 101, 99),  # mid 100
+        ]
+        for when, ask, bid in ticks:
+            a.update(name, pair, Decimal(ask), Decimal(bid), when)
+        c = a.candle(name, pair, 1, 0)
+        self.assertEqual((0, Decimal('100'), Decimal('102'), Decimal('100'),
+                          Decimal('102'), 2),
+                         (c.start, c.open, c.high, c.low, c.close, c.count))
+        # Minute candles built from closed and open second candles
+        c = a.candle(name, pair, 60, 0)
+        self.assertEqual((Decimal('100'), Decimal('102'), Decimal('97'),
+                          Decimal('97'), 3),
+                         (c.open, c.high, c.low, c.close, c.count))
+        c = a.candle(name, pair, 300, 62)
+        self.assertEqual((0, Decimal('100'), Decimal('105'), Decimal('97'),
+                          Decimal('100'), 5),
+                         (c.start, c.open, c.high, c.low, c.close, c.count))
+        a.update(name, pair, Decimal(111), Decimal(109), 301)
+        c = a.candle(name, pair, 300, 0)
+        self.assertEqual((Decimal('105'), Decimal('100'), 5),
+                         (c.high, c.close, c.count))
+        self.assertEqual(Decimal('2'), c.spread)
+        self.assertEqual([0, 60, 300],
+                         [c.start for c in a.candles(name, pair, 60, 6, 301)])
+        self.assertEqual(None, a.candle(name, pair, 1, 2))
+        with self.assertRaises(ValueError):
+            CandleSeries((60, 90), 4)
+
+if __name__ == '__main__':
+    t = TestCandles()
+    unittest.main()
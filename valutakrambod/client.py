@@ -6,11 +6,13 @@ import functools
 import tornado.ioloop
 
 from . import *
+import valutakrambod.snapshot
 
 class SimpleClient(object):
-    def __init__(self):
+    def __init__(self, snapshotpath = None):
         self.services = []
         self.streams = []
+        self.snapshotpath = snapshotpath
         pass
     def newdata(self, service, pair, changed):
         print("%-15s %s-%s: %8.3f %8.3f" % (
@@ -25,8 +27,10 @@ class SimpleClient(object):
     def run(self):
         self.ioloop = tornado.ioloop.IOLoop.current()
         self.services = valutakrambod.service.knownServices()
+        services = []
         for e in self.services:
             service = e()
+            services.append(service)
             service.subscribe(self.newdata)
             stream = service.websocket()
             if stream:
@@ -37,6 +41,13 @@ class SimpleClient(object):
                                        functools.partial(self.refresh, service))
                 # as well as regularly
                 service.periodicUpdate(60)
+        snapshotter = None
+        if self.snapshotpath is not None:
+            snapshotter = valutakrambod.snapshot.Snapshotter(services,
+                                                             self.snapshotpath)
+            for service, pair in snapshotter.restore():
+                self.newdata(service, pair, True)
+            snapshotter.start()
         for stream in self.streams:
             stream.connect()
         try:
@@ -44,6 +55,8 @@ class SimpleClient(object):
         except KeyboardInterrupt:
             print("Interrupted by keyboard, closing all connections.")
             pass
+        if snapshotter is not None:
+            snapshotter.save()
         for stream in self.streams:
             stream.close()
 
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Order book merging the order books of one pair from several services.
+
+"""
+
+import unittest
+
+from decimal import Decimal
+
+from valutakrambod.services import Orderbook
+
+class ConsolidatedBook(object):
+    """Merged order book for one pair across several services.  The
+merged price levels are kept in an Orderbook in the book member, with
+the total volume at each price, and the volume from each service is
+tagged per price level.  The best price and the depth at a given price
+are found in O(log n) time.
+
+The merge is incremental.  When the book of a service is changed in
+place, only the changed price levels are merged, using the change
+tracking of Orderbook.  When a service replace its book with a new
+object, like services sending complete snapshots, the new book is
+compared with the levels seen last time from the same service.  Books
+of pairs flagged as stale by the service, like books restored from a
+snapshot, are not merged until the service update them.
+
+    """
+    def __init__(self, pair, services = ()):
+        self.pair = pair
+        self.book = Orderbook()
+        self.venues = {
+            Orderbook.SIDE_ASK : {},
+            Orderbook.SIDE_BID : {},
+        }
+        # Map service name to the last book seen and the levels it
+        # contributed, per side.
+        self.sources = {}
+        self.subscribers = []
+        for service in services:
+            self.add(service)
+    def add(self, service):
+        """Start merging the order book of the given service."""
+        service.depthsubscribe(self._bookupdated)
+        if self.pair in service.orderbooks and self.pair not in service.stale:
+            self._merge(service.servicename(), service.orderbooks[self.pair])
+    def remove(self, service):
+        """Stop merging the order book of the given service, and remove its
+price levels from the merged book.
+
+        """
+        service.depthsubscribers.remove(self._bookupdated)
+        venue = service.servicename()
+        if venue not in self.sources:
+            return
+        before = self.book.top(raw=True)
+        book, levels = self.sources.pop(venue)
+        book.untrackchanges(self)
+        for side, seen in levels.items():
+            for price in list(seen.keys()):
+                self._setvenue(side, venue, price, None, seen)
+        self._notify(before)
+    def subscribe(self, callback):
+        """Call callback(consolidated, pair, l1changed) every time the
+merged book is updated, with l1changed telling if the best ask or bid
+price or volume moved.
+
+        """
+        self.subscribers.append(callback)
+    def _bookupdated(self, service, pair, l1changed):
+        if pair != self.pair:
+            return
+        before = self.book.top(raw=True)
+        self._merge(service.servicename(), service.orderbooks[pair])
+        self._notify(before)
+    def _notify(self, before):
+        l1changed = before != self.book.top(raw=True)
+        for s in self.subscribers:
+            s(self, self.pair, l1changed)
+    def _merge(self, venue, book):
+        source = self.sources.get(venue)
+        if source is None or source[0] is not book:
+            # A new book object, compare all its levels with the
+            # ones seen last time.
+            book.trackchanges(self)
+            book.popchanges(self)
+            if source is None:
+                levels = {
+                    Orderbook.SIDE_ASK : {},
+                    Orderbook.SIDE_BID : {},
+                }
+            else:
+                source[0].untrackchanges(self)
+                levels = source[1]
+            self.sources[venue] = (book, levels)
+            changes = {
+                Orderbook.SIDE_ASK : None,
+                Orderbook.SIDE_BID : None,
+            }
+        else:
+            levels = source[1]
+            changes = book.popchanges(self)
+        for side, table in ((Orderbook.SIDE_ASK, book.ask),
+                            (Orderbook.SIDE_BID, book.bid)):
+            seen = levels[side]
+            prices = changes[side]
+            if prices is None:
+                prices = set(seen.keys())
+                prices.update(table.keys())
+            elif book.pricedecimals is not None:
+                prices = [Decimal(p).scaleb(-book.pricedecimals)
+                          for p in prices]
+            for price in prices:
+                volume = table.get(price)
+                if volume != seen.get(price):
+                    self._setvenue(side, venue, price, volume, seen)
+    def _setvenue(self, side, venue, price, volume, seen):
+        atprice = self.venues[side].get(price)
+        if volume:
+            seen[price] = volume
+            if atprice is None:
+                atprice = {}
+                self.venues[side][price] = atprice
+            atprice[venue] = volume
+        else:
+            # Zero volume levels are treated as missing
+            seen.pop(price, None)
+            if atprice is None:
+                return
+            atprice.pop(venue, None)
+        if atprice:
+            self.book.update(side, price, sum(atprice.values()))
+        else:
+            del self.venues[side][price]
+            self.book.remove(side, price)
+    def best(self, side):
+        """Return the best price on the given side across all services as
+(price, volume, venues), where venues map service name to the volume
+it provide at that price, or None if the side is empty.
+
+        """
+        table = {
+            Orderbook.SIDE_ASK : self.book.ask,
+            Orderbook.SIDE_BID : self.book.bid,
+        }[side]
+        if 0 == len(table):
+            return None
+        price, volume = table.peekitem(0)
+        return (price, volume, dict(self.venues[side][price]))
+    def top(self):
+        """Return the best merged levels as (askprice, askvolume, bidprice,
+bidvolume), see Orderbook.top().
+
+        """
+        return self.book.top()
+    def venuesat(self, side, price):
+        """Return a dict mapping service name to the volume it provide at
+the given price.
+
+        """
+        return dict(self.venues[side].get(price, {}))
+    def volume_at(self, side, price):
+        """Return the total volume at the given price."""
+        table = {
+            Orderbook.SIDE_ASK : self.book.ask,
+            Orderbook.SIDE_BID : self.book.bid,
+        }[side]
+        return table.get(price, Decimal(0))
+    def volume_within(self, side, price):
+        """Return the total volume at the given price or better."""
+        return self.book.volume_within(side, price)
+    def snapshot(self):
+        """Return a read only snapshot of the merged book."""
+        return self.book.snapshot()
+
+class TestConsolidatedBook(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def setUp(self):
+        from valutakrambod.service.dummyservice import DummyService
+        self.pair = ('BTC', 'EUR')
+        self.s1 = DummyService()
+        self.s2 = DummyService()
+        self.s2.tickdecimals = { self.pair : (2, 8) }
+        self.s1.updateOrderbook(self.pair, self.s1.newOrderbook(
+            self.pair,
+            [(Decimal('101'), Decimal('1')), (Decimal('102'), Decimal('1'))],
+            [(Decimal('100'), Decimal('1')), (Decimal('99'), Decimal('1'))]))
+        self.c = ConsolidatedBook(self.pair, [self.s1, self.s2])
+    def testMerge(self):
+        pair = self.pair
+        n1 = self.s1.servicename()
+        n2 = self.s2.servicename()
+        self.assertEqual((Decimal('101'), Decimal('1'), {n1: Decimal('1')}),
+                         self.c.best(Orderbook.SIDE_ASK))
+        self.s2.updateOrderbook(pair, self.s2.newOrderbook(
+            pair,
+            [(Decimal('101.00'), Decimal('2')), (Decimal('103'), Decimal('1'))],
+            [(Decimal('100.50'), Decimal('1'))]))
+        price, volume, venues = self.c.best(Orderbook.SIDE_ASK)
+        self.assertEqual(Decimal('101'), price)
+        self.assertEqual(Decimal('3'), volume)
+        self.assertEqual({n1: Decimal('1'), n2: Decimal('2')}, venues)
+        self.assertEqual(Decimal('100.5'), self.c.best(Orderbook.SIDE_BID)[0])
+        self.assertEqual(Decimal('4'),
+                         self.c.volume_within(Orderbook.SIDE_ASK, Decimal('102')))
+
+        # In place changes are merged incrementally
+        book = self.s2.orderbooks[pair]
+        book.apply_delta(Orderbook.SIDE_ASK, [(Decimal('101'), Decimal('0')),
+                                              (Decimal('102'), Decimal('4'))])
+        self.s2.updateOrderbook(pair, book)
+        self.assertEqual({n1: Decimal('1')},
+                         self.c.venuesat(Orderbook.SIDE_ASK, Decimal('101')))
+        self.assertEqual(Decimal('5'),
+                         self.c.volume_at(Orderbook.SIDE_ASK, Decimal('102')))
+
+        # A full replacement of the same book is compared level by level
+        book.replace_side(Orderbook.SIDE_BID, [(Decimal('98'), Decimal('1'))])
+        self.s2.updateOrderbook(pair, book)
+        self.assertEqual(Decimal('100'), self.c.best(Orderbook.SIDE_BID)[0])
+        self.assertEqual(Decimal('0'),
+                         self.c.volume_at(Orderbook.SIDE_BID, Decimal('100.5')))
+
+        self.c.remove(self.s1)
+        self.assertEqual((Decimal('102'), Decimal('4'), Decimal('98'), Decimal('1')),
+                         self.c.top())
+        self.assertEqual([], self.s1.depthsubscribers)
+    def testStale(self):
+        from valutakrambod.service.dummyservice import DummyService
+        pair = self.pair
+        s3 = DummyService()
+        s3.restore(self.s1.snapshot())
+        self.c.add(s3)
+        n3 = s3.servicename()
+        self.assertEqual({self.s1.servicename(): Decimal('1')},
+                         self.c.venuesat(Orderbook.SIDE_ASK, Decimal('101')))
+        s3.updateOrderbook(pair, s3.orderbooks[pair])
+        self.assertFalse(pair in s3.stale)
+        self.assertEqual(Decimal('1'),
+                         self.c.venuesat(Orderbook.SIDE_ASK, Decimal('101'))[n3])
+    def testUntrack(self):
+        pair = self.pair
+        book = self.s1.orderbooks[pair]
+        self.assertIsNotNone(book.popchanges(self.c))
+        # Replaced books are no longer tracked
+        self.s1.updateOrderbook(pair, self.s1.newOrderbook(
+            pair, [(Decimal('101'), Decimal('2'))],
+            [(Decimal('100'), Decimal('1'))]))
+        self.assertIsNone(book.popchanges(self.c))
+        book = self.s1.orderbooks[pair]
+        self.c.remove(self.s1)
+        book.update(Orderbook.SIDE_ASK, Decimal('105'), Decimal('1'))
+        self.assertIsNone(book.popchanges(self.c))
+    def testTwoConsumers(self):
+        pair = self.pair
+        c2 = ConsolidatedBook(pair, [self.s1, self.s2])
+        book = self.s1.orderbooks[pair]
+        book.apply_delta(Orderbook.SIDE_ASK, [(Decimal('101'), Decimal('3'))])
+        self.s1.updateOrderbook(pair, book)
+        n1 = self.s1.servicename()
+        for c in (self.c, c2):
+            self.assertEqual(Decimal('3'),
+                             c.venuesat(Orderbook.SIDE_ASK, Decimal('101'))[n1])
+        # One consumer leaving do not stop the tracking for the other
+        c2.remove(self.s1)
+        book.apply_delta(Orderbook.SIDE_ASK, [(Decimal('101'), Decimal('4'))])
+        self.s1.updateOrderbook(pair, book)
+        self.assertEqual(Decimal('4'),
+                         self.c.venuesat(Orderbook.SIDE_ASK, Decimal('101'))[n1])
+
+if __name__ == '__main__':
+    t = TestConsolidatedBook()
+    unittest.main()
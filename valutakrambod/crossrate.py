@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Rates derived by combining the rates of several services, like
+BTC/NOK from BTC/EUR and EUR/NOK.
+
+"""
+
+import time
+import unittest
+
+from decimal import Decimal
+
+from valutakrambod.services import Quote
+
+class CrossRates(object):
+    """Keep derived rates up to date as the rates they depend on change.
+A derived pair is defined as a chain of legs, each a (servicename,
+pair) tuple naming the rate of a service, or of this engine to build
+on other derived rates.  Each leg is used as given or inverted, as
+needed to get from the base to the quote currency of the derived pair.
+
+The derived ask is the price of buying through the chain, ie the ask
+of direct legs and the inverted bid of inverted legs, and the derived
+bid the price of selling through the chain.  The timestamp is the one
+of the oldest leg.
+
+When a rate change, only the derived rates depending on it are
+calculated again, followed by the derived rates depending on those.
+The derived rates are kept in the rates member as Quote records, and
+subscribers are called like the subscribers of a Service.
+
+    """
+    def __init__(self, services = (), name = 'CrossRates'):
+        self.name = name
+        self.services = {}
+        self.rates = {}
+        self.legs = {}
+        # Map (servicename, pair) to the derived pairs using it
+        self.dependents = {}
+        self.subscribers = []
+        for service in services:
+            self.add(service)
+    def servicename(self):
+        return self.name
+    def add(self, service):
+        """Use the rates of the given service."""
+        self.services[service.servicename()] = service
+        service.subscribe(self._rateupdated)
+    def subscribe(self, callback):
+        """Call callback(crossrates, pair, changed) when a derived rate is
+calculated.
+
+        """
+        self.subscribers.append(callback)
+    def define(self, pair, legs):
+        """Derive the rate of pair from the given chain of legs.  Raise
+ValueError if the legs do not lead from the base to the quote currency
+of the pair, or if the definition would make a derived rate depend on
+itself.
+
+        """
+        chain = []
+        currency = pair[0]
+        for servicename, legpair in legs:
+            if legpair[0] == currency:
+                chain.append((servicename, legpair, False))
+                currency = legpair[1]
+            elif legpair[1] == currency:
+                chain.append((servicename, legpair, True))
+                currency = legpair[0]
+            else:
+                raise ValueError('leg %s/%s do not continue from %s' %
+                                 (legpair[0], legpair[1], currency))
+        if currency != pair[1]:
+            raise ValueError('legs end in %s, not %s' % (currency, pair[1]))
+        if self._dependson(pair, chain):
+            raise ValueError('%s/%s would depend on itself' % pair)
+        self.undefine(pair)
+        self.legs[pair] = chain
+        for servicename, legpair, inverted in chain:
+            key = (servicename, legpair)
+            if key not in self.dependents:
+                self.dependents[key] = []
+            self.dependents[key].append(pair)
+        self._update(pair)
+    def undefine(self, pair):
+        """Stop deriving the rate of pair."""
+        if pair not in self.legs:
+            return
+        for servicename, legpair, inverted in self.legs.pop(pair):
+            key = (servicename, legpair)
+            self.dependents[key].remove(pair)
+            if 0 == len(self.dependents[key]):
+                del self.dependents[key]
+        self.rates.pop(pair, None)
+    def _dependson(self, pair, chain):
+        for servicename, legpair, inverted in chain:
+            if servicename != self.name:
+                continue
+            if legpair == pair or \
+               self._dependson(pair, self.legs.get(legpair, [])):
+                return True
+        return False
+    def _rate(self, servicename, pair):
+        if servicename == self.name:
+            return self.rates.get(pair)
+        service = self.services.get(servicename)
+        # Restored rates are not used until the service confirm them
+        if service is None or pair in service.stale:
+            return None
+        return service.rates.get(pair)
+    def _rateupdated(self, service, pair, changed):
+        if not changed:
+            return
+        for derived in self.dependents.get((service.servicename(), pair), ()):
+            self._update(derived)
+    def _update(self, pair):
+        ask = bid = Decimal(1)
+        when = None
+        for servicename, legpair, inverted in self.legs[pair]:
+            rate = self._rate(servicename, legpair)
+            if rate is None:
+                return
+            if inverted:
+                if not rate.ask or not rate.bid:
+                    return
+                ask = ask / rate.bid
+                bid = bid / rate.ask
+            else:
+                ask = ask * rate.ask
+                bid = bid * rate.bid
+            if rate.when is not None and (when is None or rate.when < when):
+                when = rate.when
+        now = time.time()
+        old = self.rates.get(pair)
+        if old is not None and old.ask == ask and old.bid == bid \
+           and old.when == when:
+            old.stored = now
+            changed = False
+        else:
+            self.rates[pair] = Quote(ask, bid, when, now,
+                                     when if when else now)
+            changed = True
+        for s in self.subscribers:
+            s(self, pair, changed)
+        if changed:
+            for derived in self.dependents.get((self.name, pair), ()):
+                self._update(derived)
+
+class TestCrossRates(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def testDerive(self):
+        from valutakrambod.service.dummyservice import DummyService
+        btceur = ('BTC', 'EUR')
+        eurnok = ('EUR', 'NOK')
+        usdnok = ('USD', 'NOK')
+        btcnok = ('BTC', 'NOK')
+        s1 = DummyService()
+        s2 = DummyService()
+        s1.updateRates(btceur, Decimal('101'), Decimal('100'), 20)
+        c = CrossRates([s1, s2])
+        calls = []
+        c.subscribe(lambda engine, pair, changed: calls.append(pair))
+        c.define(btcnok, [(s1.servicename(), btceur), (s2.servicename(), eurnok)])
+        self.assertFalse(btcnok in c.rates)
+        s2.updateRates(eurnok, Decimal('10'), Decimal('9'), 10)
+        self.assertEqual(Decimal('1010'), c.rates[btcnok]['ask'])
+        self.assertEqual(Decimal('900'), c.rates[btcnok]['bid'])
+        self.assertEqual(10, c.rates[btcnok]['when'])
+
+        # Inverted legs, and rates derived from derived rates
+        c.define(('NOK', 'BTC'), [(c.servicename(), btcnok)])
+        self.assertEqual(1 / Decimal('900'), c.rates[('NOK', 'BTC')].ask)
+        c.define(('BTC', 'USD'), [(c.servicename(), btcnok), (s2.servicename(), usdnok)])
+        s2.updateRates(usdnok, Decimal('8'), Decimal('8'), 11)
+        self.assertEqual(Decimal('1010') / 8, c.rates[('BTC', 'USD')].ask)
+        calls.clear()
+        s1.updateRates(btceur, Decimal('102'), Decimal('100'), 21)
+        self.assertEqual([btcnok, ('NOK', 'BTC'), ('BTC', 'USD')], calls)
+        self.assertEqual(Decimal('1020') / 8, c.rates[('BTC', 'USD')].ask)
+        calls.clear()
+        s1.updateRates(('BTC', 'USD'), Decimal('1'), Decimal('1'), 21)
+        self.assertEqual([], calls)
+
+        # Stale legs are not used
+        s3 = DummyService()
+        s3.restore(s2.snapshot())
+        c3 = CrossRates([s1, s3])
+        c3.define(btcnok, [(s1.servicename(), btceur), (s3.servicename(), eurnok)])
+        s1.updateRates(btceur, Decimal('103'), Decimal('100'), 22)
+        self.assertFalse(btcnok in c3.rates)
+        s3.updateRates(eurnok, Decimal('10'), Decimal('9'), 12)
+        self.assertEqual(Decimal('1030'), c3.rates[btcnok].ask)
+
+        with self.assertRaises(ValueError):
+            c.define(btcnok, [(s1.servicename(), btceur), (s2.servicename(), usdnok)])
+        with self.assertRaises(ValueError):
+            c.define(btcnok, [(c.servicename(), ('BTC', 'USD')), (s2.servicename(), usdnok)])
+
+if __name__ == '__main__':
+    t = TestCrossRates()
+    unittest.main()
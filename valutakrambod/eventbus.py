@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Event bus passing updates from many services to subscribers filtering
+on service, pair and kind of event.
+
+"""
+
+import collections
+import unittest
+
+from decimal import Decimal
+
+class EventBus(object):
+    """Central dispatch of events from the services attached to the bus.
+Subscribers give the service name, pair and kind of event they want,
+where None match anything, and are called as callback(service, pair,
+kind, data).  The data is the changed flag for rate events, the
+l1changed flag for orderbook events and the message for error events,
+where the pair is None.
+
+Subscriptions are indexed on their key, so publishing an event only
+look up the keys able to match it, and only matching subscribers are
+called, no matter how many subscribers exist.
+
+    """
+    RATE = 'rate'
+    ORDERBOOK = 'orderbook'
+    ERROR = 'error'
+    def __init__(self):
+        self.index = {}
+        # Count of subscriptions per combination of fields given, to
+        # only look up key patterns in use.
+        self.patterns = collections.Counter()
+    def attach(self, service):
+        """Publish the events of the given service on this bus."""
+        service.bus = self
+    def detach(self, service):
+        if service.bus is self:
+            service.bus = None
+    def subscribe(self, callback, servicename = None, pair = None, kind = None):
+        """Call callback(service, pair, kind, data) for events matching the
+given service name, pair and kind, where None match anything.  Return
+a token for unsubscribe().
+
+        """
+        key = (servicename, pair, kind)
+        self.index[key] = self.index.get(key, ()) + (callback,)
+        self.patterns[self._pattern(key)] += 1
+        return (key, callback)
+    def unsubscribe(self, token):
+        key, callback = token
+        callbacks = list(self.index.get(key, ()))
+        if callback not in callbacks:
+            raise ValueError('not subscribed')
+        callbacks.remove(callback)
+        if callbacks:
+            self.index[key] = tuple(callbacks)
+        else:
+            del self.index[key]
+        pattern = self._pattern(key)
+        self.patterns[pattern] -= 1
+        if 0 == self.patterns[pattern]:
+            del self.patterns[pattern]
+    def _pattern(self, key):
+        return tuple(v is not None for v in key)
+    def publish(self, service, pair, kind, data):
+        """Call the subscribers matching the given event."""
+        if not self.patterns:
+            return
+        servicename = service.servicename()
+        for hasname, haspair, haskind in list(self.patterns):
+            key = (servicename if hasname else None,
+                   pair if haspair else None,
+                   kind if haskind else None)
+            # The index store tuples, which are replaced and not
+            # changed when subscribing, so callbacks can unsubscribe.
+            for callback in self.index.get(key, ()):
+                callback(service, pair, kind, data)
+
+class TestEventBus(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def testDispatch(self):
+        from valutakrambod.service.dummyservice import DummyService
+        bus = EventBus()
+        s1 = DummyService()
+        s2 = DummyService()
+        bus.attach(s1)
+        bus.attach(s2)
+        events = []
+        def collect(name):
+            def callback(service, pair, kind, data):
+                events.append((name, service.servicename(), pair, kind))
+            return callback
+        bus.subscribe(collect('all'))
+        bus.subscribe(collect('s1eur'), s1.servicename(), ('BTC', 'EUR'))
+        token = bus.subscribe(collect('rates'), kind=EventBus.RATE)
+        bus.subscribe(collect('errors'), kind=EventBus.ERROR)
+
+        s1.updateRates(('BTC', 'EUR'), Decimal('2'), Decimal('1'), 10)
+        self.assertEqual(3, len(events))
+        self.assertEqual(set(['all', 's1eur', 'rates']),
+                         set(e[0] for e in events))
+        events.clear()
+        s2.updateRates(('BTC', 'EUR'), Decimal('2'), Decimal('1'), 10)
+        self.assertEqual(set(['all', 'rates']), set(e[0] for e in events))
+        events.clear()
+        s2.logerror('failed')
+        self.assertEqual(set([('all', s2.servicename(), None, EventBus.ERROR),
+                              ('errors', s2.servicename(), None, EventBus.ERROR)]),
+                         set(events))
+        events.clear()
+        bus.unsubscribe(token)
+        s2.updateRates(('BTC', 'EUR'), Decimal('3'), Decimal('1'), 11)
+        self.assertEqual(['all'], [e[0] for e in events])
+        bus.detach(s2)
+        events.clear()
+        s2.updateRates(('BTC', 'EUR'), Decimal('4'), Decimal('1'), 12)
+        self.assertEqual([], events)
+
+if __name__ == '__main__':
+    t = TestEventBus()
+    unittest.main()
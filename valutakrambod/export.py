@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Export the current rates and order books of services as numpy
+structured arrays, for vectorized analysis of the whole market.  This
+module require numpy, which is an optional dependency of the library.
+
+"""
+
+import itertools
+import unittest
+
+import numpy
+
+from decimal import Decimal
+
+def _strwidth(strings):
+    return max(itertools.chain([1], map(len, strings)))
+
+def quotes(services):
+    """Return a structured array with one row per service and pair, with
+the fields service, base, quote, ask, bid, when, stored, lastchange and
+stale.  Missing prices and times are NaN.
+
+    """
+    entries = [(service, pair, rate)
+               for service in services
+               for pair, rate in service.rates.items()]
+    names = [service.servicename() for service in services]
+    currencies = [c for service, pair, rate in entries for c in pair]
+    dtype = numpy.dtype([
+        ('service', 'U%d' % _strwidth(names)),
+        ('base', 'U%d' % _strwidth(currencies)),
+        ('quote', 'U%d' % _strwidth(currencies)),
+        ('ask', numpy.float64),
+        ('bid', numpy.float64),
+        ('when', numpy.float64),
+        ('stored', numpy.float64),
+        ('lastchange', numpy.float64),
+        ('stale', numpy.bool_),
+    ])
+    res = numpy.empty(len(entries), dtype=dtype)
+    nan = float('nan')
+    for i, (service, pair, rate) in enumerate(entries):
+        res[i] = (service.servicename(), pair[0], pair[1],
+                  nan if rate.ask is None else rate.ask,
+                  nan if rate.bid is None else rate.bid,
+                  nan if rate.when is None else rate.when,
+                  nan if rate.stored is None else rate.stored,
+                  nan if rate.lastchange is None else rate.lastchange,
+                  pair in service.stale)
+    return res
+
+def books(services, depth):
+    """Return a structured array with one row per order book, with the
+fields service, base, quote and lastupdate, and askprice, askvolume,
+bidprice and bidvolume arrays with the depth best levels of each side,
+best first.  Books with fewer levels are padded with NaN.
+
+    """
+    entries = [(service, pair, book)
+               for service in services
+               for pair, book in service.orderbooks.items()]
+    names = [service.servicename() for service in services]
+    currencies = [c for service, pair, book in entries for c in pair]
+    dtype = numpy.dtype([
+        ('service', 'U%d' % _strwidth(names)),
+        ('base', 'U%d' % _strwidth(currencies)),
+        ('quote', 'U%d' % _strwidth(currencies)),
+        ('lastupdate', numpy.float64),
+        ('askprice', numpy.float64, (depth,)),
+        ('askvolume', numpy.float64, (depth,)),
+        ('bidprice', numpy.float64, (depth,)),
+        ('bidvolume', numpy.float64, (depth,)),
+    ])
+    res = numpy.empty(len(entries), dtype=dtype)
+    for field in ('lastupdate', 'askprice', 'askvolume', 'bidprice',
+                  'bidvolume'):
+        res[field] = numpy.nan
+    for i, (service, pair, book) in enumerate(entries):
+        row = res[i]
+        row['service'] = service.servicename()
+        row['base'] = pair[0]
+        row['quote'] = pair[1]
+        if book.lastupdate is not None:
+            row['lastupdate'] = book.lastupdate
+        for table, pricefield, volumefield in (
+                (book._ask, 'askprice', 'askvolume'),
+                (book._bid, 'bidprice', 'bidvolume')):
+            n = min(depth, len(table))
+            if 0 == n:
+                continue
+            levels = table.items()[:n]
+            if book.pricedecimals is None:
+                row[pricefield][:n] = [float(p) for p, v in levels]
+                row[volumefield][:n] = [float(v) for p, v in levels]
+            else:
+                row[pricefield][:n] = [p for p, v in levels]
+                row[pricefield][:n] /= 10.0 ** book.pricedecimals
+                row[volumefield][:n] = [v for p, v in levels]
+                row[volumefield][:n] /= 10.0 ** book.volumedecimals
+    return res
+
+def columns(array):
+    """Return a dict mapping the field names of a structured array to
+the column arrays, without copying, for use with pandas.DataFrame() or
+other columnar code.
+
+    """
+    return dict((name, array[name]) for name in array.dtype.names)
+
+def export(services, depth = 0, columnar = False):
+    """Return a dict with the quotes of all the given services, and if
+depth is above zero the depth best levels of their order books, as
+structured arrays, or as dicts of column arrays if columnar is set.
+
+    """
+    res = {'quotes': quotes(services)}
+    if 0 < depth:
+        res['books'] = books(services, depth)
+    if columnar:
+        res = dict((key, columns(value)) for key, value in res.items())
+    return res
+
+class TestExport(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def testExport(self):
+        from valutakrambod.service.dummyservice import DummyService
+        pair = ('BTC', 'EUR')
+        s1 = DummyService()
+        s2 = DummyService()
+        s2.tickdecimals = {pair: (1, 8)}
+        s1.updateOrderbook(pair, s1.newOrderbook(
+            pair,
+            [(Decimal('101.5'), Decimal('1')), (Decimal('102'), Decimal('0.5'))],
+            [(Decimal('100'), Decimal('2'))], 10))
+        s2.updateOrderbook(pair, s2.newOrderbook(
+            pair,
+            [(Decimal('101.7'), Decimal('0.25'))],
+            [(Decimal('99.9'), Decimal('3')), (Decimal('99.8'), Decimal('1')),
+             (Decimal('99.7'), Decimal('1'))], 11))
+        s2.updateRates(('BTC', 'USD'), Decimal('nan'), Decimal('120'), None)
+        s2.stale.add(('BTC', 'USD'))
+        q = quotes([s1, s2])
+        self.assertEqual(3, len(q))
+        self.assertEqual([s1.servicename(), s2.servicename(), s2.servicename()],
+                         list(q['service']))
+        self.assertEqual([101.5, 101.7], list(q['ask'][:2]))
+        self.assertTrue(numpy.isnan(q['ask'][2]))
+        self.assertEqual([False, False, True], list(q['stale']))
+        self.assertEqual([10.0, 11.0], list(q['when'][:2]))
+
+        e = export([s1, s2], depth = 2, columnar = True)
+        b = e['books']
+        self.assertEqual((2, 2), b['askprice'].shape)
+        self.assertEqual([101.5, 102.0], list(b['askprice'][0]))
+        self.assertEqual(101.7, b['askprice'][1][0])
+        self.assertTrue(numpy.isnan(b['askprice'][1][1]))
+        self.assertEqual([99.9, 99.8], list(b['bidprice'][1]))
+        self.assertEqual([3.0, 1.0], list(b['bidvolume'][1]))
+        spread = e['quotes']['ask'] - e['quotes']['bid']
+        self.assertEqual([1.5, 1.8], list(spread[:2].round(6)))
+        self.assertEqual(0, len(quotes([])))
+
+if __name__ == '__main__':
+    t = TestExport()
+    unittest.main()
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Detect rates going stale when a service stop sending updates.
+
+"""
+
+import time
+import unittest
+
+import tornado.ioloop
+
+from decimal import Decimal
+
+class TimerWheel(object):
+    """Hierarchical timing wheel, keeping timers with a given resolution
+in seconds.  Scheduling and cancelling a timer take constant time, and
+advancing the wheel take time proportional to the number of ticks
+passed and timers fired.  Each level has the given number of slots,
+and each slot on one level cover all the slots of the level below.
+Timers beyond the span of the top level come around again until their
+deadline is reached, so any number of levels give correct deadlines.
+
+    """
+    def __init__(self, resolution = 1.0, slots = 64, levels = 4, now = None):
+        if now is None:
+            now = time.time()
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.tick = int(now / resolution)
+        self.span = [slots ** level for level in range(levels + 1)]
+        self.wheels = [[{} for i in range(slots)] for level in range(levels)]
+        # Map key to the (level, slot) where its timer is stored
+        self.timers = {}
+    def __contains__(self, key):
+        return key in self.timers
+    def schedule(self, key, deadline):
+        """Fire the timer for key at the given time, replacing any existing
+timer for the key.
+
+        """
+        self.cancel(key)
+        t = -int(-deadline // self.resolution)
+        self._place(key, max(t, self.tick + 1))
+    def cancel(self, key):
+        where = self.timers.pop(key, None)
+        if where is not None:
+            level, slot = where
+            del self.wheels[level][slot][key]
+    def _place(self, key, t):
+        # Timers beyond the top level wait in the farthest slot, and
+        # are placed again when it is cascaded.
+        delta = min(t - self.tick, self.span[self.levels] - 1)
+        level = 0
+        while delta >= self.span[level + 1]:
+            level += 1
+        slot = ((self.tick + delta) // self.span[level]) % self.slots
+        self.wheels[level][slot][key] = t
+        self.timers[key] = (level, slot)
+    def advance(self, now = None):
+        """Move the wheel to the given time and return the list of keys with
+timers fired.
+
+        """
+        if now is None:
+            now = time.time()
+        target = int(now / self.resolution)
+        fired = []
+        while self.tick < target:
+            self.tick += 1
+            # Move the timers of higher level slots starting now down
+            # to the lower levels.
+            for level in range(1, self.levels):
+                if self.tick % self.span[level]:
+                    break
+                slot = (self.tick // self.span[level]) % self.slots
+                bucket = self.wheels[level][slot]
+                self.wheels[level][slot] = {}
+                for key, t in bucket.items():
+                    del self.timers[key]
+                    self._place(key, max(t, self.tick))
+            slot = self.tick % self.slots
+            bucket = self.wheels[0][slot]
+            if bucket:
+                self.wheels[0][slot] = {}
+                for key, t in bucket.items():
+                    del self.timers[key]
+                    if t > self.tick:
+                        # Parked in the farthest slot of a single
+                        # level wheel, wait another round.
+                        self._place(key, t)
+                    else:
+                        fired.append(key)
+        return fired
+
+class FreshnessTracker(object):
+    """Flag the rates of a service and pair as stale when no update arrive
+within the time to live (TTL), and as fresh again when updates return.
+Updates only record the time seen, and timers are kept in a
+TimerWheel, so the bookkeeping take constant time per update.  A timer
+firing for a pair seen since it was scheduled is moved to the new
+deadline.
+
+Subscribers are called as callback(service, pair, stale).  Views added
+using addview(), like valutakrambod.bestprice.BestPrices, get stale
+rates removed using view.remove(servicename, pair), and are refilled by
+the next update.  If droprates is set, stale rates are also removed
+from service.rates.  Call start() to check for stale rates from the
+IOLoop, or call advance() directly.
+
+    """
+    def __init__(self, services = (), ttl = 60, resolution = 1.0,
+                 droprates = False, now = None):
+        self.ttl = ttl
+        self.ttls = {}
+        self.resolution = resolution
+        self.droprates = droprates
+        self.wheel = TimerWheel(resolution, now = now)
+        self.lastseen = {}
+        self.stale = set()
+        self.subscribers = []
+        self.views = []
+        self.periodic = None
+        for service in services:
+            self.add(service)
+    def add(self, service):
+        """Track the rates of the given service."""
+        # Order book updates not moving the best prices call the rate
+        # subscribers too, with changed set to False.
+        service.subscribe(self._updated)
+    def addview(self, view):
+        self.views.append(view)
+    def subscribe(self, callback):
+        """Call callback(service, pair, stale) when a rate go stale or
+become fresh again.
+
+        """
+        self.subscribers.append(callback)
+    def setttl(self, ttl, servicename = None, pair = None):
+        """Set the TTL in seconds for the given service name and pair, where
+None match any service or pair.
+
+        """
+        self.ttls[(servicename, pair)] = ttl
+    def getttl(self, service, pair):
+        servicename = service.servicename()
+        for key in ((servicename, pair), (servicename, None), (None, pair)):
+            if key in self.ttls:
+                return self.ttls[key]
+        return self.ttl
+    def _updated(self, service, pair, changed):
+        self.seen(service, pair)
+    def seen(self, service, pair, when = None):
+        """Register an update for the pair of the given service."""
+        if when is None:
+            when = time.time()
+        key = (service, pair)
+        self.lastseen[key] = when
+        if key in self.stale:
+            self.stale.discard(key)
+            self._notify(service, pair, False)
+        if key not in self.wheel:
+            self.wheel.schedule(key, when + self.getttl(service, pair))
+    def isstale(self, service, pair):
+        return (service, pair) in self.stale
+    def advance(self, now = None):
+        """Flag the rates without updates within their TTL as stale."""
+        if now is None:
+            now = time.time()
+        for key in self.wheel.advance(now):
+            service, pair = key
+            deadline = self.lastseen[key] + self.getttl(service, pair)
+            if deadline > now:
+                self.wheel.schedule(key, deadline)
+                continue
+            self.stale.add(key)
+            if self.droprates:
+                service.rates.pop(pair, None)
+            for view in self.views:
+                view.remove(service.servicename(), pair)
+            self._notify(service, pair, True)
+    def _notify(self, service, pair, stale):
+        for s in self.subscribers:
+            s(service, pair, stale)
+    def start(self):
+        """Check for stale rates from the IOLoop, once per resolution."""
+        self.stop()
+        self.periodic = tornado.ioloop.PeriodicCallback(self.advance,
+                                                        self.resolution * 1000)
+        self.periodic.start()
+    def stop(self):
+        if self.periodic is not None:
+            self.periodic.stop()
+            self.periodic = None
+
+class TestFreshness(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def testWheel(self):
+        w = TimerWheel(resolution = 1, slots = 4, levels = 3, now = 0)
+        deadlines = {'a': 2, 'b': 5, 'c': 17, 'd': 40, 'e': 200}
+        for key, deadline in deadlines.items():
+            w.schedule(key, deadline)
+        w.schedule('f', 3)
+        w.cancel('f')
+        fired = {}
+        for now in range(0, 250):
+            for key in w.advance(now):
+                fired[key] = now
+        self.assertEqual(deadlines, fired)
+        self.assertEqual({}, w.timers)
+    def testSingleLevel(self):
+        w = TimerWheel(resolution = 1, slots = 8, levels = 1, now = 0)
+        w.schedule('far', 100)
+        w.schedule('near', 3)
+        fired = {}
+        for now in range(0, 120):
+            for key in w.advance(now):
+                fired[key] = now
+        self.assertEqual({'far': 100, 'near': 3}, fired)
+        self.assertEqual({}, w.timers)
+    def testStale(self):
+        from valutakrambod.bestprice import BestPrices
+        from valutakrambod.service.dummyservice import DummyService
+        pair = ('BTC', 'EUR')
+        s1 = DummyService()
+        s2 = DummyService()
+        prices = BestPrices([s1, s2])
+        # Updates are registered by hand below, to control the time
+        f = FreshnessTracker(ttl = 10, droprates = True, now = 0)
+        f.setttl(30, s2.servicename())
+        f.addview(prices)
+        events = []
+        f.subscribe(lambda service, pair, stale: events.append((service, stale)))
+        s1.updateRates(pair, Decimal('101'), Decimal('99'), 1)
+        s2.updateRates(pair, Decimal('102'), Decimal('98'), 1)
+        f.seen(s1, pair, 0)
+        f.seen(s2, pair, 0)
+        f.advance(5)
+        f.seen(s1, pair, 5)
+        f.advance(12)
+        self.assertEqual([], events)
+        f.advance(16)
+        self.assertEqual([(s1, True)], events)
+        self.assertTrue(f.isstale(s1, pair))
+        self.assertFalse(pair in s1.rates)
+        self.assertEqual((Decimal('102'), s2.servicename()),
+                         prices.best(pair, 'ask'))
+        f.seen(s1, pair, 17)
+        self.assertEqual([(s1, True), (s1, False)], events)
+        f.advance(31)
+        self.assertEqual((s2, True), events[-1])
+
+if __name__ == '__main__':
+    t = TestFreshness()
+    unittest.main()
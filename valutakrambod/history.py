@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Store the rate history of services in a SQLite database.
+
+"""
+
+import math
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import tornado.ioloop
+
+from decimal import Decimal
+
+class HistoryStore(object):
+    """Write the rate changes of the services given to add() to a SQLite
+database in WAL mode, so readers do not block the writer.  Changes are
+queued and inserted in one transaction when flush() is called, every
+flushinterval seconds after start() or when batchsize changes are
+queued.
+
+Rates older than rawretention seconds are downsampled to one row per
+resolution seconds (one minute by default) with the average prices,
+when downsample() is called, once an hour after start().  Each row
+keep the receive time, the time given by the service, the ask and bid
+prices as floats and the number of rates it covers.
+
+    """
+    def __init__(self, path, services = (), flushinterval = 1.0,
+                 batchsize = 10000, rawretention = 24 * 60 * 60,
+                 resolution = 60, downsampleinterval = 60 * 60):
+        self.path = path
+        self.flushinterval = flushinterval
+        self.batchsize = batchsize
+        self.rawretention = rawretention
+        self.resolution = resolution
+        self.downsampleinterval = downsampleinterval
+        self.pending = []
+        self.periodic = []
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        # Resolution is 0 for raw rates
+        self.db.execute('''CREATE TABLE IF NOT EXISTS quotes (
+  service TEXT NOT NULL,
+  base TEXT NOT NULL,
+  quote TEXT NOT NULL,
+  time REAL NOT NULL,
+  servicetime REAL,
+  ask REAL,
+  bid REAL,
+  count INTEGER NOT NULL,
+  resolution INTEGER NOT NULL
+)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS quotes_time
+  ON quotes (service, base, quote, time)''')
+        self.db.commit()
+        for service in services:
+            self.add(service)
+    def add(self, service):
+        """Store the rate changes of the given service."""
+        service.subscribe(self._rateupdated)
+    def _rateupdated(self, service, pair, changed):
+        if not changed:
+            return
+        rate = service.rates[pair]
+        self.record(service.servicename(), pair, rate.ask, rate.bid,
+                    rate.when, rate.stored)
+    def record(self, servicename, pair, ask, bid, when = None, stored = None):
+        """Queue a rate for storage.  Called automatically for the services
+given to add().
+
+        """
+        if stored is None:
+            stored = time.time()
+        self.pending.append((servicename, pair[0], pair[1], stored, when,
+                             self._float(ask), self._float(bid)))
+        if len(self.pending) >= self.batchsize:
+            self.flush()
+    def _float(self, price):
+        # NaN is stored as NULL by SQLite
+        if price is None or price != price:
+            return None
+        return float(price)
+    def flush(self):
+        """Insert the queued rates."""
+        if 0 == len(self.pending):
+            return
+        pending = self.pending
+        self.pending = []
+        with self.db:
+            self.db.executemany('''INSERT INTO quotes
+  (service, base, quote, time, servicetime, ask, bid, count, resolution)
+  VALUES (?, ?, ?, ?, ?, ?, ?, 1, 0)''', pending)
+    def downsample(self, now = None):
+        """Replace the raw rates older than rawretention seconds with one
+row per resolution seconds.  Only whole periods are downsampled.
+
+        """
+        if now is None:
+            now = time.time()
+        self.flush()
+        r = self.resolution
+        limit = math.floor((now - self.rawretention) / r) * r
+        with self.db:
+            self.db.execute('''INSERT INTO quotes
+  (service, base, quote, time, servicetime, ask, bid, count, resolution)
+  SELECT service, base, quote, CAST(time / ? AS INTEGER) * ?,
+    AVG(servicetime), AVG(ask), AVG(bid), COUNT(*), ?
+  FROM quotes WHERE resolution = 0 AND time < ?
+  GROUP BY service, base, quote, CAST(time / ? AS INTEGER)''',
+                            (r, r, r, limit, r))
+            self.db.execute('''DELETE FROM quotes
+  WHERE resolution = 0 AND time < ?''', (limit,))
+    def history(self, service, pair, start, end, resolution = None):
+        """Return the stored rates of a service (or service name) and pair
+received from start up to end, as a list of (time, ask, bid, count)
+tuples.  If resolution is given, the rates are averaged per resolution
+seconds, weighted by the number of rates each row covers, and the time
+is the start of the period.
+
+        """
+        if not isinstance(service, str):
+            service = service.servicename()
+        self.flush()
+        if resolution is None:
+            return self.db.execute('''SELECT time, ask, bid, count FROM quotes
+  WHERE service = ? AND base = ? AND quote = ? AND time >= ? AND time < ?
+  ORDER BY time''', (service, pair[0], pair[1], start, end)).fetchall()
+        return self.db.execute('''SELECT CAST(time / ? AS INTEGER) * ? AS period,
+    SUM(ask * count) / SUM(CASE WHEN ask IS NULL THEN 0 ELSE count END),
+    SUM(bid * count) / SUM(CASE WHEN bid IS NULL THEN 0 ELSE count END),
+    SUM(count)
+  FROM quotes
+  WHERE service = ? AND base = ? AND quote = ? AND time >= ? AND time < ?
+  GROUP BY period ORDER BY period''',
+                               (resolution, resolution, service, pair[0],
+                                pair[1], start, end)).fetchall()
+    def start(self):
+        """Flush and downsample regularly from the IOLoop."""
+        self.stop()
+        for callback, interval in ((self.flush, self.flushinterval),
+                                   (self.downsample, self.downsampleinterval)):
+            p = tornado.ioloop.PeriodicCallback(callback, interval * 1000)
+            p.start()
+            self.periodic.append(p)
+    def stop(self):
+        for p in self.periodic:
+            p.stop()
+        self.periodic = []
+    def close(self):
+        self.stop()
+        self.flush()
+        self.db.close()
+
+class TestHistoryStore(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def testHistory(self):
+        from valutakrambod.service.dummyservice import DummyService
+        s = DummyService()
+        pair = ('BTC', 'EUR')
+        with tempfile.TemporaryDirectory() as d:
+            h = HistoryStore(os.path.join(d, 'history.db'), [s],
+                             rawretention = 100)
+            s.updateRates(pair, Decimal('101'), Decimal('99'), None)
+            s.updateRates(pair, Decimal('101'), Decimal('99'), None)
+            self.assertEqual(1, len(h.pending))
+            h.pending = []
+            for t in range(0, 180, 10):
+                h.record(s.servicename(), pair, Decimal(100 + t), Decimal(99 + t),
+                         t - 1, t)
+            h.record(s.servicename(), pair, Decimal('nan'), Decimal(300), 180, 180)
+            rows = h.history(s, pair, 0, 30)
+            self.assertEqual([(0, 100.0, 99.0, 1), (10, 110.0, 109.0, 1),
+                              (20, 120.0, 119.0, 1)], rows)
+            rows = h.history(s.servicename(), pair, 0, 200, 60)
+            self.assertEqual((0, 125.0, 124.0, 6), rows[0])
+            self.assertEqual((120, 245.0, 244.0, 6), rows[2])
+            self.assertEqual((180, None, 300.0, 1), rows[3])
+
+            # Raw rates older than 100 seconds at time 260 are
+            # downsampled to one minute.
+            h.downsample(260)
+            raw = h.history(s, pair, 0, 200)
+            self.assertEqual((0, 125.0, 124.0, 6), raw[0])
+            self.assertEqual((60, 185.0, 184.0, 6), raw[1])
+            self.assertEqual((120, 220.0, 219.0, 1), raw[2])
+            self.assertEqual(rows, h.history(s, pair, 0, 200, 60))
+            h.close()
+
+if __name__ == '__main__':
+    t = TestHistoryStore()
+    unittest.main()
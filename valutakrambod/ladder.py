@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Array backed view of order books, for vectorized depth analytics.
+This module require numpy, which is an optional dependency of the
+library.
+
+"""
+
+import unittest
+
+import numpy
+
+from decimal import Decimal
+
+from valutakrambod.services import Orderbook
+
+class Ladder(object):
+    """Contiguous float arrays with the price levels of one version of an
+order book.  Each side has price, volume and cumulative volume and
+notional arrays, best price first.  Use Orderbook.ladder() to get a
+ladder cached for the current book version.
+
+    """
+    def __init__(self, book):
+        self.version = book.version
+        self.lastupdate = book.lastupdate
+        self.sides = {}
+        for side, table in ((Orderbook.SIDE_ASK, book._ask),
+                            (Orderbook.SIDE_BID, book._bid)):
+            n = len(table)
+            if book.pricedecimals is None:
+                price = numpy.fromiter(map(float, table.keys()),
+                                       dtype=numpy.float64, count=n)
+                volume = numpy.fromiter(map(float, table.values()),
+                                        dtype=numpy.float64, count=n)
+            else:
+                price = numpy.fromiter(table.keys(), dtype=numpy.float64,
+                                       count=n) * 10.0 ** -book.pricedecimals
+                volume = numpy.fromiter(table.values(), dtype=numpy.float64,
+                                        count=n) * 10.0 ** -book.volumedecimals
+            self.sides[side] = (price, volume,
+                                numpy.cumsum(volume),
+                                numpy.cumsum(price * volume))
+    def price(self, side):
+        return self.sides[side][0]
+    def volume(self, side):
+        return self.sides[side][1]
+    def cumvolume(self, side):
+        return self.sides[side][2]
+    def cumnotional(self, side):
+        return self.sides[side][3]
+    def depth(self, side):
+        """Return the total volume on the given side."""
+        cumvolume = self.cumvolume(side)
+        if 0 == len(cumvolume):
+            return 0.0
+        return float(cumvolume[-1])
+    def volumewithin(self, side, prices):
+        """Return the volume available at the given prices or better."""
+        price = self.price(side)
+        cumvolume = numpy.concatenate(([0.0], self.cumvolume(side)))
+        if Orderbook.SIDE_ASK == side:
+            idx = numpy.searchsorted(price, prices, side='right')
+        else:
+            idx = numpy.searchsorted(-price, -numpy.asarray(prices),
+                                     side='right')
+        return cumvolume[idx]
+    def vwap(self, side, volumes):
+        """Return the average price paid when filling each of the given
+volumes, NaN when the book is too shallow.
+
+        """
+        return vwaps([self], side, volumes)[0]
+    def spreadbps(self, volumes):
+        """Return the spread between the average ask and bid prices for
+each of the given volumes, in basis points of the mid price.
+
+        """
+        return spreadbps([self], volumes)[0]
+
+def vwaps(ladders, side, volumes):
+    """Return a len(ladders) x len(volumes) array with the average price
+paid when filling each volume on the given side of each ladder, and
+NaN when the book is too shallow.  All ladders are handled in one
+vectorized pass, by placing the cumulative volumes of each ladder on
+its own interval of one long sorted array.
+
+    """
+    volumes = numpy.asarray(volumes, dtype=numpy.float64)
+    if 0 == len(ladders):
+        return numpy.empty((0, len(volumes)))
+    prices = [l.price(side) for l in ladders]
+    vols = [l.volume(side) for l in ladders]
+    cumvols = [l.cumvolume(side) for l in ladders]
+    cumnotionals = [l.cumnotional(side) for l in ladders]
+    lengths = numpy.array([len(p) for p in prices])
+    starts = numpy.concatenate(([0], numpy.cumsum(lengths)))
+    price = numpy.concatenate(prices)
+    vol = numpy.concatenate(vols)
+    cumvol = numpy.concatenate(cumvols)
+    cumnotional = numpy.concatenate(cumnotionals)
+    if 0 == len(cumvol):
+        return numpy.full((len(ladders), len(volumes)), numpy.nan)
+
+    # Shift each ladder so its cumulative volumes sort after all the
+    # volumes of the ladders before it.
+    span = max(float(cumvol.max()),
+               float(volumes.max()) if len(volumes) else 0.0) + 1.0
+    segment = numpy.repeat(numpy.arange(len(ladders)), lengths)
+    shifted = cumvol + segment * span
+    queries = volumes[numpy.newaxis, :] \
+        + (numpy.arange(len(ladders)) * span)[:, numpy.newaxis]
+    idx = numpy.searchsorted(shifted, queries, side='left')
+    valid = idx < starts[1:, numpy.newaxis]
+    idx = numpy.minimum(idx, len(cumvol) - 1)
+    before = cumvol[idx] - vol[idx]
+    notional = cumnotional[idx] - vol[idx] * price[idx] \
+        + (volumes[numpy.newaxis, :] - before) * price[idx]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        res = notional / volumes[numpy.newaxis, :]
+    res[~valid] = numpy.nan
+    return res
+
+def spreadbps(ladders, volumes):
+    """Return a len(ladders) x len(volumes) array with the spread between
+the average ask and bid prices for each volume, in basis points of
+the mid price.
+
+    """
+    ask = vwaps(ladders, Orderbook.SIDE_ASK, volumes)
+    bid = vwaps(ladders, Orderbook.SIDE_BID, volumes)
+    return (ask - bid) / ((ask + bid) / 2) * 10000
+
+def depthstats(services, volumes):
+    """Calculate depth statistics for every order book of the given
+services in one vectorized pass.  Return a dict with the list of
+(servicename, pair) keys in 'keys', and arrays with one row per key
+for the ask and bid average prices ('askvwap', 'bidvwap', one column
+per volume), the spread in basis points ('spreadbps') and the total
+volume on each side ('askdepth', 'biddepth').
+
+    """
+    keys = []
+    ladders = []
+    for service in services:
+        for pair in sorted(service.orderbooks.keys()):
+            keys.append((service.servicename(), pair))
+            ladders.append(service.orderbooks[pair].ladder())
+    ask = vwaps(ladders, Orderbook.SIDE_ASK, volumes)
+    bid = vwaps(ladders, Orderbook.SIDE_BID, volumes)
+    return {
+        'keys': keys,
+        'volumes': numpy.asarray(volumes, dtype=numpy.float64),
+        'askvwap': ask,
+        'bidvwap': bid,
+        'spreadbps': (ask - bid) / ((ask + bid) / 2) * 10000,
+        'askdepth': numpy.array([l.depth(Orderbook.SIDE_ASK) for l in ladders]),
+        'biddepth': numpy.array([l.depth(Orderbook.SIDE_BID) for l in ladders]),
+    }
+
+class TestLadder(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def setUp(self):
+        self.o = Orderbook()
+        self.t = Orderbook(2, 8)
+        for o in (self.o, self.t):
+            o.update(Orderbook.SIDE_ASK, Decimal('101'), Decimal('1'))
+            o.update(Orderbook.SIDE_ASK, Decimal('102'), Decimal('2'))
+            o.update(Orderbook.SIDE_BID, Decimal('100'), Decimal('1'))
+            o.update(Orderbook.SIDE_BID, Decimal('99'), Decimal('1'))
+    def testVwap(self):
+        for o in (self.o, self.t):
+            l = o.ladder()
+            self.assertIs(l, o.ladder())
+            res = l.vwap(Orderbook.SIDE_ASK, [0.5, 1, 2, 3, 4])
+            self.assertAlmostEqual(101.0, res[0])
+            self.assertAlmostEqual(101.0, res[1])
+            self.assertAlmostEqual(101.5, res[2])
+            self.assertAlmostEqual(305.0 / 3, res[3])
+            self.assertTrue(numpy.isnan(res[4]))
+            res = l.vwap(Orderbook.SIDE_BID, [2])
+            self.assertAlmostEqual(99.5, res[0])
+            self.assertEqual(3.0, l.depth(Orderbook.SIDE_ASK))
+            within = l.volumewithin(Orderbook.SIDE_BID, [100, 99.5, 98])
+            self.assertEqual([1.0, 1.0, 2.0], list(within))
+    def testManyLadders(self):
+        empty = Orderbook()
+        res = vwaps([self.o.ladder(), empty.ladder(), self.t.ladder()],
+                    Orderbook.SIDE_ASK, [1, 3])
+        self.assertEqual((3, 2), res.shape)
+        self.assertAlmostEqual(101.0, res[0][0])
+        self.assertTrue(numpy.isnan(res[1][0]))
+        self.assertAlmostEqual(305.0 / 3, res[2][1])
+        bps = spreadbps([self.o.ladder()], [1])
+        self.assertAlmostEqual(1 / 100.5 * 10000, bps[0][0])
+    def testNewVersion(self):
+        l = self.o.ladder()
+        self.o.update(Orderbook.SIDE_ASK, Decimal('100.5'), Decimal('1'))
+        self.assertIsNot(l, self.o.ladder())
+        self.assertEqual(100.5, self.o.ladder().price(Orderbook.SIDE_ASK)[0])
+
+if __name__ == '__main__':
+    t = TestLadder()
+    unittest.main()
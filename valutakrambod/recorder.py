@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Record raw websocket frames, HTTP response bodies and rate events
+to an append-only binary log, for later replay and analysis.
+
+The log is a set of segment files, each starting with a magic header
+followed by blocks.  Each block is a flag byte telling if the block is
+zlib compressed, the length of the block as a 32 bit unsigned integer
+and the block data.  The uncompressed block data is a sequence of
+records, each with a type byte, the receive time as a 64 bit float and
+the length of the payload as a 32 bit unsigned integer, followed by the
+payload.  All integers are in network byte order.  The payload start
+with the length prefixed service name, followed by
+
+  FRAME: the websocket frame as UTF-8
+  HTTP:  the length prefixed URL and the response body
+  RATE:  JSON with the pair, ask, bid and when
+  BOOK:  JSON with the pair, the best levels and l1changed
+
+"""
+
+import os
+import queue
+import re
+import simplejson
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+from decimal import Decimal
+
+MAGIC = b'VKREC1\n'
+
+FRAME = 1
+HTTP = 2
+RATE = 3
+BOOK = 4
+
+_block = struct.Struct('!BI')
+_record = struct.Struct('!BdI')
+_short = struct.Struct('!H')
+
+def _packstr(s):
+    b = s.encode('UTF-8')
+    return _short.pack(len(b)) + b
+
+def _unpackstr(data, offset):
+    length, = _short.unpack_from(data, offset)
+    offset += _short.size
+    return data[offset:offset + length].decode('UTF-8'), offset + length
+
+class Recorder(object):
+    """Append-only recorder writing to segment files named
+prefix-NNNNNN.vkr in the given directory, starting a new segment when
+the current one grow beyond segmentsize bytes.  Records are queued by
+the caller as given and encoded, compressed and written by a background
+thread, so recording only cost a queue insert on the IOLoop.  The
+writer thread write a block when bufsize bytes are collected or
+flushinterval seconds have passed.
+
+Use attach() to record the websocket frames, public HTTP responses,
+rate updates and order book updates of a service.  Responses to
+requests with headers, ie authenticated requests, are not recorded.
+
+If writing fail, for example when the disk is full, the writer thread
+stop and the exception is kept in error.  Nothing more is queued, the
+error is reported once through logerror() of the recorded service,
+and close() raise it.
+
+    """
+    def __init__(self, directory, prefix = 'valutakrambod',
+                 segmentsize = 64 * 1024 * 1024, compress = True,
+                 bufsize = 256 * 1024, flushinterval = 1.0):
+        self.directory = directory
+        self.prefix = prefix
+        self.segmentsize = segmentsize
+        self.compress = compress
+        self.bufsize = bufsize
+        self.flushinterval = flushinterval
+        self.queue = queue.SimpleQueue()
+        self.file = None
+        self.written = 0
+        self.error = None
+        self.reported = False
+        existing = segments(directory, prefix)
+        if existing:
+            self.sequence = int(re.search(r'-(\d+)\.vkr$', existing[-1]).group(1))
+        else:
+            self.sequence = 0
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+    def attach(self, service):
+        """Record the traffic and updates of the given service."""
+        service.recorder = self
+    def detach(self, service):
+        if service.recorder is self:
+            service.recorder = None
+    def record(self, kind, servicename, payload, when = None):
+        """Queue a record with the given type and payload, either bytes or
+the values encoded by the writer thread: a string for FRAME, (url,
+body) for HTTP and a dict for RATE and BOOK records.
+
+        """
+        if self.error is not None:
+            return
+        if when is None:
+            when = time.time()
+        self.queue.put((kind, when, servicename, payload))
+    def _failed(self, service):
+        """Return True if the writer thread has stopped, and report the
+error through the service the first time.
+
+        """
+        if self.error is None:
+            return False
+        if not self.reported:
+            self.reported = True
+            service.logerror("%s recording stopped: %s" % (
+                service.servicename(), str(self.error)))
+        return True
+    def frame(self, service, msg, when = None):
+        if self._failed(service):
+            return
+        self.record(FRAME, service.servicename(), msg, when)
+    def http(self, service, url, body, when = None):
+        if self._failed(service):
+            return
+        self.record(HTTP, service.servicename(), (url, body), when)
+    def rate(self, service, pair, ask, bid, when):
+        if self._failed(service):
+            return
+        self.record(RATE, service.servicename(), {
+            'pair': pair,
+            'ask': ask,
+            'bid': bid,
+            'when': when,
+        })
+    def book(self, service, pair, top, l1changed):
+        if self._failed(service):
+            return
+        self.record(BOOK, service.servicename(), {
+            'pair': pair,
+            'top': top,
+            'l1changed': l1changed,
+        })
+    def close(self):
+        """Write the queued records and close the current segment.  Raise
+the error stopping the writer thread, if any.
+
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise self.error
+    def _writer(self):
+        try:
+            self._write()
+        except Exception as e:
+            self.error = e
+            if self.file is not None:
+                try:
+                    self.file.close()
+                except Exception:
+                    pass
+                self.file = None
+            # Free the records queued before record() noticed
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+    def _write(self):
+        buf = []
+        size = 0
+        deadline = None
+        while True:
+            try:
+                timeout = None
+                if deadline is not None:
+                    timeout = max(0, deadline - time.time())
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if item:
+                kind, when, servicename, payload = item
+                payload = _packstr(servicename) + _encode(payload)
+                buf.append(_record.pack(kind, when, len(payload)))
+                buf.append(payload)
+                size += _record.size + len(payload)
+                if deadline is None:
+                    deadline = time.time() + self.flushinterval
+                if size < self.bufsize:
+                    continue
+            if buf:
+                self._writeblock(b''.join(buf))
+                buf = []
+                size = 0
+            deadline = None
+            if item is None:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                return
+    def _writeblock(self, data):
+        if self.file is None or self.written >= self.segmentsize:
+            if self.file is not None:
+                self.file.close()
+            self.sequence += 1
+            path = os.path.join(self.directory, '%s-%06d.vkr' %
+                                (self.prefix, self.sequence))
+            self.file = open(path, 'ab')
+            self.file.write(MAGIC)
+            self.written = len(MAGIC)
+        flag = 0
+        if self.compress:
+            data = zlib.compress(data)
+            flag = 1
+        self.file.write(_block.pack(flag, len(data)) + data)
+        self.file.flush()
+        self.written += _block.size + len(data)
+
+def _encode(payload):
+    if isinstance(payload, bytes):
+        return payload
+    if isinstance(payload, str):
+        return payload.encode('UTF-8')
+    if isinstance(payload, tuple):
+        url, body = payload
+        return _packstr(url) + body
+    return simplejson.dumps(payload).encode('UTF-8')
+
+def segments(directory, prefix = 'valutakrambod'):
+    """Return the paths of the segment files in directory, oldest
+first.
+
+    """
+    pattern = re.compile(r'^%s-\d+\.vkr$' % re.escape(prefix))
+    return [os.path.join(directory, f)
+            for f in sorted(os.listdir(directory)) if pattern.match(f)]
+
+def readrecords(paths):
+    """Return a generator giving (kind, when, servicename, data) for the
+records in the given segment files, in order.  The data is a string
+for FRAME records, (url, body) for HTTP records and a dict for RATE and
+BOOK records, with prices as Decimal.  A partly written block at the
+end of a segment is ignored.
+
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    for path in paths:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a recording' % path)
+            while True:
+                header = f.read(_block.size)
+                if len(header) < _block.size:
+                    break
+                flag, length = _block.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    break
+                if flag:
+                    data = zlib.decompress(data)
+                offset = 0
+                while offset < len(data):
+                    kind, when, length = _record.unpack_from(data, offset)
+                    offset += _record.size
+                    end = offset + length
+                    servicename, start = _unpackstr(data, offset)
+                    payload = data[start:end]
+                    offset = end
+                    if FRAME == kind:
+                        value = payload.decode('UTF-8')
+                    elif HTTP == kind:
+                        url, start = _unpackstr(payload, 0)
+                        value = (url, payload[start:])
+                    else:
+                        value = simplejson.loads(payload.decode('UTF-8'),
+                                                 use_decimal=True)
+                        value['pair'] = tuple(value['pair'])
+                    yield (kind, when, servicename, value)
+
+class TestRecorder(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def testRoundtrip(self):
+        from valutakrambod.service.dummyservice import DummyService
+        s = DummyService()
+        for compress in (True, False):
+            with tempfile.TemporaryDirectory() as d:
+                r = Recorder(d, segmentsize = 100, compress = compress,
+                             bufsize = 1)
+                r.attach(s)
+                r.frame(s, '{"event":"heartbeat"}', 10.0)
+                r.http(s, 'https://example.com/', b'{}', 11.0)
+                s.updateRates(('BTC', 'EUR'), Decimal('101.5'), Decimal('100'), 12)
+                s.updateOrderbook(('BTC', 'EUR'), s.newOrderbook(
+                    ('BTC', 'EUR'), [(Decimal('101.5'), Decimal('1'))],
+                    [(Decimal('100'), Decimal('2'))]))
+                r.close()
+                r.detach(s)
+                files = segments(d)
+                self.assertTrue(1 < len(files))
+                records = list(readrecords(files))
+                self.assertEqual((FRAME, 10.0, s.servicename(),
+                                  '{"event":"heartbeat"}'), records[0])
+                self.assertEqual((HTTP, 11.0, s.servicename(),
+                                  ('https://example.com/', b'{}')), records[1])
+                kinds = [record[0] for record in records]
+                self.assertTrue(RATE in kinds)
+                self.assertTrue(BOOK in kinds)
+                rate = records[kinds.index(RATE)][3]
+                self.assertEqual(('BTC', 'EUR'), rate['pair'])
+                self.assertEqual(Decimal('101.5'), rate['ask'])
+
+                # Continue numbering after existing segments
+                r = Recorder(d)
+                r.frame(s, 'more')
+                r.close()
+                self.assertEqual(len(files) + 1, len(segments(d)))
+                self.assertEqual('more', list(readrecords(segments(d)[-1]))[0][3])
+    def testWriteError(self):
+        from valutakrambod.service.dummyservice import DummyService
+        s = DummyService()
+        errors = []
+        s.errsubscribe(lambda service, msg: errors.append(msg))
+        with tempfile.TemporaryDirectory() as d:
+            r = Recorder(d, bufsize = 1)
+            def full(data):
+                raise OSError(28, 'No space left on device')
+            r._writeblock = full
+            r.attach(s)
+            r.frame(s, 'lost', 10.0)
+            r.thread.join(5)
+            self.assertFalse(r.thread.is_alive())
+            self.assertTrue(isinstance(r.error, OSError))
+            r.frame(s, 'dropped', 11.0)
+            r.http(s, 'https://example.com/', b'{}', 12.0)
+            self.assertEqual(1, len(errors))
+            self.assertTrue('No space' in errors[0])
+            self.assertTrue(r.queue.empty())
+            with self.assertRaises(OSError):
+                r.close()
+    def testPrivate(self):
+        from valutakrambod.service.dummyservice import DummyService
+        import tornado.ioloop
+        class Response(object):
+            body = b'{"balance": 1}'
+        class Client(object):
+            async def fetch(self, req):
+                return Response()
+        s = DummyService()
+        s.http_client = Client()
+        ioloop = tornado.ioloop.IOLoop.current()
+        with tempfile.TemporaryDirectory() as d:
+            r = Recorder(d)
+            r.attach(s)
+            ioloop.run_sync(lambda: s._fetch(
+                'GET', 'https://example.com/private',
+                headers={'Authorization': 'Bearer secret'}))
+            ioloop.run_sync(lambda: s._fetch('GET', 'https://example.com/public'))
+            ioloop.run_sync(lambda: s._fetch(
+                'GET', 'https://example.com/quotes?pairs=EURUSD,USDNOK&api_key=secret'))
+            r.close()
+            records = list(readrecords(segments(d)))
+        self.assertEqual([(HTTP, s.servicename(),
+                           ('https://example.com/public', b'{"balance": 1}')),
+                          (HTTP, s.servicename(),
+                           ('https://example.com/quotes?pairs=EURUSD,USDNOK',
+                            b'{"balance": 1}'))],
+                         [(kind, name, value)
+                          for kind, when, name, value in records])
+
+if __name__ == '__main__':
+    t = TestRecorder()
+    unittest.main()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Replay traffic recorded by valutakrambod.recorder through the
+parsers of the services, without any network connection, to benchmark
+the parsers and order books and to reproduce problems offline.
+
+"""
+
+import collections
+import tempfile
+import time
+import unittest
+
+import tornado.gen
+import tornado.ioloop
+
+from tornado import httpclient
+
+from valutakrambod.recorder import FRAME, HTTP, readrecords, segments
+
+class ReplayResponse(object):
+    """The part of a tornado HTTP response used by the services."""
+    def __init__(self, request, body):
+        self.request = request
+        self.effective_url = request.url
+        self.code = 200
+        self.body = body
+
+class ReplayHTTPClient(object):
+    """Stand in for the AsyncHTTPClient of a service, answering each
+request with the next queued body instead of using the network.
+
+    """
+    def __init__(self):
+        self.bodies = collections.deque()
+    def add(self, body):
+        self.bodies.append(body)
+    async def fetch(self, request):
+        if isinstance(request, str):
+            request = httpclient.HTTPRequest(request)
+        if not self.bodies:
+            raise httpclient.HTTPClientError(599, 'no recorded response for %s'
+                                             % request.url)
+        return ReplayResponse(request, self.bodies.popleft())
+    def close(self):
+        pass
+
+class Replayer(object):
+    """Feed recorded websocket frames and HTTP response bodies to the
+given services.  The frames are passed to the _on_message() method of
+the websocket client of the service, and HTTP bodies are returned by a
+ReplayHTTPClient installed as the http_client of the service, while
+the service is asked to process the URL using replayhttp().  Messages
+sent by the websocket clients are collected in the sent list.  The
+services should be fresh instances used for replay only.
+
+Records are replayed as fast as possible if speed is None, or with the
+recorded spacing divided by speed, so 1 replay in real time and 10 run
+ten times faster.  Records for unknown services, HTTP records the
+service can not replay and rate and book records are skipped, as the
+rates and books are rebuilt by the parsers.
+
+    """
+    def __init__(self, services, speed = None):
+        self.services = {}
+        self.clients = {}
+        self.speed = speed
+        self.sent = []
+        self.errors = 0
+        for service in services:
+            self.add(service)
+    def add(self, service):
+        self.services[service.servicename()] = service
+        service.http_client = ReplayHTTPClient()
+        service.errsubscribe(self._error)
+    def _error(self, service, msg):
+        self.errors += 1
+    def websocket(self, service):
+        """Return the websocket client of the service used for replay,
+creating it on first use.
+
+        """
+        servicename = service.servicename()
+        if servicename not in self.clients:
+            c = service.websocket()
+            if c is not None:
+                c.send = self.sent.append
+            self.clients[servicename] = c
+        return self.clients[servicename]
+    async def run(self, records):
+        """Replay the given (kind, when, servicename, data) records, as
+returned by valutakrambod.recorder.readrecords(), and return a dict
+with the number of records replayed, frames, http, skipped and errors,
+and the seconds used.
+
+        """
+        stats = {
+            'records': 0,
+            'frames': 0,
+            'http': 0,
+            'skipped': 0,
+        }
+        self.errors = 0
+        start = time.time()
+        first = None
+        for kind, when, servicename, value in records:
+            stats['records'] += 1
+            if self.speed is not None:
+                if first is None:
+                    first = when
+                delay = start + (when - first) / self.speed - time.time()
+                if 0 < delay:
+                    await tornado.gen.sleep(delay)
+            service = self.services.get(servicename)
+            if service is None:
+                stats['skipped'] += 1
+                continue
+            if FRAME == kind:
+                c = self.websocket(service)
+                if c is None:
+                    stats['skipped'] += 1
+                    continue
+                c._read_message(value)
+                stats['frames'] += 1
+            elif HTTP == kind:
+                url, body = value
+                service.http_client.add(body)
+                try:
+                    await service.replayhttp(url)
+                    stats['http'] += 1
+                except NotImplementedError:
+                    stats['skipped'] += 1
+                except Exception as e:
+                    service.logerror("unable to replay %s: %s" % (url, str(e)))
+                # Drop the body if the service did not fetch it
+                service.http_client.bodies.clear()
+            else:
+                stats['skipped'] += 1
+        stats['errors'] = self.errors
+        stats['seconds'] = time.time() - start
+        return stats
+    def replay(self, directory, prefix = 'valutakrambod'):
+        """Replay the segments in the given directory, running the IOLoop
+until done, and return the statistics from run().
+
+        """
+        records = readrecords(segments(directory, prefix))
+        return tornado.ioloop.IOLoop.current().run_sync(
+            lambda: self.run(records))
+
+class TestReplayer(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def testReplay(self):
+        from decimal import Decimal
+        from valutakrambod.recorder import Recorder
+        from valutakrambod.service.kraken import Kraken
+        source = Kraken(['BTC', 'EUR'])
+        pair = ('BTC', 'EUR')
+        with tempfile.TemporaryDirectory() as d:
+            r = Recorder(d)
+            r.http(source, 'https://api.kraken.com/0/public/Depth?pair=XXBTZUSD',
+                   b'{"error":[],"result":{"XXBTZUSD":{"asks":[["6400.1","1.5",1534614248]],"bids":[["6399.9","2.0",1534614249]]}}}', 1.0)
+            r.http(source, 'https://api.kraken.com/0/public/Ticker?pair=XXBTZUSD',
+                   b'{}', 1.5)
+            r.frame(source, '{"channelID":42,"event":"subscriptionStatus","pair":"XBT/EUR","status":"subscribed","subscription":{"depth":10,"name":"book"}}', 2.0)
+            r.frame(source, '[42,{"as":[["5541.30000","2.50700000","1534614248.123678"],["5541.80000","0.33000000","1534614098.345543"]],"bs":[["5541.20000","1.52900000","1534614248.765567"],["5539.90000","0.30000000","1534614241.769870"]]},"book-10","XBT/EUR"]', 2.1)
+            r.frame(source, '[42,{"a":[["5541.30000","0.00000000","1534614335.345903"]]},{"b":[["5541.00000","1.00000000","1534614335.345903"]]},"book-10","XBT/EUR"]', 2.2)
+            r.frame(source, 'not json', 2.3)
+            r.close()
+
+            for speed in (None, 20):
+                s = Kraken(['BTC', 'EUR'])
+                stats = Replayer([s], speed = speed).replay(d)
+                self.assertEqual(6, stats['records'])
+                self.assertEqual(4, stats['frames'])
+                self.assertEqual(1, stats['http'])
+                self.assertEqual(1, stats['skipped'])
+                self.assertEqual(1, stats['errors'])
+                self.assertEqual(Decimal('6400.1'), s.rates[('BTC', 'USD')]['ask'])
+                self.assertEqual(Decimal('5541.8'), s.rates[pair]['ask'])
+                self.assertEqual(3, len(s.orderbooks[pair].bid))
+                if speed is not None:
+                    self.assertTrue(1.3 / speed <= stats['seconds'])
+
+if __name__ == '__main__':
+    t = TestReplayer()
+    unittest.main()
@@ -35,6 +35,12 @@ the websocket API.
         'BTC' : 'XBT',
         }
     baseurl = "https://www.bitstamp.net/api/"
+    # From https://www.bitstamp.net/api/v2/trading-pairs-info/
+    marketdecimals = {
+        ('BTC', 'USD') : (2, 8),
+        ('BTC', 'EUR') : (2, 8),
+        ('EUR', 'USD') : (5, 8),
+    }
     def servicename(self):
         return "Bitstamp"
 
@@ -137,18 +143,15 @@ the websocket API.
             m = simplejson.loads(msg, use_decimal=True)
             #print(m)
             if 'data' == m['event']:
-                o = Orderbook()
+                pair = self._channelmap[m['channel']]
                 d = m['data']
-                for side in ('asks', 'bids'):
-                    oside = {
-                        'asks' : o.SIDE_ASK,
-                        'bids' : o.SIDE_BID,
-                    }[side]
-                    for e in d[side]:
-                        # Note, some times volume is zero.  No idea what that mean.
-                        o.update(oside, Decimal(e[0]), Decimal(e[1]))
-                o.setupdated(int(d['timestamp']))
-                self.service.updateOrderbook(self._channelmap[m['channel']], o)
+                # Note, some times volume is zero.  No idea what that mean.
+                o = self.service.newOrderbook(
+                    pair,
+                    [(Decimal(e[0]), Decimal(e[1])) for e in d['asks']],
+                    [(Decimal(e[0]), Decimal(e[1])) for e in d['bids']],
+                    int(d['timestamp']))
+                self.service.updateOrderbook(pair, o)
     def websocket(self):
         return self.WSClient(self)
     class BitstampTrading(Trading):
@@ -16,6 +16,7 @@ from decimal import Decimal
 from os.path import expanduser
 
 from valutakrambod.services import Orderbook
+from valutakrambod.services import fromticks
 from valutakrambod.services import Service
 from valutakrambod.services import Trading
 from valutakrambod.websocket import WebSocketClient
@@ -26,6 +27,11 @@ Query the Bl3p API.  Documentation is available from
 https://bl3p.eu/api .
 """
     baseurl = "https://api.bl3p.eu/1/"
+    # The API provide price_int in 1e-5 and amount_int in 1e-8 units
+    marketdecimals = {
+        ('LTC', 'EUR') : (5, 8),
+        ('BTC', 'EUR') : (5, 8),
+    }
     async def _signedpost(self, url, data):
         path = url.replace(self.baseurl, '')
         datastr = urllib.parse.urlencode(data)
@@ -95,20 +101,25 @@ https://bl3p.eu/api .
         def _on_message(self, msg):
             m = simplejson.loads(msg, use_decimal=True)
             #print(m)
-            o = Orderbook()
-            for side in ('asks', 'bids'):
-                oside = {
-                    'asks' : o.SIDE_ASK,
-                    'bids' : o.SIDE_BID,
-                }[side]
-                for e in m[side]:
-                    o.update(oside, Decimal(e['price_int']) / 100000,
-                             Decimal(e['amount_int']) / 100000000 )
+            pair = (m['marketplace'][:3], m['marketplace'][3:])
+            # Prices are in 1e-5 EUR and amounts in 1e-8 BTC, as
+            # listed in marketdecimals.  Use them as they are for
+            # books stored as integer ticks of the same size.
+            scale = self.service.marketdecimals.get(pair, (5, 8))
+            asks = [(int(e['price_int']), int(e['amount_int'])) for e in m['asks']]
+            bids = [(int(e['price_int']), int(e['amount_int'])) for e in m['bids']]
+            ticks = scale == self.service.tickdecimals.get(pair)
+            if not ticks:
+                pricedecimals, volumedecimals = scale
+                asks = [(fromticks(p, pricedecimals), fromticks(v, volumedecimals))
+                        for p, v in asks]
+                bids = [(fromticks(p, pricedecimals), fromticks(v, volumedecimals))
+                        for p, v in bids]
+            o = self.service.newOrderbook(pair, asks, bids, ticks = ticks)
             # FIXME setting our own timestamp, as there is no
             # timestamp from the source.  Asked bl3p to set one in
             # email sent 2018-06-27.
             #o.setupdated(time.time())
-            pair = (m['marketplace'][:3], m['marketplace'][3:])
             self.service.updateOrderbook(pair, o)
         def _on_connection_close(self):
             pass
@@ -342,6 +353,24 @@ Run simple self test.
         self.updates = 0
         self.runCheck(self.checkWebsocket, timeout=10)
         self.assertTrue(0 < self.updates)
+    def testWebsocketBook(self):
+        """Check the integer prices and amounts of the book, stored as
+Decimal and as integer ticks, without any network connection.
+
+        """
+        c = self.s.websocket()
+        msg = '{"marketplace":"%s","asks":[{"price_int":554130000,"amount_int":250700000}],"bids":[{"price_int":554120000,"amount_int":152900000}]}'
+        for marketplace, tickbooks in (('BTCEUR', False), ('BTCEUR', True),
+                                       ('ETHEUR', True)):
+            self.s.usetickbooks(tickbooks)
+            c._on_message(msg % marketplace)
+            o = self.s.orderbooks[(marketplace[:3], marketplace[3:])]
+            if tickbooks and 'BTCEUR' == marketplace:
+                self.assertEqual(5, o.pricedecimals)
+            else:
+                self.assertEqual(None, o.pricedecimals)
+            self.assertEqual((Decimal('5541.3'), Decimal('2.507'),
+                              Decimal('5541.2'), Decimal('1.529')), o.top())
 
     async def checkTradingConnection(self):
         # Unable to test without API access credentials in the config
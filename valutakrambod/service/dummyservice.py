@@ -59,8 +59,10 @@ around a predefined price, with a predefined spread.
         self.spread = Decimal('0.01') * random_decimal()
         now = time.time()
         for pair in pairs:
-            o = Orderbook()
-            for side, direction in ((o.SIDE_ASK, 1), (o.SIDE_BID, -1)):
+            levels = {}
+            lastupdate = None
+            for side, direction in ((Orderbook.SIDE_ASK, 1), (Orderbook.SIDE_BID, -1)):
+                levels[side] = []
                 depth=10
                 for i in range(depth):
                     randombook = True
@@ -75,7 +77,13 @@ around a predefined price, with a predefined spread.
                         price = depth + i * direction
                         amount = 1
                     when = now - (now - self.lasttime) * random.random()
-                    o.update(side, Decimal(price), Decimal(amount), when)
+                    levels[side].append((Decimal(price), Decimal(amount)))
+                    if lastupdate is None or when > lastupdate:
+                        lastupdate = when
+            o = self.newOrderbook(pair,
+                                  levels[Orderbook.SIDE_ASK],
+                                  levels[Orderbook.SIDE_BID],
+                                  lastupdate)
             self.updateOrderbook(pair, o)
         self.lasttime = now
 
@@ -152,7 +160,11 @@ after decimal dot.
                 # Delay removal to make sure keys() return all the keys in the set
                 toremove = []
                 ordercount = 0
-                for orderprice in book.ask.keys():
+                # Walk a snapshot of the book, to see the same price
+                # levels while the live book is changed below.  Keep
+                # the snapshot during the loop.
+                snap = book.snapshot()
+                for orderprice in snap.ask.keys():
                     #print("ordercount %d" % ordercount)
                     ordercount = ordercount + 1
                     if price is None or orderprice < price:
@@ -182,13 +194,15 @@ after decimal dot.
                             # Only use the money you got
                             if moneyleft >= cost:
                                 moneyleft = moneyleft - cost
-                                book.ask[orderprice] = book.ask[orderprice] - volumeleft
+                                book.update(book.SIDE_ASK, orderprice,
+                                            book.ask[orderprice] - volumeleft)
                                 volumeleft = 0
                             else:
                                 self.log("Ran out of money, buy less")
                                 buyvolume = moneyleft / orderprice
                                 moneyleft = 0
-                                book.ask[orderprice] = book.ask[orderprice] - buyvolume
+                                book.update(book.SIDE_ASK, orderprice,
+                                            book.ask[orderprice] - buyvolume)
                                 volumeleft = volumeleft - buyvolume
                                 break
                     else:
@@ -222,7 +236,11 @@ after decimal dot.
                 # Delay removal to make sure keys() return all the keys in the set
                 toremove = []
                 ordercount = 0
-                for orderprice in book.bid.keys():
+                # Walk a snapshot of the book, to see the same price
+                # levels while the live book is changed below.  Keep
+                # the snapshot during the loop.
+                snap = book.snapshot()
+                for orderprice in snap.bid.keys():
                     #print("ordercount %d" % ordercount)
                     ordercount = ordercount + 1
                     if price is None or orderprice >= price:
@@ -236,7 +254,7 @@ after decimal dot.
                                                    book.bid[orderprice])
                             totalearn = totalearn + earn
                             volumeleft = volumeleft - book.bid[orderprice]
-                            book.bid[orderprice] = 0
+                            book.update(book.SIDE_BID, orderprice, 0)
                             toremove.append(orderprice)
                             #book.remove(book.SIDE_BID, orderprice)
                             self.log("earn %s %s, volume left in order %s, want %s" % (
@@ -253,7 +271,8 @@ after decimal dot.
 
                             earn =  volumeleft * orderprice
                             totalearn = totalearn + earn
-                            book.bid[orderprice] = book.bid[orderprice] - volumeleft
+                            book.update(book.SIDE_BID, orderprice,
+                                        book.bid[orderprice] - volumeleft)
                             volumeleft = Decimal(0)
                             self.log("earn %s, left in order %s" % (totalearn, book.bid[orderprice]))
                             #toremove.append(orderprice)
@@ -364,6 +383,45 @@ Run simple self test.
         self.runCheck(self.checkUpdates, timeout=10)
         self.assertTrue(0 < self.updates)
 
+    def testDepthNotifications(self):
+        pair = ('BTC', 'EUR')
+        rates = []
+        depth = []
+        self.s.subscribe(lambda s, p, c: rates.append((p, c)))
+        self.s.depthsubscribe(lambda s, p, l1changed: depth.append(l1changed))
+        book = self.s.orderbooks[pair]
+        quote = self.s.rates[pair]
+        stored = quote.stored
+        worst = book.ask.peekitem(-1)[0]
+        book.apply_delta(book.SIDE_ASK, [(worst, Decimal(3))])
+        self.s.updateOrderbook(pair, book)
+        self.assertEqual([False], depth)
+        # The rates are refreshed, not replaced
+        self.assertEqual([(pair, False)], rates)
+        self.assertIs(quote, self.s.rates[pair])
+        self.assertTrue(stored <= quote.stored)
+        best = book.ask.peekitem(0)[0]
+        book.apply_delta(book.SIDE_ASK, [(best, Decimal(3))])
+        self.s.updateOrderbook(pair, book)
+        self.assertEqual([False, True], depth)
+        # Only the volume moved, so the rates are the same
+        self.assertEqual([(pair, False), (pair, False)], rates)
+        book.apply_delta(book.SIDE_ASK, [(best, Decimal(0))])
+        self.s.updateOrderbook(pair, book)
+        self.assertEqual((pair, True), rates[-1])
+        # Rates from a ticker call are replaced by the book rates on
+        # the next book update, even if the top of the book is the same
+        askprice, askvolume, bidprice, bidvolume = book.top()
+        self.s.updateRates(pair, askprice + 4, bidprice - 5,
+                           self.s.rates[pair].when + 1)
+        self.assertEqual(askprice + 4, self.s.rates[pair].ask)
+        book.apply_delta(book.SIDE_ASK, [(worst, Decimal(4))],
+                         self.s.rates[pair].when + 1)
+        self.s.updateOrderbook(pair, book)
+        self.assertEqual(askprice, self.s.rates[pair].ask)
+        self.assertEqual(bidprice, self.s.rates[pair].bid)
+        self.assertEqual((pair, True), rates[-1])
+
     async def checkTradingConnection(self):
         # Unable to test without API access credentials in the config
         if self.s.confget('apikey', fallback=None) is None:
@@ -2,10 +2,14 @@
 # Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
 # This file is covered by the GPLv2 or later, read COPYING for details.
 
+import datetime
 import dateutil
+import time
 import tornado.ioloop
 import unittest
 
+from pytz import timezone
+
 from valutakrambod.services import Service
 
 class Exchangerates(Service):
@@ -28,6 +32,13 @@ https://www.ecb.europa.eu/stats/policy_and_exchange_rates/euro_reference_exchang
     def datestr2epoch(self, datestr):
         when = dateutil.parser.parse(datestr)
         return when.timestamp()
+    def dailyepoch(self, datestr):
+        """Return the time of the daily rates of the given date, published
+16:00 Central European time, ie CEST in the summer.
+
+        """
+        when = datetime.datetime.strptime(datestr, '%Y-%m-%d')
+        return timezone('CET').localize(when.replace(hour=16)).timestamp()
     async def fetchRates(self, pairs = None):
         if pairs is None:
             pairs = self.ratepairs()
@@ -48,6 +59,23 @@ https://www.ecb.europa.eu/stats/policy_and_exchange_rates/euro_reference_exchang
             res[p] = self.rates[p]
         return res
 
+    async def fetchHistory(self, pair, start, end):
+        if pair not in self.ratepairs():
+            raise NotImplementedError()
+        url = "%shistory?start_at=%s&end_at=%s&base=%s&symbols=%s" % (
+            self.baseurl,
+            time.strftime('%Y-%m-%d', time.gmtime(start)),
+            time.strftime('%Y-%m-%d', time.gmtime(end)),
+            pair[0], pair[1])
+        j, r = await self._jsonget(url)
+        res = []
+        for datestr, rates in j['rates'].items():
+            when = self.dailyepoch(datestr)
+            if start <= when < end and pair[1] in rates:
+                res.append((when, rates[pair[1]], rates[pair[1]]))
+        res.sort()
+        return res
+
     def websocket(self):
         """Exchange rates do not provide websocket API 2018-06-27."""
         return None
@@ -71,6 +99,10 @@ class TestExchangerates(unittest.TestCase):
         self.ioloop.stop()
     def testCurrentRates(self):
         self.runCheck(self.checkCurrentRates)
+    def testDailyEpoch(self):
+        # 15:00 UTC in the winter and 14:00 UTC in the summer
+        self.assertEqual(1579100400, self.s.dailyepoch('2020-01-15'))
+        self.assertEqual(1594821600, self.s.dailyepoch('2020-07-15'))
 
 if __name__ == '__main__':
     t = TestExchangerates()
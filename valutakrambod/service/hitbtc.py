@@ -14,6 +14,7 @@ from os.path import expanduser
 from decimal import Decimal
 
 from valutakrambod.services import Orderbook
+from valutakrambod.services import PrecisionError
 from valutakrambod.services import Service
 from valutakrambod.websocket import WebSocketClient
 
@@ -60,21 +61,36 @@ Query the Hitbtc API.
         def __init__(self, service):
             super().__init__(service)
             self.url = "wss://api.hitbtc.com/api/2/ws"
+            # Pairs waiting for a fresh book after a failed update
+            self.resyncing = set()
         def connect(self, url = None):
             if url is None:
                 url = self.url
             super().connect(url)
         def _on_connection_success(self):
             #print("_on_connection_success()")
+            self.resyncing.clear()
             for p in self.service.ratepairs():
-                self.send({
-                    "method": "subscribeOrderbook", # subscribeTicker
-                    "params": {
-                        "symbol": "%s%s" % (p[0], p[1])
-                    },
-                    "id": 123
-                })
-            pass
+                self._subscribebook(p)
+        def _subscribebook(self, pair):
+            self.send({
+                "method": "subscribeOrderbook", # subscribeTicker
+                "params": {
+                    "symbol": "%s%s" % (pair[0], pair[1])
+                },
+                "id": 123
+            })
+        def resubscribe(self, pair):
+            """Subscribe again to the book of the pair, to get a fresh book
+snapshot.  The rates of the pair are flagged as stale, and updates are
+ignored until the snapshot arrive.
+
+            """
+            self.service.stale.add(pair)
+            if pair in self.resyncing:
+                return
+            self.resyncing.add(pair)
+            self._subscribebook(pair)
         def datestr2epoch(self, datestr):
             when = dateutil.parser.parse(datestr)
             return when.timestamp()
@@ -94,34 +110,51 @@ Query the Hitbtc API.
                     )
                 if "snapshotOrderbook" == m['method']:
                     pair = self.symbols2pair(m['params']['symbol'])
-                    o = Orderbook()
-                    for side in ('ask', 'bid'):
-                        oside = {
-                            'ask' : o.SIDE_ASK,
-                            'bid' : o.SIDE_BID,
-                        }[side]
-                        #print(m['params'][side])
-                        for e in m['params'][side]:
-                            o.update(oside, Decimal(e['price']), Decimal(e['size']))
+                    #print(m['params'])
                     # FIXME setting our own timestamp, as there is no
                     # timestamp from the source.  Ask bl3p to set one?
-                    o.setupdated(time.time())
+                    o = self.service.newOrderbook(
+                        pair,
+                        [(Decimal(e['price']), Decimal(e['size']))
+                         for e in m['params']['ask']],
+                        [(Decimal(e['price']), Decimal(e['size']))
+                         for e in m['params']['bid']],
+                        time.time())
+                    self.resyncing.discard(pair)
                     self.service.updateOrderbook(pair, o)
                 if "updateOrderbook" == m['method']:
                     pair = self.symbols2pair(m['params']['symbol'])
-                    o = self.service.orderbooks[pair].copy()
+                    if pair in self.resyncing:
+                        return
+                    o = self.service.orderbooks.get(pair)
+                    if o is None:
+                        self.resubscribe(pair)
+                        return
+                    deltas = []
                     for side in ('ask', 'bid'):
                         oside = {
                             'ask' : o.SIDE_ASK,
                             'bid' : o.SIDE_BID,
                         }[side]
+                        levels = []
                         for e in m['params'][side]:
-                            price = Decimal(e['price'])
-                            if '0.00' == e['size']:
-                                o.remove(oside, price)
-                            else:
-                                volume = Decimal(e['size'])
-                                o.update(oside, price, volume)
+                            # A zero size remove the price level
+                            levels.append((Decimal(e['price']),
+                                           Decimal(e['size'])))
+                        deltas.append((oside, levels))
+                    try:
+                        o.apply_deltas(deltas)
+                    except PrecisionError as e:
+                        self.service.droptickdecimals(pair, e)
+                        self.resubscribe(pair)
+                        return
+                    except ValueError as e:
+                        # A missed update left the book half changed,
+                        # fetch a fresh one.
+                        self.service.logerror("%s %s book out of sync: %s" % (
+                            self.service.servicename(), pair, str(e)))
+                        self.resubscribe(pair)
+                        return
                     # FIXME setting our own timestamp, as there is no
                     # timestamp from the source.  Ask bl3p to set one?
                     o.setupdated(time.time())
@@ -180,6 +213,35 @@ Run simple self test.
         self.updates = 0
         self.runCheck(self.checkWebsocket, timeout=10)
         self.assertTrue(0 < self.updates)
+    def testWebsocketResync(self):
+        """Check resubscription after an update out of sync with the book,
+without any network connection.
+
+        """
+        c = self.s.websocket()
+        sent = []
+        c.send = sent.append
+        errors = []
+        self.s.logerror = errors.append
+        pair = ('BTC', 'USD')
+        c._on_message('{"jsonrpc":"2.0","method":"snapshotOrderbook","params":{"ask":[{"price":"6500.1","size":"1.5"},{"price":"6501.0","size":"0.5"}],"bid":[{"price":"6499.9","size":"2"}],"symbol":"BTCUSD","sequence":1}}')
+        c._on_message('{"jsonrpc":"2.0","method":"updateOrderbook","params":{"ask":[{"price":"6500.1","size":"0"}],"bid":[],"symbol":"BTCUSD","sequence":2}}')
+        self.assertEqual(Decimal('6501.0'), self.s.rates[pair]['ask'])
+        self.assertEqual([], sent)
+        # Removing an unknown level
+        c._on_message('{"jsonrpc":"2.0","method":"updateOrderbook","params":{"ask":[{"price":"6502.0","size":"1"},{"price":"6400.0","size":"0"}],"bid":[],"symbol":"BTCUSD","sequence":3}}')
+        self.assertEqual(1, len(errors))
+        self.assertTrue(pair in self.s.stale)
+        self.assertEqual('subscribeOrderbook', sent[0]['method'])
+        # Updates are ignored until a new snapshot arrive
+        c._on_message('{"jsonrpc":"2.0","method":"updateOrderbook","params":{"ask":[{"price":"6300.0","size":"0"}],"bid":[],"symbol":"BTCUSD","sequence":4}}')
+        self.assertEqual(1, len(sent))
+        self.assertEqual(1, len(errors))
+        c._on_message('{"jsonrpc":"2.0","method":"snapshotOrderbook","params":{"ask":[{"price":"6505.0","size":"1"}],"bid":[{"price":"6499.9","size":"2"}],"symbol":"BTCUSD","sequence":5}}')
+        self.assertFalse(pair in self.s.stale)
+        self.assertEqual(Decimal('6505.0'), self.s.rates[pair]['ask'])
+        c._on_message('{"jsonrpc":"2.0","method":"updateOrderbook","params":{"ask":[{"price":"6505.0","size":"0"},{"price":"6506.0","size":"1"}],"bid":[],"symbol":"BTCUSD","sequence":6}}')
+        self.assertEqual(Decimal('6506.0'), self.s.rates[pair]['ask'])
 
 if __name__ == '__main__':
     t = TestHitbtc()
@@ -10,6 +10,7 @@ import simplejson
 import time
 import unittest
 import urllib
+import zlib
 import urllib.parse
 import tornado.ioloop
 
@@ -17,6 +18,7 @@ from decimal import Decimal, ROUND_DOWN, ROUND_UP
 from os.path import expanduser
 
 from valutakrambod.services import Orderbook
+from valutakrambod.services import PrecisionError
 from valutakrambod.services import Service
 from valutakrambod.services import Trading
 from valutakrambod.websocket import WebSocketClient
@@ -38,6 +40,13 @@ https://www.kraken.com/features/websocket-api .
         }
     baseurl = "https://api.kraken.com/0/public/"
     privatebaseurl = "https://api.kraken.com/0/private/"
+    # Prices are given with 5 decimals and volumes with 8 decimals
+    marketdecimals = {
+        ('BTC', 'USD') : (5, 8),
+        ('BTC', 'EUR') : (5, 8),
+    }
+    # Most price levels per side the Depth call return
+    maxrestdepth = 500
     def servicename(self):
         return "Kraken"
 
@@ -119,23 +128,60 @@ https://www.kraken.com/features/websocket-api .
         res = {}
         for pair in pairs:
             pairstr = self._makepair(pair[0], pair[1])
-            j = await self._query_public('Depth', {'pair' : pairstr})
+            args = {'pair' : pairstr}
+            maxdepth = self.getmaxdepth(pair)
+            if maxdepth is not None:
+                args['count'] = min(maxdepth, self.maxrestdepth)
+            j = await self._query_public('Depth', args)
             #print(j)
-            o = Orderbook()
-            for side in ('asks', 'bids'):
-                oside = {
-                    'asks' : o.SIDE_ASK,
-                    'bids' : o.SIDE_BID,
-                }[side]
-                # For some strange reason, some orders have timestamps
-                # in the future.  This is reported to Kraken Support
-                # as request 1796106.
-                for order in j['result'][pairstr][side]:
-                    #print("Updating %s", (side, order), now - order[2])
-                    o.update(oside, Decimal(order[0]), Decimal(order[1]), order[2])
-                #print(o)
+            r = j['result'][pairstr]
+            # For some strange reason, some orders have timestamps
+            # in the future.  This is reported to Kraken Support as
+            # request 1796106.
+            o = self.newOrderbook(
+                pair,
+                [(order[0], order[1]) for order in r['asks']],
+                [(order[0], order[1]) for order in r['bids']],
+                max((order[2] for order in r['asks'] + r['bids']), default=None))
+            #print(o)
             self.updateOrderbook(pair, o)
 
+    # Daily candles, and the OHLC call return at most 720 of them
+    historyinterval = 1440
+    historychunk = 720 * historyinterval * 60
+    def historyoldest(self, pair):
+        return time.time() - 720 * self.historyinterval * 60
+    async def fetchHistory(self, pair, start, end):
+        """Return the closing prices of the daily candles as ask and bid.
+Kraken only provide the last 720 candles, no matter how old start is.
+
+        """
+        pairstr = self._makepair(pair[0], pair[1])
+        j = await self._query_public('OHLC', {
+            'pair' : pairstr,
+            'interval' : self.historyinterval,
+            'since' : int(start) - 1,
+        })
+        if 0 != len(j['error']):
+            raise Exception(j['error'])
+        res = []
+        for row in j['result'][pairstr]:
+            when = row[0]
+            if start <= when < end:
+                close = Decimal(row[4])
+                res.append((when, close, close))
+        return res
+    async def replayhttp(self, url):
+        u = urllib.parse.urlparse(url)
+        if not u.path.endswith('/Depth'):
+            raise NotImplementedError()
+        pairstr = urllib.parse.parse_qs(u.query)['pair'][0]
+        for pair in self.ratepairs():
+            if pairstr == self._makepair(pair[0], pair[1]):
+                await self._fetchOrderbooks([pair])
+                return
+        raise NotImplementedError()
+
     async def _fetchTicker(self, pairs = None):
         if pairs is None:
             pairs = self.ratepairs()
@@ -328,29 +374,110 @@ This is example output from the API call:
         return self.WSClient(self)
 
     class WSClient(WebSocketClient):
+        # Book depths available in subscriptions
+        depths = (10, 25, 100, 500, 1000)
+        # Seconds to wait for a fresh book after resubscribing
+        resynctimeout = 30
         def __init__(self, service):
             super().__init__(service)
             self.url = "wss://ws.kraken.com"
             self.channelinfo = {}
+            # Pair names used by Kraken, and pairs waiting for a fresh
+            # book after a checksum mismatch.
+            self.wsnames = {}
+            self.resyncing = set()
+            self.resynctimers = {}
         def connect(self, url = None):
             if url is None:
                 url = self.url
             super().connect(url)
-        def _on_connection_success(self):
-            #print("_on_connection_success()")
-            pairs = []
-            for p in self.service.ratepairs():
-                pairs.append("%s/%s" % (p[0], p[1]))
-            data = {
-                'event': 'subscribe',
+        def subscriptiondepth(self, pair):
+            """Return the book depth to subscribe to for the pair, the
+smallest depth provided by Kraken covering the depth limit of the
+service.
+
+            """
+            maxdepth = self.service.getmaxdepth(pair)
+            if maxdepth is None:
+                return 500
+            for depth in self.depths:
+                if maxdepth <= depth:
+                    return depth
+            return self.depths[-1]
+        def _bookrequest(self, event, pair):
+            return {
+                'event': event,
                 'subscription': {
                     'name': 'book',
-                    'depth': 500, # One of 10, 25, 100, 500, 1000
+                    'depth': self.subscriptiondepth(pair),
                 },
-                'pair': pairs,
+                'pair': [self.wsnames.get(pair, "%s/%s" % (pair[0], pair[1]))],
             }
-            self.send(data)
-            pass
+        def resubscribe(self, pair):
+            """Unsubscribe and subscribe again to the book of one pair, to get
+a fresh book snapshot without reconnecting and resetting the other
+pairs.  Updates for the pair are ignored until the snapshot arrive.
+
+            """
+            if pair in self.resyncing:
+                return
+            self.resyncing.add(pair)
+            self.resynctimers[pair] = tornado.ioloop.IOLoop.current().call_later(
+                self.resynctimeout, self._resyncexpired, pair)
+            self.send(self._bookrequest('unsubscribe', pair))
+        def _resynced(self, pair):
+            self.resyncing.discard(pair)
+            timer = self.resynctimers.pop(pair, None)
+            if timer is not None:
+                tornado.ioloop.IOLoop.current().remove_timeout(timer)
+        def _resyncexpired(self, pair):
+            # The unsubscribe or subscribe acknowledgement or the fresh
+            # book never arrived, try again.
+            if pair in self.resyncing:
+                self.service.logerror("%s %s no fresh book after %d seconds, resubscribing" % (
+                    self.service.servicename(), pair, self.resynctimeout))
+                self._resynced(pair)
+                self.resubscribe(pair)
+        def checksum(self, book):
+            """Return the CRC32 checksum Kraken calculate from the ten best
+levels of each side of the book.  Each price and volume is formatted
+as sent by Kraken, with the decimal point and leading zeros removed.
+See https://docs.kraken.com/websockets/#book-checksum .
+
+            """
+            parts = []
+            for side in (book.SIDE_ASK, book.SIDE_BID):
+                for price, volume in book.toplevels(side, 10, raw=True):
+                    if book.pricedecimals is None:
+                        parts.append(format(price, 'f').replace('.', '').lstrip('0'))
+                        parts.append(format(volume, 'f').replace('.', '').lstrip('0'))
+                    else:
+                        # Integer ticks are already without decimal
+                        # point and leading zeros
+                        parts.append(str(price))
+                        parts.append(str(volume))
+            return zlib.crc32(''.join(parts).encode('ascii'))
+        def _on_connection_success(self):
+            #print("_on_connection_success()")
+            for pair in list(self.resyncing):
+                self._resynced(pair)
+            # Pairs with different depth need separate subscriptions
+            pairs = {}
+            for p in self.service.ratepairs():
+                depth = self.subscriptiondepth(p)
+                if depth not in pairs:
+                    pairs[depth] = []
+                pairs[depth].append("%s/%s" % (p[0], p[1]))
+            for depth in sorted(pairs.keys()):
+                data = {
+                    'event': 'subscribe',
+                    'subscription': {
+                        'name': 'book',
+                        'depth': depth,
+                    },
+                    'pair': pairs[depth],
+                }
+                self.send(data)
         def symbols2pair(self, symbol):
             symbolmap = {
                 'XBT': 'BTC',
@@ -369,9 +496,23 @@ This is example output from the API call:
                 # status/heartbeat
                 if 'event' in m:
                     if 'subscriptionStatus' == m['event']:
-                        channel = m['channelID']
+                        status = m.get('status', 'subscribed')
                         pair = self.symbols2pair(m['pair'])
-                        self.channelinfo[channel] = { 'pair': pair}
+                        if 'subscribed' == status:
+                            channel = m['channelID']
+                            self.channelinfo[channel] = { 'pair': pair}
+                            self.wsnames[pair] = m['pair']
+                        elif 'unsubscribed' == status and pair in self.resyncing:
+                            self.send(self._bookrequest('subscribe', pair))
+                        elif 'error' == status:
+                            self.service.logerror("%s subscription error for %s: %s" % (
+                                self.service.servicename(), m['pair'],
+                                m.get('errorMessage')))
+                            if pair in self.resyncing:
+                                # Most likely the unsubscribe failed,
+                                # subscribe to get a fresh book anyway.
+                                self._resynced(pair)
+                                self.send(self._bookrequest('subscribe', pair))
                     elif 'heartbeat' == m['event']:
                         pass
                     elif 'systemStatus' == m['event']:
@@ -379,38 +520,70 @@ This is example output from the API call:
             elif list == type(m):
                 channel = m[0]
                 pair = self.channelinfo[channel]['pair']
-                updates = list(m[1].keys())
-                #print("channel update:", updates, pair)
-                for update in updates:
-                    if update in ('as', 'bs'):
-                        o = Orderbook()
-                        for side in ('as', 'bs'):
-                            oside = {
-                                'as' : o.SIDE_ASK,
-                                'bs' : o.SIDE_BID,
-                            }[side]
-                            for e in m[1][side]:
-                                o.update(oside, Decimal(e[0]), Decimal(e[1]), float(e[2]))
-                        self.service.updateOrderbook(pair, o)
-                    elif update in ('a', 'b'):
-                        o = self.service.orderbooks[pair].copy()
-                        for side in ('a', 'b'):
-                            oside = {
-                                'a' : o.SIDE_ASK,
-                                'b' : o.SIDE_BID,
-                            }[side]
-                            if side in m[1]:
-                                for e in m[1][side]:
-                                    price = Decimal(e[0])
-                                    if '0.00000000' == e[1]:
-                                        try:
-                                            o.remove(oside, price)
-                                        except KeyError as e:
-                                            raise ValueError('asked to remove non-existing %s order %s' % (oside, price))
-                                    else:
-                                        volume = Decimal(e[1])
-                                        o.update(oside, price, volume, float(e[2]))
+                # Book updates arrive as one or two dicts after the
+                # channel ID, followed by the channel name and pair.
+                deltas = []
+                when = None
+                checksum = None
+                for d in m[1:]:
+                    if dict != type(d):
+                        continue
+                    #print("channel update:", list(d.keys()), pair)
+                    if 'c' in d:
+                        checksum = int(d['c'])
+                    if 'as' in d or 'bs' in d:
+                        self._resynced(pair)
+                        asks = d.get('as', [])
+                        bids = d.get('bs', [])
+                        o = self.service.newOrderbook(
+                            pair,
+                            [(e[0], e[1]) for e in asks],
+                            [(e[0], e[1]) for e in bids],
+                            max((float(e[2]) for e in asks + bids), default=None))
                         self.service.updateOrderbook(pair, o)
+                    for side in ('a', 'b'):
+                        if side not in d:
+                            continue
+                        oside = {
+                            'a' : Orderbook.SIDE_ASK,
+                            'b' : Orderbook.SIDE_BID,
+                        }[side]
+                        levels = []
+                        for e in d[side]:
+                            # The order book parse the strings
+                            levels.append((e[0], e[1]))
+                            t = float(e[2])
+                            if when is None or t > when:
+                                when = t
+                        deltas.append((oside, levels))
+                if deltas and pair not in self.resyncing:
+                    # Change the live book in place instead of copying
+                    # the complete book for every small change.
+                    o = self.service.orderbooks[pair]
+                    try:
+                        o.apply_deltas(deltas, when)
+                    except PrecisionError as e:
+                        # More decimals than tickdecimals allow, fetch
+                        # a fresh book stored as Decimal.
+                        self.service.droptickdecimals(pair, e)
+                        self.resubscribe(pair)
+                        return
+                    except ValueError as e:
+                        # A missed delta, fetch a fresh book
+                        self.service.logerror("%s %s book out of sync: %s" % (
+                            self.service.servicename(), pair, str(e)))
+                        self.resubscribe(pair)
+                        return
+                    # The checksum cover the ten best levels, which a
+                    # book capped below ten levels do not have.
+                    if checksum is not None and \
+                       (o.maxdepth is None or 10 <= o.maxdepth) and \
+                       checksum != self.checksum(o):
+                        self.service.logerror("%s %s book checksum mismatch, resubscribing" % (
+                            self.service.servicename(), pair))
+                        self.resubscribe(pair)
+                        return
+                    self.service.updateOrderbook(pair, o)
             return
             if False:
                 if "ticker" == m['method']:
@@ -587,6 +760,143 @@ Run simple self test.
         self.runCheck(self.checkWebsocket, timeout=10)
         self.assertTrue(0 < self.updates)
 
+    def testSubscriptionDepth(self):
+        c = self.s.websocket()
+        pair = ('BTC', 'EUR')
+        self.assertEqual(500, c.subscriptiondepth(pair))
+        self.s.setmaxdepth(20)
+        self.assertEqual(25, c.subscriptiondepth(pair))
+        self.s.setmaxdepth(5000, pair)
+        self.assertEqual(1000, c.subscriptiondepth(pair))
+        self.assertEqual(5000, self.s.newOrderbook(pair).maxdepth)
+        # The REST call accept at most 500 levels
+        calls = []
+        async def query(method, args):
+            calls.append(args)
+            return {'result': {args['pair']: {'asks': [], 'bids': []}}}
+        self.s._query_public = query
+        self.s.logerror = lambda msg: None
+        tornado.ioloop.IOLoop.current().run_sync(
+            lambda: self.s._fetchOrderbooks([pair]))
+        self.assertEqual(500, calls[0]['count'])
+
+    def testWebsocketBookDeltas(self):
+        """Feed recorded style book messages through the websocket parser,
+without any network connection.
+
+        """
+        c = self.s.websocket()
+        pair = ('BTC', 'EUR')
+        c._on_message('{"channelID":42,"event":"subscriptionStatus","pair":"XBT/EUR","status":"subscribed","subscription":{"depth":10,"name":"book"}}')
+        c._on_message('[42,{"as":[["5541.30000","2.50700000","1534614248.123678"],["5541.80000","0.33000000","1534614098.345543"]],"bs":[["5541.20000","1.52900000","1534614248.765567"],["5539.90000","0.30000000","1534614241.769870"]]},"book-10","XBT/EUR"]')
+        book = self.s.orderbooks[pair]
+        self.assertEqual(2, len(book.ask))
+        c._on_message('[42,{"a":[["5541.30000","0.00000000","1534614335.345903"]]},{"b":[["5541.00000","1.00000000","1534614335.345903"]]},"book-10","XBT/EUR"]')
+        # Deltas are applied to the same book object, not a copy
+        self.assertIs(book, self.s.orderbooks[pair])
+        self.assertEqual(Decimal('5541.8'), book.ask.peekitem(0)[0])
+        self.assertEqual(3, len(book.bid))
+        self.assertEqual(1534614335.345903, book.lastupdate)
+        self.assertEqual(Decimal('5541.8'), self.s.rates[pair]['ask'])
+        with self.assertRaises(ValueError):
+            book.apply_delta(book.SIDE_ASK, [(Decimal('1'), Decimal('0'))])
+
+    def testWebsocketChecksum(self):
+        """Check book checksums and resubscription after a mismatch, without
+any network connection.
+
+        """
+        self.s.usetickbooks()
+        self.checkWebsocketChecksum()
+        self.assertEqual(5, self.s.orderbooks[('BTC', 'EUR')].pricedecimals)
+    def testWebsocketChecksumDecimal(self):
+        """Check book checksums of books stored as Decimal."""
+        self.checkWebsocketChecksum()
+        self.assertIsNone(self.s.orderbooks[('BTC', 'EUR')].pricedecimals)
+    def checkWebsocketChecksum(self):
+        c = self.s.websocket()
+        sent = []
+        c.send = sent.append
+        pair = ('BTC', 'EUR')
+        c._on_message('{"channelID":42,"event":"subscriptionStatus","pair":"XBT/EUR","status":"subscribed","subscription":{"depth":10,"name":"book"}}')
+        c._on_message('[42,{"as":[["5541.30000","2.50700000","1534614248.123678"],["5541.80000","0.33000000","1534614098.345543"]],"bs":[["5541.20000","1.52900000","1534614248.765567"],["5539.90000","0.30000000","1534614241.769870"]]},"book-10","XBT/EUR"]')
+        book = self.s.orderbooks[pair]
+        expected = zlib.crc32(b'554180000' b'33000000'
+                              b'554120000' b'152900000'
+                              b'554100000' b'100000000'
+                              b'553990000' b'30000000')
+        c._on_message('[42,{"a":[["5541.30000","0.00000000","1534614335.345903"]]},{"b":[["5541.00000","1.00000000","1534614335.345903"]],"c":"%d"},"book-10","XBT/EUR"]' % expected)
+        self.assertEqual(expected, c.checksum(book))
+        self.assertEqual([], sent)
+        c._on_message('[42,{"b":[["5541.00000","2.00000000","1534614336.345903"]],"c":"%d"},"book-10","XBT/EUR"]' % expected)
+        self.assertEqual('unsubscribe', sent[0]['event'])
+        self.assertEqual(['XBT/EUR'], sent[0]['pair'])
+        # Updates are ignored until the new snapshot arrive
+        c._on_message('[42,{"b":[["5540.00000","1.00000000","1534614337.345903"]]},"book-10","XBT/EUR"]')
+        self.assertEqual(3, len(book.bid))
+        c._on_message('{"channelID":42,"event":"subscriptionStatus","pair":"XBT/EUR","status":"unsubscribed","subscription":{"depth":10,"name":"book"}}')
+        self.assertEqual('subscribe', sent[1]['event'])
+        c._on_message('{"channelID":43,"event":"subscriptionStatus","pair":"XBT/EUR","status":"subscribed","subscription":{"depth":10,"name":"book"}}')
+        c._on_message('[43,{"as":[["5541.30000","2.50700000","1534614348.123678"]],"bs":[["5541.20000","1.52900000","1534614348.765567"]]},"book-10","XBT/EUR"]')
+        self.assertEqual(set(), c.resyncing)
+        self.assertEqual({}, c.resynctimers)
+    def testWebsocketResyncError(self):
+        """Check that a failed unsubscribe or a missing acknowledgement do
+not leave a pair waiting for a fresh book forever.
+
+        """
+        c = self.s.websocket()
+        sent = []
+        c.send = sent.append
+        errors = []
+        self.s.logerror = errors.append
+        pair = ('BTC', 'EUR')
+        c._on_message('{"channelID":42,"event":"subscriptionStatus","pair":"XBT/EUR","status":"subscribed","subscription":{"depth":10,"name":"book"}}')
+        c.resubscribe(pair)
+        self.assertEqual('unsubscribe', sent[-1]['event'])
+        c._on_message('{"errorMessage":"Subscription Not Found","event":"subscriptionStatus","pair":"XBT/EUR","status":"error","subscription":{"depth":10,"name":"book"}}')
+        self.assertEqual('subscribe', sent[-1]['event'])
+        self.assertEqual(set(), c.resyncing)
+        self.assertEqual({}, c.resynctimers)
+        # No acknowledgement before the timeout
+        c.resubscribe(pair)
+        self.assertEqual(3, len(sent))
+        c._resyncexpired(pair)
+        self.assertEqual(4, len(sent))
+        self.assertEqual('unsubscribe', sent[-1]['event'])
+        self.assertEqual(set([pair]), c.resyncing)
+        self.assertEqual(2, len(errors))
+        c._on_message('{"channelID":42,"event":"subscriptionStatus","pair":"XBT/EUR","status":"unsubscribed","subscription":{"depth":10,"name":"book"}}')
+        c._on_message('{"channelID":43,"event":"subscriptionStatus","pair":"XBT/EUR","status":"subscribed","subscription":{"depth":10,"name":"book"}}')
+        c._on_message('[43,{"as":[["5541.30000","2.50700000","1534614348.123678"]],"bs":[["5541.20000","1.52900000","1534614348.765567"]]},"book-10","XBT/EUR"]')
+        self.assertEqual(set(), c.resyncing)
+        self.assertEqual({}, c.resynctimers)
+
+    def testWebsocketPrecision(self):
+        """Check that a delta with more decimals than the tick size give a
+precision error and a fresh Decimal book, without any network
+connection.
+
+        """
+        self.s.usetickbooks()
+        c = self.s.websocket()
+        sent = []
+        c.send = sent.append
+        errors = []
+        self.s.errsubscribe(lambda service, msg: errors.append(msg))
+        pair = ('BTC', 'EUR')
+        c._on_message('{"channelID":42,"event":"subscriptionStatus","pair":"XBT/EUR","status":"subscribed","subscription":{"depth":10,"name":"book"}}')
+        c._on_message('[42,{"as":[["5541.30000","2.50700000","1534614248.123678"]],"bs":[["5541.20000","1.52900000","1534614248.765567"]]},"book-10","XBT/EUR"]')
+        self.assertEqual(5, self.s.orderbooks[pair].pricedecimals)
+        c._on_message('[42,{"a":[["5541.300001","1.00000000","1534614335.345903"]]},"book-10","XBT/EUR"]')
+        self.assertTrue('precision' in errors[0])
+        self.assertFalse('out of sync' in ' '.join(errors))
+        self.assertEqual('unsubscribe', sent[0]['event'])
+        c._on_message('{"channelID":42,"event":"subscriptionStatus","pair":"XBT/EUR","status":"unsubscribed","subscription":{"depth":10,"name":"book"}}')
+        c._on_message('[42,{"as":[["5541.300001","2.50700000","1534614348.123678"]],"bs":[["5541.20000","1.52900000","1534614348.765567"]]},"book-10","XBT/EUR"]')
+        self.assertEqual(None, self.s.orderbooks[pair].pricedecimals)
+        self.assertEqual(Decimal('5541.300001'), self.s.rates[pair]['ask'])
+
     async def checkBalanceCaching(self):
         t = self.s.trading()
         if not t:
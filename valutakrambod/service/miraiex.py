@@ -34,20 +34,15 @@ https://developers.miraiex.com/ .
 
     async def fetchOrderbooks(self, pairs):
         for pair in pairs:
-            o = Orderbook()
             url = "%smarkets/%s%s/depth" % (self.baseurl, pair[0], pair[1])
             #print(url)
             j, r = await self._jsonget(url)
             #print(j)
-            for side in ('asks', 'bids'):
-                oside = {
-                    'asks' : o.SIDE_ASK,
-                    'bids' : o.SIDE_BID,
-                }[side]
-                for order in j[side]:
-                    #print("Updating %s for %s" % (side, pair), order)
-                    o.update(oside, Decimal(order[0]), Decimal(order[1]))
-                #print(o)
+            o = self.newOrderbook(
+                pair,
+                [(Decimal(order[0]), Decimal(order[1])) for order in j['asks']],
+                [(Decimal(order[0]), Decimal(order[1])) for order in j['bids']])
+            #print(o)
             self.updateOrderbook(pair, o)
 
     async def fetchMarkets(self, pairs):
@@ -118,18 +118,19 @@ found in https://nbx.com/developers .
 
     async def fetchOrderbooks(self, pairs):
         for pair in pairs:
-            o = Orderbook()
             url = "%s/markets/%s-%s/orders" % (self.baseurl, pair[0], pair[1])
             #print(url)
             j, r = await self._jsonget(url)
             #print(j)
+            levels = {
+                'BUY': [],
+                'SELL' : [],
+            }
             for order in j:
-                oside = {
-                    'BUY': o.SIDE_BID,
-                    'SELL' : o.SIDE_ASK,
-                }[order['side']]
-                o.update(oside, Decimal(order['price']), Decimal(order['quantity']))
+                levels[order['side']].append((Decimal(order['price']),
+                                              Decimal(order['quantity'])))
                 #print(pair, order['side'], Decimal(order['price']), Decimal(order['quantity']))
+            o = self.newOrderbook(pair, levels['SELL'], levels['BUY'])
             self.updateOrderbook(pair, o)
 
     def websocket(self):
@@ -2,13 +2,16 @@
 # Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
 # This file is covered by the GPLv2 or later, read COPYING for details.
 
+import datetime
 import dateutil
 import re
+import time
 import unittest
 import tornado.ioloop
 
 from decimal import Decimal
 from lxml import etree
+from pytz import timezone
 
 from valutakrambod.services import Service
 
@@ -30,6 +33,13 @@ daily.  See also https://www.norges-bank.no/RSS/.
     def datestr2epoch(self, datestr):
         when = dateutil.parser.parse(datestr)
         return when.timestamp()
+    def dailyepoch(self, datestr):
+        """Return the time of the daily rates of the given date, published
+16:00 Oslo time.
+
+        """
+        when = datetime.datetime.strptime(datestr, '%Y-%m-%d')
+        return timezone('Europe/Oslo').localize(when.replace(hour=16)).timestamp()
     async def fetchRates(self, pairs = None):
         if pairs is None:
             pairs = self.ratepairs()
@@ -64,6 +74,29 @@ daily.  See also https://www.norges-bank.no/RSS/.
                 raise ValueError("unexpected RSS returned")
         return res
 
+    async def fetchHistory(self, pair, start, end):
+        """Fetch the daily rates from the SDMX API of Norges Bank, see
+https://www.norges-bank.no/en/topics/Statistics/open-data/ .
+
+        """
+        if pair not in self.ratepairs():
+            raise NotImplementedError()
+        url = "https://data.norges-bank.no/api/data/EXR/B.%s.%s.SP?format=sdmx-json&startPeriod=%s&endPeriod=%s&locale=en" % (
+            pair[0], pair[1],
+            time.strftime('%Y-%m-%d', time.gmtime(start)),
+            time.strftime('%Y-%m-%d', time.gmtime(end)))
+        j, r = await self._jsonget(url)
+        dates = j['data']['structure']['dimensions']['observation'][0]['values']
+        res = []
+        for series in j['data']['dataSets'][0]['series'].values():
+            for index, value in series['observations'].items():
+                when = self.dailyepoch(dates[int(index)]['id'])
+                if start <= when < end:
+                    rate = Decimal(value[0])
+                    res.append((when, rate, rate))
+        res.sort()
+        return res
+
     def websocket(self):
         """Exchange rates do not provide websocket API 2018-06-27."""
         return None
@@ -95,6 +128,10 @@ Run simple self test.
         self.ioloop.stop()
     def testCurrentRates(self):
         self.runCheck(self.checkCurrentRates)
+    def testDailyEpoch(self):
+        # 15:00 UTC in the winter and 14:00 UTC in the summer
+        self.assertEqual(1579100400, self.s.dailyepoch('2020-01-15'))
+        self.assertEqual(1594821600, self.s.dailyepoch('2020-07-15'))
 
 if __name__ == '__main__':
     t = TestNorgesbank()
@@ -90,21 +90,21 @@ https://github.com/Paymium/api-documentation/blob/master/WEBSOCKETS.md.
             #print(url)
             j, r = await self._jsonget(url)
             #print(j)
-            o = Orderbook()
+            levels = {}
+            lastupdate = None
             for side in ('asks', 'bids'):
-                oside = {
-                    'asks' : o.SIDE_ASK,
-                    'bids' : o.SIDE_BID,
-                }[side]
+                levels[side] = []
                 for order in j[side]:
                     if t != order['currency']: # sanity check
                         raise Exception("unexpected currency returned by depth call")
                     #print("Updating %s", (side, order), now - order['timestamp'])
-                    o.update(oside,
-                             Decimal(order['price']),
-                             Decimal(order['amount']),
-                             order['timestamp'])
-                #print(o)
+                    levels[side].append((Decimal(order['price']),
+                                         Decimal(order['amount'])))
+                    if order['timestamp'] and \
+                       (lastupdate is None or order['timestamp'] > lastupdate):
+                        lastupdate = order['timestamp']
+            o = self.newOrderbook(pair, levels['asks'], levels['bids'], lastupdate)
+            #print(o)
             self.updateOrderbook(pair, o)
 
     async def _fetchTicker(self, pairs = None):
@@ -2,50 +2,1117 @@
 # Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
 # This file is covered by the GPLv2 or later, read COPYING for details.
 
+import bisect
 import collections
+import collections.abc
+import itertools
+import math
+import random
 import simplejson
 import statistics
 import time
+import unittest
+import urllib.parse
+import weakref
 from operator import neg
 
 from decimal import Decimal
 from sortedcontainers.sorteddict import SortedDict
 from tornado import httpclient
+import tornado.gen
 import tornado.ioloop
 
+class PrecisionError(ValueError):
+    """Raised when a price or volume do not fit in the number of decimals
+used for integer ticks.
+
+    """
+    pass
+
+def todecimal(value):
+    """Return a price or volume given as a string as Decimal, leaving
+other values as they are.
+
+    """
+    if str is type(value):
+        return Decimal(value)
+    return value
+
+def toticks(value, decimals):
+    """Convert a price or volume to an integer number of ticks with the
+given number of decimals.  Raise PrecisionError if the value can not
+be represented exactly.
+
+    """
+    if str is type(value):
+        # Prices and volumes from the wire are usually plain decimal
+        # strings, which are converted directly to integers.  Anything
+        # else, like exponents, go through Decimal.
+        whole, dot, fraction = value.partition('.')
+        if len(fraction) > decimals and not fraction[decimals:].strip('0'):
+            fraction = fraction[:decimals]
+        if len(fraction) <= decimals:
+            try:
+                return int(whole + fraction + '0' * (decimals - len(fraction)))
+            except ValueError:
+                pass
+        value = Decimal(value)
+    elif not isinstance(value, Decimal):
+        value = Decimal(value)
+    scaled = value.scaleb(decimals)
+    tick = int(scaled)
+    if tick != scaled:
+        raise PrecisionError('%s do not fit in %d decimals' % (value, decimals))
+    return tick
+
+_quanta = {}
+def quantum(decimals):
+    """Return the value of one tick with the given number of decimals.
+Multiplying with it is cheaper than Decimal.scaleb() when converting
+ticks back to Decimal.
+
+    """
+    q = _quanta.get(decimals)
+    if q is None:
+        q = _quanta[decimals] = Decimal(1).scaleb(-decimals)
+    return q
+
+def fromticks(tick, decimals):
+    """Convert an integer number of ticks with the given number of
+decimals back to Decimal.
+
+    """
+    return Decimal(tick) * quantum(decimals)
+
+class TableSequence(collections.abc.Sequence):
+    """Keys, values or items view of a TickTable, converting to Decimal
+when read.  Like the views of SortedDict, it support len(), indexing,
+slicing and repeated iteration, and follow changes in the table.
+
+    """
+    __slots__ = ('view', 'kind')
+    KEYS = 0
+    VALUES = 1
+    ITEMS = 2
+    def __init__(self, view, kind):
+        self.view = view
+        self.kind = kind
+    def _raw(self):
+        table = self.view.table
+        if self.KEYS == self.kind:
+            return table.keys()
+        if self.VALUES == self.kind:
+            return table.values()
+        return table.items()
+    def _convert(self, raw):
+        if self.KEYS == self.kind:
+            return self.view._price(raw)
+        if self.VALUES == self.kind:
+            return self.view._volume(raw)
+        return (self.view._price(raw[0]), self.view._volume(raw[1]))
+    def __len__(self):
+        return len(self.view.table)
+    def __getitem__(self, index):
+        raw = self._raw()[index]
+        if isinstance(index, slice):
+            return [self._convert(r) for r in raw]
+        return self._convert(raw)
+    def __iter__(self):
+        convert = self._convert
+        for raw in self._raw():
+            yield convert(raw)
+    def __reversed__(self):
+        convert = self._convert
+        for raw in reversed(self._raw()):
+            yield convert(raw)
+    def __contains__(self, value):
+        if self.KEYS == self.kind:
+            return value in self.view
+        if self.ITEMS == self.kind:
+            price, volume = value
+            return price in self.view and self.view[price] == volume
+        return any(value == v for v in self)
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, list(self))
+
+class TickTable(collections.abc.Mapping):
+    """Read only view of a price table stored as integer ticks.  Prices
+and volumes are converted back to Decimal when read, and prices used
+for lookup are converted to ticks.
+
+    """
+    __slots__ = ('table', 'pricedecimals', 'volumedecimals', 'owner',
+                 'pricequantum', 'volumequantum')
+    def __init__(self, table, pricedecimals, volumedecimals, owner = None):
+        self.table = table
+        self.pricedecimals = pricedecimals
+        self.volumedecimals = volumedecimals
+        if pricedecimals is not None:
+            self.pricequantum = quantum(pricedecimals)
+            self.volumequantum = quantum(volumedecimals)
+        # The order book snapshot sharing the table, kept alive while
+        # the view is in use, so the live book copy the table before
+        # changing it.
+        self.owner = owner
+    def _price(self, tick):
+        return Decimal(tick) * self.pricequantum
+    def _volume(self, volume):
+        return Decimal(volume) * self.volumequantum
+    def __getitem__(self, price):
+        try:
+            tick = toticks(price, self.pricedecimals)
+        except ValueError:
+            raise KeyError(price)
+        return self._volume(self.table[tick])
+    def __iter__(self):
+        q = self.pricequantum
+        for tick in self.table:
+            yield Decimal(tick) * q
+    def __len__(self):
+        return len(self.table)
+    def __contains__(self, price):
+        try:
+            return toticks(price, self.pricedecimals) in self.table
+        except ValueError:
+            return False
+    def keys(self):
+        return TableSequence(self, TableSequence.KEYS)
+    def values(self):
+        return TableSequence(self, TableSequence.VALUES)
+    def items(self):
+        return TableSequence(self, TableSequence.ITEMS)
+    def peekitem(self, index=-1):
+        tick, volume = self.table.peekitem(index)
+        return (Decimal(tick) * self.pricequantum,
+                Decimal(volume) * self.volumequantum)
+    def __str__(self):
+        return "%s(%s)" % (type(self).__name__, list(self.items()))
+
+class SnapshotTable(TickTable):
+    """Read only view of a price table of an order book snapshot stored
+as Decimal, keeping the snapshot alive like TickTable.
+
+    """
+    __slots__ = ()
+    def __init__(self, table, owner):
+        super().__init__(table, None, None, owner)
+    def _price(self, price):
+        return price
+    def _volume(self, volume):
+        return volume
+    def __getitem__(self, price):
+        return self.table[price]
+    def __iter__(self):
+        for price in self.table:
+            yield price
+    def __contains__(self, price):
+        return price in self.table
+    def peekitem(self, index=-1):
+        return self.table.peekitem(index)
+
+class DepthIndex(object):
+    """Fenwick trees with the cumulative volume and notional (price times
+volume) of one side of an order book, indexed on the position of the
+price levels, best price first.  Prefix sums and the search for the
+level where a given volume is filled take logarithmic time.  Adding or
+removing a level move the positions of the levels after it, so the
+index must then be rebuilt.
+
+    """
+    __slots__ = ('n', 'volume', 'notional', 'topbit')
+    def __init__(self, table):
+        self._build(len(table), ((i + 1, p, v)
+                                 for i, (p, v) in enumerate(table.items())))
+    def _build(self, n, levels):
+        volume = [0] * (n + 1)
+        notional = [0] * (n + 1)
+        for i, p, v in levels:
+            volume[i] = v
+            notional[i] = p * v
+        # Build the trees in linear time
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                volume[j] += volume[i]
+                notional[j] += notional[i]
+        self.n = n
+        self.volume = volume
+        self.notional = notional
+        self.topbit = 1
+        while self.topbit * 2 <= n:
+            self.topbit *= 2
+    def add(self, pos, volume, notional):
+        """Add to the volume and notional of the level at the given
+position.
+
+        """
+        i = pos + 1
+        while i <= self.n:
+            self.volume[i] += volume
+            self.notional[i] += notional
+            i += i & -i
+    def place(self, table, price, volume, moved):
+        """Add the volume change of the given price level, which is in the
+table.  Return False if the index can not be updated in place, ie when
+moved tell the level was added or removed.
+
+        """
+        if moved:
+            return False
+        self.add(table.index(price), volume, price * volume)
+        return True
+    def prefix(self, count):
+        """Return the total volume and notional of the first count levels.
+
+        """
+        volume = notional = 0
+        i = count
+        while 0 < i:
+            volume += self.volume[i]
+            notional += self.notional[i]
+            i -= i & -i
+        return volume, notional
+    def within(self, table, price):
+        """Return the total volume and notional of the levels at the given
+price or better.
+
+        """
+        return self.prefix(table.bisect_right(price))
+    def _search(self, volume):
+        pos = 0
+        before = notional = 0
+        bit = self.topbit
+        while 0 < bit and 0 < self.n:
+            i = pos + bit
+            if i <= self.n and before + self.volume[i] < volume:
+                pos = i
+                before += self.volume[i]
+                notional += self.notional[i]
+            bit //= 2
+        if pos >= self.n:
+            return None
+        return pos, before, notional
+    def search(self, table, volume):
+        """Return the price of the level where the given volume is filled,
+and the total volume and notional of the levels before it.  Return
+None if the side hold less than the given volume.
+
+        """
+        found = self._search(volume)
+        if found is None:
+            return None
+        pos, before, notional = found
+        return table.peekitem(pos)[0], before, notional
+
+class TickDepthIndex(DepthIndex):
+    """Depth index for order books with integer tick prices, indexed on
+the distance in ticks from a base price beyond the best level instead
+of on the position, so adding and removing levels also take logarithmic
+time.  The index cover the price range of the book with headroom on
+both sides, and must be rebuilt when a level fall outside it.
+
+    """
+    __slots__ = ('sign', 'base')
+    # Smallest headroom in ticks on each side of the book
+    headroom = 64
+    def __init__(self, table):
+        # Bids are sorted on the negated price
+        self.sign = -1 if table.key is neg else 1
+        first = self.sign * self._tick(table.peekitem(0)[0])
+        span = self.sign * self._tick(table.peekitem(-1)[0]) - first
+        headroom = max(span, self.headroom)
+        self.base = first - headroom
+        self._build(span + 2 * headroom + 1,
+                    ((self.sign * self._tick(p) - self.base + 1, p, v)
+                     for p, v in table.items()))
+    @staticmethod
+    def fits(table):
+        """Return True if the table is suitable for a tick index, ie not
+empty and not too sparse for an array over its price range.
+
+        """
+        if 0 == len(table):
+            return False
+        span = abs(table.peekitem(-1)[0] - table.peekitem(0)[0])
+        return span <= 16 * len(table) + 4096
+    def _tick(self, price):
+        """Return the price as an integer tick, or None if it is not a
+whole number of ticks.
+
+        """
+        return price
+    def _scale(self, price):
+        return price
+    def _price(self, tick):
+        return tick
+    def place(self, table, price, volume, moved):
+        tick = self._tick(price)
+        if tick is None:
+            return False
+        offset = self.sign * tick - self.base
+        if offset < 0 or offset >= self.n:
+            return False
+        self.add(offset, volume, price * volume)
+        return True
+    def within(self, table, price):
+        count = math.floor(self.sign * self._scale(price)) - self.base + 1
+        return self.prefix(min(max(count, 0), self.n))
+    def search(self, table, volume):
+        found = self._search(volume)
+        if found is None:
+            return None
+        pos, before, notional = found
+        return self._price(self.sign * (self.base + pos)), before, notional
+
+class DecimalDepthIndex(TickDepthIndex):
+    """Depth index for order books with Decimal prices, using the
+TickDepthIndex layout with ticks as small as the price with the most
+decimals in the table.  A new level with more decimals than that can
+not be placed, and the index must then be rebuilt.
+
+    """
+    __slots__ = ('decimals',)
+    def __init__(self, table, decimals):
+        self.decimals = decimals
+        super().__init__(table)
+    @staticmethod
+    def tickdecimals(table):
+        """Return the number of decimals in the price with the most
+decimals in the table, or None if some prices are not Decimal.
+
+        """
+        exponent = 0
+        for price in table:
+            if not isinstance(price, Decimal):
+                return None
+            exponent = min(exponent, price.as_tuple().exponent)
+        return -exponent
+    @staticmethod
+    def fits(table, decimals):
+        if 0 == len(table):
+            return False
+        span = abs(table.peekitem(-1)[0] - table.peekitem(0)[0]).scaleb(decimals)
+        return span <= 16 * len(table) + 4096
+    def _tick(self, price):
+        if not isinstance(price, Decimal):
+            return None
+        scaled = price.scaleb(self.decimals)
+        tick = int(scaled)
+        if tick != scaled:
+            return None
+        return tick
+    def _scale(self, price):
+        return price.scaleb(self.decimals)
+    def _price(self, tick):
+        return fromticks(tick, self.decimals)
+
+class Quote(object):
+    """The current rate of a pair, as stored in Service.rates.  The
+fields are ask, bid, when (the timestamp from the service), stored
+(when the rate was last confirmed) and lastchange (when the rate last
+changed).  Slots keep the record small, and the fields can be read
+and changed both as attributes and dict style, ie quote['ask'].
+
+    """
+    __slots__ = ('ask', 'bid', 'when', 'stored', 'lastchange')
+    def __init__(self, ask, bid, when, stored, lastchange):
+        self.ask = ask
+        self.bid = bid
+        self.when = when
+        self.stored = stored
+        self.lastchange = lastchange
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+    def __contains__(self, key):
+        return key in self.__slots__
+    def __iter__(self):
+        return iter(self.__slots__)
+    def __len__(self):
+        return len(self.__slots__)
+    def keys(self):
+        return self.__slots__
+    def values(self):
+        return [getattr(self, key) for key in self.__slots__]
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+    def get(self, key, default = None):
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
+    def __eq__(self, other):
+        if isinstance(other, (Quote, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class PeriodEstimator(object):
+    """Streaming estimate of the time between updates, fed with the
+update times using add().  Keep the last window steps between updates
+for the median used by period(), which follow changes in the update
+rate.  Also keep an exponentially weighted moving average and variance
+of the time between updates, and a P-square estimate of the median
+(Jain and Chlamtac, 1985) covering all the updates seen.  Every update
+and query take constant time and space.
+
+    """
+    __slots__ = ('alpha', 'p', 'last', 'count', 'mean', 'var', 'recent',
+                 '_q', '_n', '_np', '_dn')
+    def __init__(self, alpha = 0.1, p = 0.5, window = 31):
+        self.alpha = alpha
+        self.p = p
+        self.last = None
+        self.count = 0
+        self.mean = float('nan')
+        self.var = 0.0
+        self.recent = collections.deque(maxlen=window)
+        # P-square marker heights, positions, desired positions and
+        # desired position increments.
+        self._q = []
+        self._n = [0, 1, 2, 3, 4]
+        self._np = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self._dn = [0, p / 2, p, (1 + p) / 2, 1]
+    def add(self, when):
+        """Register an update at the given time.  Updates older than or at
+the same time as the newest one seen are ignored.
+
+        """
+        when = float(when)
+        last = self.last
+        if last is not None and when <= last:
+            return
+        self.last = when
+        if last is not None:
+            self._addstep(when - last)
+    def _addstep(self, step):
+        self.count += 1
+        self.recent.append(step)
+        if 1 == self.count:
+            self.mean = step
+        else:
+            alpha = max(self.alpha, 1.0 / self.count)
+            diff = step - self.mean
+            incr = alpha * diff
+            self.mean += incr
+            self.var = (1 - alpha) * (self.var + diff * incr)
+        q = self._q
+        if len(q) < 5:
+            bisect.insort(q, step)
+            return
+        n = self._n
+        if step < q[0]:
+            q[0] = step
+            k = 0
+        elif step >= q[4]:
+            q[4] = step
+            k = 3
+        else:
+            k = 0
+            while step >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        np = self._np
+        for i in range(5):
+            np[i] += self._dn[i]
+        for i in (1, 2, 3):
+            d = np[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or \
+               (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # Piecewise parabolic prediction, falling back to
+                # linear if it break the ordering of the markers.
+                qp = q[i] + d / (n[i + 1] - n[i - 1]) * \
+                    ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                     (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < qp < q[i + 1]:
+                    qp = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = qp
+                n[i] += d
+    def quantile(self):
+        """Return the estimated p quantile of the time between all the
+updates seen, the median by default, or NaN if there is no estimate
+yet.
+
+        """
+        q = self._q
+        if 0 == len(q):
+            return float('nan')
+        if len(q) < 5:
+            # Exact quantile of the sorted first few samples
+            pos = self.p * (len(q) - 1)
+            i = int(pos)
+            if i + 1 == len(q):
+                return q[i]
+            return q[i] + (q[i + 1] - q[i]) * (pos - i)
+        return q[2]
+    def period(self):
+        """Return the median of the recent times between updates, or NaN if
+less than two periods have been seen.
+
+        """
+        if self.count < 2:
+            return float('nan')
+        return statistics.median(self.recent)
+    def median(self):
+        """Return the estimated median time between all the updates seen,
+or NaN if less than two periods have been seen.
+
+        """
+        if self.count < 2:
+            return float('nan')
+        return self.quantile()
+    def variance(self):
+        """Return the moving variance of the time between updates."""
+        if 0 == self.count:
+            return float('nan')
+        return self.var
+    def stddev(self):
+        return self.variance() ** 0.5
+    def state(self):
+        """Return the estimator state as a dict of JSON compatible values,
+for use with fromstate().
+
+        """
+        state = dict((key, getattr(self, key)) for key in self.__slots__)
+        # JSON has no NaN, used for the mean before the first step
+        if 0 == self.count:
+            state['mean'] = None
+        state['recent'] = list(self.recent)
+        state['window'] = self.recent.maxlen
+        return state
+    @classmethod
+    def fromstate(cls, state):
+        """Return an estimator with the state returned by state().  The
+time of the last update is left out, as the updates seen after the
+state was saved are unknown, and the first update after a restore
+would otherwise count as one long step.
+
+        """
+        e = cls(state['alpha'], state['p'], state.get('window', 31))
+        for key in cls.__slots__:
+            if key in ('last', 'recent'):
+                continue
+            setattr(e, key, state[key])
+        if e.mean is None:
+            e.mean = float('nan')
+        e.recent.extend(state.get('recent', ()))
+        return e
+
 class Orderbook(object):
+    """Order book with the ask and bid price levels of a market.  The ask
+and bid members are SortedDict tables mapping price to volume, with
+the best price first.
+
+The book is changed in place as updates arrive.  Readers wanting a
+view that do not change while they look at it should use snapshot(),
+which share the tables with the live book until the live book is
+changed.
+
+If pricedecimals and volumedecimals are given, prices and volumes are
+stored as integer ticks with that many decimals, and the ask and bid
+members are TickTable views converting to Decimal when read.  This is
+exact and use less memory, but reading is slower than with Decimal, see
+Service.usetickbooks().
+
+If maxdepth is given, each side keep at most that many price levels.
+Levels pushed out of the cap, or arriving beyond it, are kept in a
+reserve of at most maxdepth levels used to refill the cap when levels
+inside it disappear.  Removal of unknown levels beyond the cap are
+ignored, as they might have been trimmed away.
+
+    """
     SIDE_ASK = "ask"
     SIDE_BID = "bid"
-    def __init__(self):
-        self.ask = SortedDict()
-        self.bid = SortedDict(neg)
+    __slots__ = ('_ask', '_bid', 'pricedecimals', 'volumedecimals',
+                 'maxdepth', '_reserve', 'lastupdate', 'version', 'frozen',
+                 '_snapshot', '_sharedwith', '_ladder', '_index', '_changes',
+                 '_views', '__weakref__')
+    def __init__(self, pricedecimals = None, volumedecimals = None,
+                 maxdepth = None):
+        if (pricedecimals is None) != (volumedecimals is None):
+            raise ValueError('both or none of pricedecimals and volumedecimals must be set')
+        if maxdepth is not None and maxdepth < 1:
+            raise ValueError('maxdepth must be a positive number')
+        self._ask = SortedDict()
+        self._bid = SortedDict(neg)
+        self.pricedecimals = pricedecimals
+        self.volumedecimals = volumedecimals
+        self.maxdepth = maxdepth
+        self._reserve = {}
         self.lastupdate = None
+        self.version = 0
+        self.frozen = False
+        self._snapshot = None
+        self._sharedwith = {}
+        self._ladder = None
+        self._index = {}
+        self._changes = None
+        self._views = {}
+    @property
+    def ask(self):
+        return self._view(self.SIDE_ASK, self._ask)
+    @property
+    def bid(self):
+        return self._view(self.SIDE_BID, self._bid)
+    def _view(self, side, table):
+        # Views of a snapshot refer to the snapshot, to keep the shared
+        # table from being changed while the view is used.
+        if self.frozen:
+            if self.pricedecimals is None:
+                return SnapshotTable(table, self)
+            return TickTable(table, self.pricedecimals, self.volumedecimals,
+                             self)
+        if self.pricedecimals is None:
+            return table
+        # The view of a live book is reused until the table is replaced.
+        view = self._views.get(side)
+        if view is None or view.table is not table:
+            view = TickTable(table, self.pricedecimals, self.volumedecimals)
+            self._views[side] = view
+        return view
+    @classmethod
+    def from_levels(cls, asks, bids, lastupdate = None, pricedecimals = None,
+                    volumedecimals = None, maxdepth = None, ticks = False):
+        """Return a new order book with the given ask and bid levels, each a
+sequence of (price, volume) pairs.  See replace_side().
+
+        """
+        o = cls(pricedecimals, volumedecimals, maxdepth)
+        o.replace_side(cls.SIDE_ASK, asks, ticks = ticks)
+        o.replace_side(cls.SIDE_BID, bids, ticks = ticks)
+        o.lastupdate = lastupdate
+        return o
+    def replace_side(self, side, levels, timestamp = None, ticks = False):
+        """Replace all price levels on one side of the book with the given
+sequence of (price, volume) pairs, for example from a full book
+snapshot.  The price table is built in one go instead of one level at
+a time, which is a lot faster for deep books, and cheapest when the
+levels are sorted best price first.  Set ticks if the levels are
+already integer ticks.  Prices and volumes can also be given as the
+decimal strings sent by the services, which are converted directly to
+ticks for books using integer ticks.  Snapshots of the book keep the
+old levels.
+
+        """
+        if self.frozen:
+            raise TypeError('order book snapshot is read only')
+        if self.pricedecimals is not None and not ticks:
+            pricedecimals = self.pricedecimals
+            volumedecimals = self.volumedecimals
+            levels = [(toticks(price, pricedecimals),
+                       toticks(volume, volumedecimals))
+                      for price, volume in levels]
+        elif self.pricedecimals is None:
+            levels = list(levels)
+            if levels and str is type(levels[0][0]):
+                levels = [(Decimal(price), Decimal(volume))
+                          for price, volume in levels]
+        if self.SIDE_ASK == side:
+            key = None
+        else:
+            key = neg
+        table = SortedDict(key, levels)
+        self._reserve.pop(side, None)
+        if self.maxdepth is not None and len(table) > self.maxdepth:
+            items = table.items()
+            self._reserve[side] = SortedDict(key, items[self.maxdepth:2 * self.maxdepth])
+            table = SortedDict(key, items[:self.maxdepth])
+        self.version += 1
+        # The old table is left untouched, so snapshots sharing it
+        # do not need a copy.
+        self._sharedwith.pop(side, None)
+        self._index.pop(side, None)
+        if self._changes is not None:
+            self._replaced(side)
+        if self.SIDE_ASK == side:
+            self._ask = table
+        else:
+            self._bid = table
+        if timestamp and (self.lastupdate is None or timestamp > self.lastupdate):
+            self.lastupdate = timestamp
+    def _table(self, side):
+        """Return the raw price table of the given side."""
+        if side is self.SIDE_ASK or side == self.SIDE_ASK:
+            return self._ask
+        return self._bid
     def copy(self):
-        o = Orderbook()
-        o.ask = self.ask.copy()
-        o.bid = self.bid.copy()
+        o = Orderbook(self.pricedecimals, self.volumedecimals, self.maxdepth)
+        o._ask = self._ask.copy()
+        o._bid = self._bid.copy()
+        for side, reserve in self._reserve.items():
+            o._reserve[side] = reserve.copy()
         o.lastupdate = self.lastupdate
         return o
+    def snapshot(self):
+        """Return a read only view of the book as it is now.  The view share
+the price tables with the live book, and the live book only copy a
+table when it is changed while a snapshot still refer to it.  Asking
+for a snapshot of an unchanged book return the same view again.
+
+        """
+        if self.frozen:
+            return self
+        if self._snapshot is not None:
+            s = self._snapshot()
+            if s is not None and s.version == self.version:
+                return s
+        s = Orderbook.__new__(Orderbook)
+        s._ask = self._ask
+        s._bid = self._bid
+        s.pricedecimals = self.pricedecimals
+        s.volumedecimals = self.volumedecimals
+        s.maxdepth = self.maxdepth
+        s._reserve = {}
+        s.lastupdate = self.lastupdate
+        s.version = self.version
+        s.frozen = True
+        s._snapshot = None
+        s._sharedwith = {}
+        s._ladder = None
+        s._index = {}
+        s._changes = None
+        s._views = {}
+        for side in (self.SIDE_ASK, self.SIDE_BID):
+            if side not in self._sharedwith:
+                self._sharedwith[side] = weakref.WeakSet()
+            self._sharedwith[side].add(s)
+        self._snapshot = weakref.ref(s)
+        return s
+    def ladder(self):
+        """Return a valutakrambod.ladder.Ladder with numpy arrays of the
+price levels, for vectorized depth analytics.  The ladder is built on
+first use and reused until the book change.  Require numpy.
+
+        """
+        if self._ladder is None or self._ladder.version != self.version:
+            from valutakrambod.ladder import Ladder
+            self._ladder = Ladder(self)
+        return self._ladder
+    def _writable(self, side):
+        """Return the price table for the given side, ready to be changed.
+
+        """
+        if self.frozen:
+            raise TypeError('order book snapshot is read only')
+        self.version += 1
+        sharers = self._sharedwith.get(side)
+        if sharers is not None:
+            del self._sharedwith[side]
+            if 0 < len(sharers):
+                # Live snapshots refer to the current table, give the
+                # live book its own copy before changing it.
+                if self.SIDE_ASK == side:
+                    self._ask = self._ask.copy()
+                else:
+                    self._bid = self._bid.copy()
+        return self._table(side)
     def update(self, side, price, volume, timestamp = None):
-        table = {
-            self.SIDE_ASK : self.ask,
-            self.SIDE_BID : self.bid,
-        }[side]
-        table[price] = volume
+        if self.pricedecimals is not None:
+            price = toticks(price, self.pricedecimals)
+            volume = toticks(volume, self.volumedecimals)
+        else:
+            price = todecimal(price)
+            volume = todecimal(volume)
+        self.update_ticks(side, price, volume, timestamp)
+    def update_ticks(self, side, price, volume, timestamp = None):
+        """Store a price level given as integer ticks, without any
+conversion.  Useful for services providing integer prices and volumes.
+
+        """
+        table = self._writable(side)
+        self._set(side, table, price, volume)
         if timestamp and (self.lastupdate is None or timestamp > self.lastupdate):
             self.lastupdate = timestamp
     def remove(self, side, price):
-        table = {
-            self.SIDE_ASK : self.ask,
-            self.SIDE_BID : self.bid,
-        }[side]
-        del table[price]
+        if self.pricedecimals is not None:
+            price = toticks(price, self.pricedecimals)
+        else:
+            price = todecimal(price)
+        table = self._writable(side)
+        self._delete(side, table, price)
+    def apply_delta(self, side, levels, timestamp = None):
+        """Change the given price levels on one side of the order book in
+place.  The levels argument is a sequence of (price, volume) pairs,
+where a zero volume remove the price level from the book.  Only the
+changed levels are touched, so the cost is proportional to the number
+of levels in the delta, not the depth of the book.  See replace_side()
+for the accepted values.
+
+        """
+        table = self._writable(side)
+        pricedecimals = self.pricedecimals
+        volumedecimals = self.volumedecimals
+        for price, volume in levels:
+            if pricedecimals is not None:
+                price = toticks(price, pricedecimals)
+                volume = toticks(volume, volumedecimals)
+            elif str is type(price):
+                price = Decimal(price)
+                volume = Decimal(volume)
+            if volume:
+                self._set(side, table, price, volume)
+            else:
+                try:
+                    self._delete(side, table, price)
+                except KeyError:
+                    if pricedecimals is not None:
+                        price = fromticks(price, pricedecimals)
+                    raise ValueError('asked to remove non-existing %s order %s' %
+                                     (side, price))
+        if timestamp and (self.lastupdate is None or timestamp > self.lastupdate):
+            self.lastupdate = timestamp
+    def apply_deltas(self, deltas, timestamp = None):
+        """Apply a batch of deltas in place.  The deltas argument is a
+sequence of (side, levels) pairs, see apply_delta() for the format of
+levels.
+
+        """
+        for side, levels in deltas:
+            self.apply_delta(side, levels)
+        if timestamp and (self.lastupdate is None or timestamp > self.lastupdate):
+            self.lastupdate = timestamp
     def clear(self):
-        self.ask.clear()
-        self.bid.clear()
+        self._writable(self.SIDE_ASK).clear()
+        self._writable(self.SIDE_BID).clear()
+        self._reserve.clear()
+        self._index.clear()
+        if self._changes is not None:
+            self._replaced(self.SIDE_ASK)
+            self._replaced(self.SIDE_BID)
+    def trackchanges(self, consumer = None):
+        """Start recording which price levels change for the given
+consumer, to be collected using popchanges().  Each consumer get its
+own record of the changes, so several consumers can follow the same
+book.
+
+        """
+        if self._changes is None:
+            self._changes = {}
+        if consumer not in self._changes:
+            self._changes[consumer] = {
+                self.SIDE_ASK : set(),
+                self.SIDE_BID : set(),
+            }
+    def untrackchanges(self, consumer = None):
+        """Stop recording changed price levels for the given consumer and
+forget its recorded changes, when it is done with the book.  Changes
+are still recorded for the other consumers.
+
+        """
+        if self._changes is not None:
+            self._changes.pop(consumer, None)
+            if 0 == len(self._changes):
+                self._changes = None
+    def popchanges(self, consumer = None):
+        """Return the price levels changed since the last call for the
+given consumer, as a dict mapping side to a set of raw prices (ie
+integer ticks when used), or to None if the whole side was replaced.
+Return None if trackchanges() was not called for the consumer.
+
+        """
+        if self._changes is None or consumer not in self._changes:
+            return None
+        changes = self._changes[consumer]
+        self._changes[consumer] = {
+            self.SIDE_ASK : set(),
+            self.SIDE_BID : set(),
+        }
+        return changes
+    def _changed(self, side, price):
+        for changes in self._changes.values():
+            changed = changes[side]
+            if changed is not None:
+                changed.add(price)
+    def _replaced(self, side):
+        for changes in self._changes.values():
+            changes[side] = None
+    def _isbetter(self, side, price, other):
+        if self.SIDE_ASK == side:
+            return price < other
+        return price > other
+    def _set(self, side, table, price, volume):
+        """Store a price level in the writable table of the given side,
+keeping the depth index and the depth cap in order.
+
+        """
+        if self._changes is not None:
+            self._changed(side, price)
+        if price in table:
+            delta = volume - table[price]
+            table[price] = volume
+            if delta:
+                self._indexlevel(side, table, price, delta, False)
+            return
+        if self.maxdepth is None or len(table) < self.maxdepth:
+            table[price] = volume
+            self._indexlevel(side, table, price, volume, True)
+            return
+        reserve = self._reserve.get(side)
+        if reserve is None:
+            reserve = SortedDict(table.key)
+            self._reserve[side] = reserve
+        worst = table.peekitem(-1)[0]
+        if self._isbetter(side, price, worst):
+            v = reserve[worst] = table.pop(worst)
+            self._indexlevel(side, table, worst, -v, True)
+            table[price] = volume
+            self._indexlevel(side, table, price, volume, True)
+            if self._changes is not None:
+                self._changed(side, worst)
+        else:
+            reserve[price] = volume
+        if len(reserve) > self.maxdepth:
+            reserve.popitem(-1)
+    def _delete(self, side, table, price):
+        """Remove a price level from the writable table of the given side,
+refilling the depth cap from the reserve.  Raise KeyError if the level
+is unknown and inside the cap.
+
+        """
+        if price in table:
+            volume = table.pop(price)
+            self._indexlevel(side, table, price, -volume, True)
+            reserve = self._reserve.get(side)
+            if self._changes is not None:
+                self._changed(side, price)
+            if reserve:
+                p, v = reserve.popitem(0)
+                table[p] = v
+                self._indexlevel(side, table, p, v, True)
+                if self._changes is not None:
+                    self._changed(side, p)
+            return
+        reserve = self._reserve.get(side)
+        if reserve is not None and price in reserve:
+            del reserve[price]
+            return
+        if self.maxdepth is not None and len(table) >= self.maxdepth \
+           and self._isbetter(side, table.peekitem(-1)[0], price):
+            # Beyond the cap, might have been trimmed away
+            return
+        raise KeyError(price)
+    def _indexlevel(self, side, table, price, volume, moved):
+        """Add the volume change of a price level to the depth index of the
+side, if any, dropping the index if it can not be updated in place.
+Set moved when the level was added or removed.
+
+        """
+        index = self._index.get(side)
+        if index is not None and not index.place(table, price, volume, moved):
+            del self._index[side]
+    def _depthindex(self, side):
+        index = self._index.get(side)
+        if index is None:
+            table = self._table(side)
+            if self.pricedecimals is not None:
+                if TickDepthIndex.fits(table):
+                    index = TickDepthIndex(table)
+            elif 0 < len(table):
+                decimals = DecimalDepthIndex.tickdecimals(table)
+                if decimals is not None and \
+                   DecimalDepthIndex.fits(table, decimals):
+                    index = DecimalDepthIndex(table, decimals)
+            if index is None:
+                index = DepthIndex(table)
+            self._index[side] = index
+        return index
+    def _scaledvolume(self, volume):
+        if not isinstance(volume, Decimal):
+            volume = Decimal(volume)
+        if self.volumedecimals is not None:
+            volume = volume.scaleb(self.volumedecimals)
+        return volume
+    def toplevels(self, side, count, raw = False):
+        """Return a list with up to count (price, volume) pairs from the best
+end of the given side.  With raw set, values are returned as stored.
+
+        """
+        table = self._table(side)
+        levels = list(itertools.islice(table.items(), count))
+        if raw or self.pricedecimals is None:
+            return levels
+        pq = quantum(self.pricedecimals)
+        vq = quantum(self.volumedecimals)
+        return [(Decimal(p) * pq, Decimal(v) * vq) for p, v in levels]
+    def top(self, raw = False):
+        """Return the best price levels as (askprice, askvolume, bidprice,
+bidvolume), with None for an empty side.  With raw set, prices and
+volumes are returned as stored, ie as integer ticks when used, which
+is cheaper when the values are only compared.
+
+        """
+        if 0 < len(self._ask):
+            askprice, askvolume = self._ask.peekitem(0)
+        else:
+            askprice = askvolume = None
+        if 0 < len(self._bid):
+            bidprice, bidvolume = self._bid.peekitem(0)
+        else:
+            bidprice = bidvolume = None
+        if raw or self.pricedecimals is None:
+            return (askprice, askvolume, bidprice, bidvolume)
+        pq = quantum(self.pricedecimals)
+        vq = quantum(self.volumedecimals)
+        if askprice is not None:
+            askprice = Decimal(askprice) * pq
+            askvolume = Decimal(askvolume) * vq
+        if bidprice is not None:
+            bidprice = Decimal(bidprice) * pq
+            bidvolume = Decimal(bidvolume) * vq
+        return (askprice, askvolume, bidprice, bidvolume)
+    def volume_within(self, side, price):
+        """Return the volume available at the given price or better.
+
+        """
+        if not isinstance(price, Decimal):
+            price = Decimal(price)
+        if self.pricedecimals is not None:
+            price = price.scaleb(self.pricedecimals)
+        volume, notional = self._depthindex(side).within(self._table(side), price)
+        if self.volumedecimals is not None:
+            return Decimal(volume).scaleb(-self.volumedecimals)
+        return Decimal(volume)
+    def price_for_volume(self, side, volume):
+        """Return the worst price reached when filling the given volume
+from the given side of the book, or None if the book is too shallow.
+
+        """
+        found = self._depthindex(side).search(self._table(side),
+                                              self._scaledvolume(volume))
+        if found is None:
+            return None
+        price = found[0]
+        if self.pricedecimals is not None:
+            return Decimal(price).scaleb(-self.pricedecimals)
+        return price
+    def cost_to_fill(self, side, volume):
+        """Return the total price of filling the given volume from the given
+side of the book, or None if the book is too shallow.  Divide by the
+volume to get the average price.
+
+        """
+        scaled = self._scaledvolume(volume)
+        found = self._depthindex(side).search(self._table(side), scaled)
+        if found is None:
+            return None
+        price, before, notional = found
+        cost = notional + (scaled - before) * price
+        if self.pricedecimals is not None:
+            return Decimal(cost).scaleb(-self.pricedecimals - self.volumedecimals)
+        return Decimal(cost)
     def setupdated(self, lastupdate = None):
+        if self.frozen:
+            raise TypeError('order book snapshot is read only')
         if lastupdate is None:
             lastupdate = time.time()
+        self.version += 1
         self.lastupdate = lastupdate
 
     def __str__(self):
@@ -138,7 +1205,52 @@ volume for price.
         """
         return Decimal(0.0)
 
+class BatchedSubscriber(object):
+    """Collect rate or depth updates and pass them on once per IOLoop
+iteration.  Use an instance as the callback given to Service.subscribe()
+or Service.depthsubscribe(), for one or several services.  At the end
+of the IOLoop iteration where updates arrived, callback(updates) is
+called once with a set of (service, pair, changed) tuples, with one
+entry per service and pair, and changed set if any of the collected
+updates for the pair were changes.  Useful for consumers doing heavy
+work per update, like redrawing a screen.
+
+    """
+    def __init__(self, callback, ioloop = None):
+        self.callback = callback
+        self.ioloop = ioloop
+        self.pending = {}
+    def __call__(self, service, pair, changed):
+        key = (service, pair)
+        if key in self.pending:
+            if changed:
+                self.pending[key] = True
+            return
+        if 0 == len(self.pending):
+            ioloop = self.ioloop
+            if ioloop is None:
+                ioloop = tornado.ioloop.IOLoop.current()
+            ioloop.add_callback(self.flush)
+        self.pending[key] = changed
+    def flush(self):
+        """Pass on the collected updates, if any."""
+        if 0 == len(self.pending):
+            return
+        pending = self.pending
+        self.pending = {}
+        self.callback(set((service, pair, changed)
+                          for (service, pair), changed in pending.items()))
+
 class Service(object):
+    # Markets where prices and volumes have a fixed number of decimals.
+    # Map pair to (pricedecimals, volumedecimals).
+    marketdecimals = {}
+    # Markets with order books stored as integer ticks, see
+    # usetickbooks().
+    tickdecimals = {}
+    # URL query parameters holding credentials, left out of recordings.
+    privateparams = frozenset(('api_key', 'apikey', 'key', 'secret',
+                               'token', 'access_token', 'signature', 'sign'))
     def __init__(self, currencies=None):
         self.http_client = httpclient.AsyncHTTPClient(
             defaults=dict(user_agent="Valutakrambod library client")
@@ -146,7 +1258,11 @@ class Service(object):
         self.rates = {}
         self.orderbooks = {}
         self.subscribers = []
+        self.depthsubscribers = []
+        self.tops = {}
+        self.maxdepths = {}
         self.updates = {}
+        self.periods = {}
         self.currencies = currencies
         self.wantedpairs = None
         self.periodic = None
@@ -164,11 +1280,20 @@ class Service(object):
             self.wantedpairs = self.ratepairs()
         #print("Want", self.wantedpairs)
         self.errsubscribers = []
+        # valutakrambod.eventbus.EventBus to publish events on, if any
+        self.bus = None
+        # valutakrambod.recorder.Recorder to record traffic with, if any
+        self.recorder = None
+        # Pairs with rates restored from a snapshot and not yet
+        # confirmed by the service
+        self.stale = set()
     def errsubscribe(self, callback):
         self.errsubscribers.append(callback)
     def logerror(self, msg):
         for s in self.errsubscribers:
             s(self, msg)
+        if self.bus is not None:
+            self.bus.publish(self, None, 'error', msg)
 
     def confinit(self, config):
         """Set a configparser compatible object member for use by individual
@@ -195,7 +1320,28 @@ services to store configuration.
         )
         response = await self.http_client.fetch(req)
         #print("updated %s" % self.servicename())
+        # Requests with headers are authenticated, and neither the
+        # request nor the response of these belong in a recording.
+        if self.recorder is not None and headers is None:
+            recordurl = self.recordedurl(url)
+            if recordurl is not None:
+                self.recorder.http(self, recordurl, response.body)
         return response.body, response
+    def recordedurl(self, url):
+        """Return the URL to store in a recording for a fetched URL, with
+the query parameters listed in privateparams removed.  Services can
+return None to keep the response out of recordings.
+
+        """
+        parts = urllib.parse.urlsplit(url)
+        if not parts.query:
+            return url
+        # Keep the other parameters as they were sent
+        query = '&'.join(
+            param for param in parts.query.split('&')
+            if urllib.parse.unquote_plus(param.partition('=')[0]).lower()
+            not in self.privateparams)
+        return urllib.parse.urlunsplit(parts._replace(query=query))
     async def _get(self, url, timeout = 30, headers = None):
         return await self._fetch('GET', url, timeout = timeout, headers = headers)
     async def _jsonget(self, url, timeout = 30, headers = None):
@@ -213,7 +1359,19 @@ services to store configuration.
     def servicename(self):
         raise NotImplementedError()
     def subscribe(self, callback):
+        """Call callback(service, pair, changed) when the rates of a pair
+are updated, ie when the best ask or bid of its order book move.  Use
+a BatchedSubscriber as callback to get one call per IOLoop iteration.
+
+        """
         self.subscribers.append(callback)
+    def depthsubscribe(self, callback):
+        """Call callback(service, pair, l1changed) every time the order book
+of a pair is updated, with l1changed telling if the best ask or bid
+price or volume moved.
+
+        """
+        self.depthsubscribers.append(callback)
     async def _callFetchRates(self):
         try:
             await self.fetchRates()
@@ -247,15 +1405,18 @@ seconds specified in as an argument.  The default update frequency is
 
     def updateRates(self, pair, ask, bid, when):
         now = time.time()
+        self.stale.discard(pair)
+        if self.recorder is not None:
+            self.recorder.rate(self, pair, ask, bid, when)
         changed = True
         if pair in self.rates:
             old = self.rates[pair]
-            if old['ask'] == ask and old['bid'] == bid and old['when'] == when:
+            if old.ask == ask and old.bid == bid and old.when == when:
                 changed = False
-            if when is not None and old['when'] is not None and old['when'] > when:
+            if when is not None and old.when is not None and old.when > when:
                 self.logerror('ignoring old %s update (%.1f < %.1f - %.1fs behind)' %
                               (self.servicename(),
-                               when, old['when'], old['when'] - when ))
+                               when, old.when, old.when - when ))
                 return
 
         if changed:
@@ -263,27 +1424,119 @@ seconds specified in as an argument.  The default update frequency is
                 lastchange = when
             else:
                 lastchange = now
-            self.rates[pair] = {
-                'ask':  ask,
-                'bid':  bid,
-                'when': when,
-                'stored': now,
-                'lastchange': lastchange,
-            }
+            self.rates[pair] = Quote(ask, bid, when, now, lastchange)
         else:
-            self.rates[pair]['stored'] = now
-            lastchange = self.rates[pair]['lastchange']
+            old.stored = now
+            lastchange = old.lastchange
         for s in self.subscribers:
             s(self, pair, changed)
+        if self.bus is not None:
+            self.bus.publish(self, pair, 'rate', changed)
         if not pair in self.updates:
             self.updates[pair] = collections.deque(maxlen=10)
         if  lastchange and (0 == len(self.updates[pair]) or \
                             lastchange != self.updates[pair][-1]):
             self.updates[pair].append(lastchange)
+            if pair not in self.periods:
+                self.periods[pair] = PeriodEstimator()
+            self.periods[pair].add(lastchange)
 #        self.stats(pair)
 
+    def setmaxdepth(self, maxdepth, pair = None):
+        """Limit the number of price levels kept per side in the order book
+of the given pair, or of all pairs if pair is None.  Use None as
+maxdepth to remove the limit.  Take effect for order books created
+and subscriptions made after the call.
+
+        """
+        self.maxdepths[pair] = maxdepth
+    def getmaxdepth(self, pair):
+        """Return the maximum number of price levels to keep per side in
+the order book of the given pair, or None if there is no limit.  The
+limit is set using setmaxdepth(), or the maxdepth setting in the
+configuration section of the service.
+
+        """
+        if pair in self.maxdepths:
+            return self.maxdepths[pair]
+        if None in self.maxdepths:
+            return self.maxdepths[None]
+        if getattr(self, '_config', None) is not None:
+            return self.confgetint('maxdepth', fallback=None)
+        return None
+    def newOrderbook(self, pair, asks = (), bids = (), lastupdate = None,
+                     ticks = False):
+        """Return a new order book for the given pair with the given ask
+and bid (price, volume) levels, using integer ticks if the number of
+decimals for the market is listed in tickdecimals, and limited to the
+depth given by getmaxdepth().  Set ticks if the levels are already
+integer ticks.
+
+        """
+        pricedecimals, volumedecimals = self.tickdecimals.get(pair, (None, None))
+        if pricedecimals is not None and not ticks:
+            asks = list(asks)
+            bids = list(bids)
+            try:
+                return Orderbook.from_levels(asks, bids, lastupdate,
+                                             pricedecimals, volumedecimals,
+                                             self.getmaxdepth(pair))
+            except PrecisionError as e:
+                self.droptickdecimals(pair, e)
+                pricedecimals = volumedecimals = None
+        return Orderbook.from_levels(asks, bids, lastupdate,
+                                     pricedecimals, volumedecimals,
+                                     self.getmaxdepth(pair), ticks)
+    def usetickbooks(self, enable = True):
+        """Store new order books of the markets listed in marketdecimals as
+integer ticks instead of Decimal.  This is off by default, as the
+conversion to and from ticks make building and reading the books
+slower than with Decimal, while using less memory for deep books.
+
+        """
+        if enable:
+            self.tickdecimals = dict(self.marketdecimals)
+        else:
+            self.tickdecimals = {}
+    def droptickdecimals(self, pair, error):
+        """Stop using integer ticks for new order books of the given pair,
+after the service sent a price or volume with more decimals than
+listed in tickdecimals.
+
+        """
+        self.logerror("%s %s precision beyond the tick size (%s), using Decimal order books" % (
+            self.servicename(), pair, str(error)))
+        tickdecimals = dict(self.tickdecimals)
+        tickdecimals.pop(pair, None)
+        self.tickdecimals = tickdecimals
     def updateOrderbook(self, pair, book):
         self.orderbooks[pair] = book
+        self.stale.discard(pair)
+        top = book.top(raw=True)
+        l1changed = top != self.tops.get(pair)
+        self.tops[pair] = top
+        if self.recorder is not None:
+            self.recorder.book(self, pair, book.top(), l1changed)
+        for s in self.depthsubscribers:
+            s(self, pair, l1changed)
+        if self.bus is not None:
+            self.bus.publish(self, pair, 'orderbook', l1changed)
+        rate = self.rates.get(pair)
+        if not l1changed and rate is not None:
+            # Only deeper levels changed.  If the rates are the ones
+            # from the book, and not from a ticker call, keep the Quote
+            # but tell the rate subscribers the rates are refreshed, as
+            # updateRates() do for unchanged rates.
+            askprice, askvolume, bidprice, bidvolume = book.top()
+            if rate.ask == askprice and rate.bid == bidprice:
+                rate.stored = time.time()
+                if self.recorder is not None:
+                    self.recorder.rate(self, pair, rate.ask, rate.bid, rate.when)
+                for s in self.subscribers:
+                    s(self, pair, False)
+                if self.bus is not None:
+                    self.bus.publish(self, pair, 'rate', False)
+                return
         if 0 < len(book.ask) and 0 < len(book.bid):
             self.updateRates(pair,
                              book.ask.peekitem(0)[0],
@@ -293,51 +1546,114 @@ seconds specified in as an argument.  The default update frequency is
             self.logerror("%s %s order book empty, not updating rates" % (
                 pair, self.servicename()))
 
+    def snapshot(self):
+        """Return the rates, order books and update times of the service as
+a dict of JSON compatible values, for use with restore().  Prices and
+volumes are stored as strings to keep them exact, and missing prices
+as None.
+
+        """
+        def levels(book, side):
+            return [(str(price), str(volume))
+                    for price, volume in book.toplevels(side, None)]
+        def price(value):
+            if value is None:
+                return None
+            return str(value)
+        return {
+            'rates': [{
+                'pair': pair,
+                'ask': price(rate.ask),
+                'bid': price(rate.bid),
+                'when': rate.when,
+                'stored': rate.stored,
+                'lastchange': rate.lastchange,
+            } for pair, rate in self.rates.items()],
+            'orderbooks': [{
+                'pair': pair,
+                'asks': levels(book, Orderbook.SIDE_ASK),
+                'bids': levels(book, Orderbook.SIDE_BID),
+                'lastupdate': book.lastupdate,
+            } for pair, book in self.orderbooks.items()],
+            'updates': [{
+                'pair': pair,
+                'times': list(times),
+            } for pair, times in self.updates.items()],
+            'periods': [{
+                'pair': pair,
+                'state': estimator.state(),
+            } for pair, estimator in self.periods.items()],
+        }
+    def restore(self, state):
+        """Restore the rates, order books and update times from a dict
+returned by snapshot(), for pairs without data yet.  The restored
+rates are flagged as stale until the service update them, by keeping
+the pairs in the stale set.  Subscribers are not called.  Return the
+list of pairs with restored rates.
+
+        """
+        def price(value):
+            if value is None:
+                return None
+            return Decimal(value)
+        restored = []
+        for r in state.get('rates', ()):
+            pair = tuple(r['pair'])
+            if pair in self.rates:
+                continue
+            self.rates[pair] = Quote(price(r['ask']), price(r['bid']),
+                                     r['when'], r['stored'], r['lastchange'])
+            self.stale.add(pair)
+            restored.append(pair)
+        for b in state.get('orderbooks', ()):
+            pair = tuple(b['pair'])
+            if pair in self.orderbooks:
+                continue
+            self.orderbooks[pair] = self.newOrderbook(
+                pair,
+                [(Decimal(p), Decimal(v)) for p, v in b['asks']],
+                [(Decimal(p), Decimal(v)) for p, v in b['bids']],
+                b['lastupdate'])
+        for u in state.get('updates', ()):
+            pair = tuple(u['pair'])
+            if pair not in self.updates:
+                self.updates[pair] = collections.deque(u['times'], maxlen=10)
+        for p in state.get('periods', ()):
+            pair = tuple(p['pair'])
+            if pair not in self.periods:
+                self.periods[pair] = PeriodEstimator.fromstate(p['state'])
+        return restored
+
     def guessperiod(self, pair):
-        if pair not in self.updates:
-            return float('nan')
-        last = None
-        steps = []
-        for t in self.updates[pair]:
-            if last:
-                steps.append(t - last)
-            last = t
-        if 1 < len(steps):
-            now = time.time()
-            period = statistics.median(steps)
-#            print("Guess next update for %s is %.1f %.1f (%f)" %
-#                  (self.servicename(), t + period, t + period - now, period))
-            return period
-        else:
+        """Return the median of the recent times between rate changes for
+the given pair, or NaN if not known yet.  See periodestimator() for
+more statistics.
+
+        """
+        if pair not in self.periods:
             return float('nan')
+        return self.periods[pair].period()
+    def periodestimator(self, pair):
+        """Return the PeriodEstimator tracking the time between rate changes
+for the given pair, or None if no change is seen yet.
+
+        """
+        return self.periods.get(pair)
 
     def stats(self, pair):
         print(pair,
               self.rates[pair]['ask'], self.rates[pair]['bid'],
               self.servicename())
         if pair in self.orderbooks:
-            b = self.orderbooks[pair]
-            bars = [1, 10, 20, 100, 1000, 2000, 50000]
-            res  = [0,  0,  0,   0,    0,    0,     0]
-            for side in ('ask', 'bid'):
-                t = {
-                    'ask' : b.ask,
-                    'bid' : b.bid,
-                }[side]
-                barnum = 0
-                amount = 0.0
-                price = 0.0
-                for o in t.items():
-                    #print(o)
-                    price = price + o[0] * o[1]
-                    amount = amount + o[1]
-                    #print(barnum, amount)
-                    n = bars[barnum]
-                    if amount > n:
-                        res[barnum] = price/amount
-                        barnum = barnum + 1
-                        if barnum > len(bars) - 1:
-                            break
+            # Average price when filling each volume bar, found using
+            # the depth index of the book.
+            book = self.orderbooks[pair]
+            bars = [1, 10, 20, 100, 1000]
+            for side in (Orderbook.SIDE_ASK, Orderbook.SIDE_BID):
+                res = []
+                for volume in bars:
+                    cost = book.cost_to_fill(side, volume)
+                    res.append(float('nan') if cost is None else cost / volume)
                 print(pair, "%s %9.4f %9.4f %9.4f %9.4f %9.4f (%s)" %
                       (side,
                        res[0],  res[1],  res[2],  res[3],  res[4],
@@ -387,6 +1703,31 @@ This method must be implemented in each service.
 
     async def fetchRates(self, pairs = None):
         raise NotImplementedError()
+    # Length in seconds of the time ranges fetchHistory() should be
+    # called with.
+    historychunk = 365 * 24 * 60 * 60
+    def historyoldest(self, pair):
+        """Return the oldest time fetchHistory() can return rates for, or
+None if there is no known limit.
+
+        """
+        return None
+    async def fetchHistory(self, pair, start, end):
+        """Return a list of (when, ask, bid) tuples with the historical
+rates of the pair from start up to end, oldest first.  Raise
+NotImplementedError if the service do not provide historical rates.
+See valutakrambod.backfill.
+
+        """
+        raise NotImplementedError()
+    async def replayhttp(self, url):
+        """Process a recorded response from the given URL, by running the
+code fetching and parsing it.  Used by valutakrambod.replay.Replayer,
+which make the recorded body available to the http_client.  Raise
+NotImplementedError if the URL can not be replayed.
+
+        """
+        raise NotImplementedError()
 
     def websocket(self):
         """Return a websocket client object.  Return None if no websocket API
@@ -400,3 +1741,325 @@ available.
 
         """
         return self.activetrader
+
+class TestBatchedSubscriber(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def testBatch(self):
+        batches = []
+        b = BatchedSubscriber(batches.append)
+        async def check():
+            b('s1', ('BTC', 'EUR'), False)
+            b('s1', ('BTC', 'EUR'), True)
+            b('s1', ('BTC', 'EUR'), False)
+            b('s2', ('BTC', 'EUR'), False)
+            self.assertEqual([], batches)
+            await tornado.gen.sleep(0.01)
+            b('s1', ('BTC', 'USD'), False)
+            await tornado.gen.sleep(0.01)
+        tornado.ioloop.IOLoop.current().run_sync(check)
+        self.assertEqual([set([('s1', ('BTC', 'EUR'), True),
+                               ('s2', ('BTC', 'EUR'), False)]),
+                          set([('s1', ('BTC', 'USD'), False)])],
+                         batches)
+
+class TestPeriodEstimator(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def testPeriod(self):
+        e = PeriodEstimator()
+        self.assertTrue(math.isnan(e.period()))
+        for t in (10, 12, 12, 11, 16):
+            e.add(t)
+        # Steps 2 and 4, the repeated and older times are ignored
+        self.assertEqual(2, e.count)
+        self.assertEqual(3.0, e.period())
+        self.assertEqual(16.0, e.last)
+        rng = random.Random(1)
+        steps = [rng.expovariate(1 / 30.0) for i in range(5000)]
+        t = e.last
+        for step in steps:
+            t += step
+            e.add(t)
+        self.assertEqual(5002, e.count)
+        self.assertAlmostEqual(statistics.median(steps), e.median(),
+                               delta=0.05 * statistics.median(steps))
+        self.assertAlmostEqual(statistics.median(steps[-31:]), e.period())
+        self.assertTrue(0 < e.variance())
+    def testAdapt(self):
+        e = PeriodEstimator()
+        e.add(0)
+        r = PeriodEstimator.fromstate(simplejson.loads(
+            simplejson.dumps(e.state(), allow_nan=False)))
+        self.assertTrue(math.isnan(r.mean))
+        e = PeriodEstimator()
+        t = 0
+        for i in range(1000):
+            t += 10
+            e.add(t)
+        for i in range(200):
+            t += 60
+            e.add(t)
+        self.assertEqual(60, e.period())
+        self.assertAlmostEqual(10, e.median(), delta=2)
+        # The restored estimator do not count the time since the save
+        r = PeriodEstimator.fromstate(simplejson.loads(simplejson.dumps(e.state())))
+        self.assertEqual(None, r.last)
+        r.add(t + 3600)
+        r.add(t + 3660)
+        self.assertEqual(60, r.period())
+        self.assertEqual(1200, r.count)
+        self.assertAlmostEqual(60, r.mean)
+    def testService(self):
+        from valutakrambod.service.dummyservice import DummyService
+        s = DummyService()
+        pair = ('BTC', 'EUR')
+        for when in (100, 110, 120, 131):
+            s.updateRates(pair, Decimal(when), Decimal(1), when)
+        self.assertEqual(10, s.guessperiod(pair))
+        self.assertEqual(3, s.periodestimator(pair).count)
+        self.assertTrue(math.isnan(s.guessperiod(('BTC', 'USD'))))
+
+class TestOrderbook(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def setUp(self):
+        self.o = Orderbook()
+        for i in range(10):
+            self.o.update(Orderbook.SIDE_ASK, Decimal(101 + i), Decimal(1))
+            self.o.update(Orderbook.SIDE_BID, Decimal(100 - i), Decimal(1))
+    def testSnapshot(self):
+        s = self.o.snapshot()
+        self.assertIs(s, self.o.snapshot())
+        self.assertIs(s._ask, self.o._ask)
+        self.o.apply_delta(Orderbook.SIDE_ASK, [(Decimal(101), Decimal(0)),
+                                                (Decimal(99), Decimal(2))])
+        # The snapshot keep the old view, the untouched side is still shared
+        self.assertEqual(Decimal(101), s.ask.peekitem(0)[0])
+        self.assertEqual(Decimal(99), self.o.ask.peekitem(0)[0])
+        self.assertIs(s._bid, self.o._bid)
+        self.assertIsNot(s, self.o.snapshot())
+        with self.assertRaises(TypeError):
+            s.update(Orderbook.SIDE_ASK, Decimal(1), Decimal(1))
+        # One version step per side changed
+        version = self.o.version
+        self.o.apply_deltas([(Orderbook.SIDE_ASK, [(Decimal(99), Decimal(1))]),
+                             (Orderbook.SIDE_BID, [(Decimal(98), Decimal(1))])],
+                            12.0)
+        self.assertEqual(version + 2, self.o.version)
+        self.assertEqual(12.0, self.o.lastupdate)
+    def testSnapshotView(self):
+        for o in (self.o, Orderbook.from_levels(self.o.ask.items(),
+                                                self.o.bid.items(),
+                                                pricedecimals = 2,
+                                                volumedecimals = 8)):
+            # The snapshot itself is not kept, only the view
+            view = o.snapshot().ask
+            o.apply_delta(Orderbook.SIDE_ASK, [(Decimal(101), Decimal(0)),
+                                               (Decimal(99), Decimal(2))])
+            self.assertEqual(Decimal(101), view.peekitem(0)[0])
+            self.assertFalse(Decimal(99) in view)
+            # Change the book while iterating a snapshot view
+            seen = []
+            for price in o.snapshot().ask.keys():
+                seen.append(price)
+                o.apply_delta(Orderbook.SIDE_ASK, [(price, Decimal(0)),
+                                                   (price + 100, Decimal(1))])
+            self.assertEqual([Decimal(99)] + [Decimal(102 + i) for i in range(9)],
+                             seen)
+            self.assertEqual(Decimal(199), o.ask.peekitem(0)[0])
+    def testTicks(self):
+        o = Orderbook(2, 8)
+        o.update(Orderbook.SIDE_ASK, Decimal('101.5'), Decimal('0.001'))
+        o.update_ticks(Orderbook.SIDE_ASK, 10100, 200000000)
+        o.apply_delta(Orderbook.SIDE_BID, [(Decimal('100.25'), Decimal('3'))])
+        self.assertEqual([10100, 10150], list(o._ask.keys()))
+        self.assertEqual((Decimal('101.00'), Decimal('2.00000000')),
+                         o.ask.peekitem(0))
+        self.assertEqual(Decimal('0.001'), o.ask[Decimal('101.5')])
+        self.assertTrue(Decimal('100.25') in o.bid)
+        with self.assertRaises(ValueError):
+            o.update(Orderbook.SIDE_ASK, Decimal('101.001'), Decimal(1))
+        o.remove(Orderbook.SIDE_ASK, Decimal('101'))
+        self.assertEqual(1, len(o.snapshot().ask))
+        # The views behave like the SortedDict views
+        o.update(Orderbook.SIDE_ASK, Decimal('102'), Decimal('1'))
+        keys = o.ask.keys()
+        self.assertEqual(2, len(keys))
+        self.assertEqual(Decimal('102'), keys[-1])
+        self.assertEqual([Decimal('101.5')], keys[:1])
+        self.assertEqual(list(keys), list(keys))
+        self.assertTrue(Decimal('102') in keys)
+        self.assertEqual(Decimal('1'), o.ask.values()[1])
+        self.assertEqual((Decimal('102'), Decimal('1')), o.ask.items()[1])
+        self.assertTrue((Decimal('102'), Decimal('1')) in o.ask.items())
+        o.remove(Orderbook.SIDE_ASK, Decimal('102'))
+        self.assertEqual(1, len(keys))
+    def testDepthIndex(self):
+        for o in (self.o, Orderbook(0, 0)):
+            for i in range(10):
+                o.update(Orderbook.SIDE_ASK, Decimal(101 + i), Decimal(1))
+            o.update(Orderbook.SIDE_ASK, Decimal(102), Decimal(3))
+            self.assertEqual(Decimal(4), o.volume_within(Orderbook.SIDE_ASK, 102))
+            self.assertEqual(Decimal(101), o.price_for_volume(Orderbook.SIDE_ASK, 1))
+            self.assertEqual(Decimal(102), o.price_for_volume(Orderbook.SIDE_ASK, 2))
+            self.assertEqual(Decimal(101 + 102 * 2),
+                             o.cost_to_fill(Orderbook.SIDE_ASK, 3))
+            # Volume changes update the index in place
+            o.apply_delta(Orderbook.SIDE_ASK, [(Decimal(101), Decimal(2))])
+            self.assertEqual(Decimal(5), o.volume_within(Orderbook.SIDE_ASK, 102))
+            # Added and removed levels in range of the index too
+            index = o._index[Orderbook.SIDE_ASK]
+            o.apply_delta(Orderbook.SIDE_ASK, [(Decimal(101), Decimal(0)),
+                                               (Decimal(100), Decimal(1))])
+            self.assertIs(index, o._index[Orderbook.SIDE_ASK])
+            self.assertEqual(Decimal(100 + 102 * 2),
+                             o.cost_to_fill(Orderbook.SIDE_ASK, 3))
+            self.assertEqual(Decimal(12), o.volume_within(Orderbook.SIDE_ASK, 1000))
+            self.assertIsNone(o.cost_to_fill(Orderbook.SIDE_ASK, 13))
+            if self.o == o:
+                self.assertEqual(Decimal(3), o.volume_within(Orderbook.SIDE_BID, 98))
+    def testTickDepthIndex(self):
+        for o, indextype in ((Orderbook(1, 0, maxdepth=20), TickDepthIndex),
+                             (Orderbook(maxdepth=20), DecimalDepthIndex)):
+            rng = random.Random(1)
+            for side in (Orderbook.SIDE_ASK, Orderbook.SIDE_BID):
+                o.apply_delta(side, [(Decimal(100 + i) / 10, Decimal(1 + i % 3))
+                                     for i in range(20)])
+            o.volume_within(Orderbook.SIDE_ASK, 0)
+            o.volume_within(Orderbook.SIDE_BID, 0)
+            for i in range(500):
+                side = rng.choice((Orderbook.SIDE_ASK, Orderbook.SIDE_BID))
+                price = Decimal(rng.randrange(50, 200)) / 10
+                view = o.ask if Orderbook.SIDE_ASK == side else o.bid
+                if price in view and rng.random() < 0.5:
+                    o.apply_delta(side, [(price, Decimal(0))])
+                else:
+                    o.apply_delta(side, [(price, Decimal(rng.randrange(1, 5)))])
+                index = o._depthindex(side)
+                levels = list(o.toplevels(side, 20))
+                volume = rng.randrange(1, 40)
+                filled = 0
+                expected = None
+                for p, v in levels:
+                    filled += v
+                    if filled >= volume:
+                        expected = p
+                        break
+                self.assertEqual(expected, o.price_for_volume(side, volume))
+                self.assertEqual(Decimal(sum(v for p, v in levels)),
+                                 o.volume_within(side, 0 if Orderbook.SIDE_BID == side
+                                                 else 1000))
+            # The index of the side only changed in range is kept
+            self.assertTrue(isinstance(o._index[side], indextype))
+        # A price with more decimals rebuild the index of a Decimal book
+        o._depthindex(Orderbook.SIDE_ASK)
+        o.apply_delta(Orderbook.SIDE_ASK, [(Decimal('4.95'), Decimal(1))])
+        self.assertFalse(Orderbook.SIDE_ASK in o._index)
+        self.assertEqual(Decimal('4.95'),
+                         o.price_for_volume(Orderbook.SIDE_ASK, 1))
+        self.assertEqual(2, o._depthindex(Orderbook.SIDE_ASK).decimals)
+    def testMaxDepth(self):
+        o = Orderbook(maxdepth=3)
+        for i in range(10):
+            o.update(Orderbook.SIDE_BID, Decimal(100 - i), Decimal(1))
+        self.assertEqual([100, 99, 98], list(o.bid.keys()))
+        o.update(Orderbook.SIDE_BID, Decimal('99.5'), Decimal(1))
+        self.assertEqual([100, Decimal('99.5'), 99], list(o.bid.keys()))
+        # Levels inside the cap are refilled from the reserve
+        o.apply_delta(Orderbook.SIDE_BID, [(Decimal(100), Decimal(0)),
+                                           (Decimal(99), Decimal(0))])
+        self.assertEqual([Decimal('99.5'), 98, 97], list(o.bid.keys()))
+        # Removing trimmed away levels beyond the cap is accepted
+        o.apply_delta(Orderbook.SIDE_BID, [(Decimal(50), Decimal(0))])
+        with self.assertRaises(ValueError):
+            o.apply_delta(Orderbook.SIDE_BID, [(Decimal('97.5'), Decimal(0))])
+    def testQuote(self):
+        q = Quote(Decimal('2'), Decimal('1'), 10.0, 11.0, 10.0)
+        self.assertEqual(Decimal('2'), q['ask'])
+        q['stored'] = 12.0
+        self.assertEqual(12.0, q.stored)
+        self.assertTrue('lastchange' in q)
+        self.assertEqual(None, q.get('spread'))
+        with self.assertRaises(KeyError):
+            q['spread']
+        self.assertEqual({'ask': Decimal('2'), 'bid': Decimal('1'),
+                          'when': 10.0, 'stored': 12.0,
+                          'lastchange': 10.0}, dict(q.items()))
+        self.assertFalse(hasattr(q, '__dict__'))
+        self.assertFalse(hasattr(self.o, '__dict__'))
+    def testFromLevels(self):
+        asks = [(Decimal('101'), Decimal('1')), (Decimal('102'), Decimal('2')),
+                (Decimal('103'), Decimal('3'))]
+        bids = [(Decimal('100'), Decimal('1')), (Decimal('99'), Decimal('2'))]
+        for args in ((), (2, 8)):
+            o = Orderbook.from_levels(reversed(asks), bids, 10.0, *args)
+            self.assertEqual(list(o.ask.items()), asks)
+            self.assertEqual(list(o.bid.items()), bids)
+            self.assertEqual(10.0, o.lastupdate)
+            self.assertEqual(Decimal('199'), o.cost_to_fill(o.SIDE_BID, 2))
+            s = o.snapshot()
+            o.replace_side(o.SIDE_BID, [(Decimal('98'), Decimal('5'))], 11.0)
+            self.assertEqual(Decimal('100'), s.top()[2])
+            self.assertEqual(Decimal('98'), o.top()[2])
+            self.assertEqual(11.0, o.lastupdate)
+        o = Orderbook.from_levels(asks, bids, maxdepth=2)
+        self.assertEqual(2, len(o.ask))
+        o.remove(o.SIDE_ASK, Decimal('101'))
+        self.assertEqual([Decimal('102'), Decimal('103')], list(o.ask.keys()))
+    def testWireStrings(self):
+        self.assertEqual(554130000, toticks('5541.30000', 5))
+        self.assertEqual(554130000, toticks('5541.3000000', 5))
+        self.assertEqual(-50000, toticks('-.5', 5))
+        self.assertEqual(100, toticks('1E2', 0))
+        with self.assertRaises(PrecisionError):
+            toticks('5541.300001', 5)
+        for pricedecimals, volumedecimals in ((None, None), (5, 8)):
+            o = Orderbook.from_levels([('101.5', '0.5')], [('100', '1')],
+                                      None, pricedecimals, volumedecimals)
+            o.apply_delta(o.SIDE_ASK, [('101.25', '2.00000000')])
+            self.assertEqual((Decimal('101.25'), Decimal('2'),
+                              Decimal('100'), Decimal('1')), o.top())
+            self.assertIs(o.ask, o.ask)
+            s = o.snapshot()
+            o.remove(o.SIDE_ASK, '101.25')
+            self.assertEqual(Decimal('101.25'), s.ask.peekitem(0)[0])
+            self.assertEqual(Decimal('101.5'), o.ask.peekitem(0)[0])
+    def testTickBooks(self):
+        from valutakrambod.service.dummyservice import DummyService
+        pair = ('BTC', 'EUR')
+        s = DummyService()
+        s.marketdecimals = {pair: (2, 8)}
+        self.assertEqual(None, s.newOrderbook(pair).pricedecimals)
+        s.usetickbooks()
+        self.assertEqual(2, s.newOrderbook(pair).pricedecimals)
+        s.usetickbooks(False)
+        self.assertEqual(None, s.newOrderbook(pair).pricedecimals)
+    def testTickPrecision(self):
+        from valutakrambod.service.dummyservice import DummyService
+        pair = ('BTC', 'EUR')
+        s = DummyService()
+        s.tickdecimals = {pair: (2, 8)}
+        errors = []
+        s.errsubscribe(lambda service, msg: errors.append(msg))
+        o = s.newOrderbook(pair, iter([(Decimal('101.125'), Decimal('1'))]),
+                           [(Decimal('100'), Decimal('1'))])
+        self.assertEqual(None, o.pricedecimals)
+        self.assertEqual(Decimal('101.125'), o.top()[0])
+        self.assertTrue('precision' in errors[0])
+        self.assertFalse(pair in s.tickdecimals)
+        self.assertEqual({}, DummyService.tickdecimals)
+        with self.assertRaises(PrecisionError):
+            Orderbook(2, 8).update(Orderbook.SIDE_ASK, Decimal('1.001'), 1)
+    def testNoCopyWithoutSnapshot(self):
+        self.o.snapshot()
+        table = self.o.bid
+        self.o.remove(Orderbook.SIDE_BID, Decimal(100))
+        self.assertIs(table, self.o.bid)
+
+if __name__ == '__main__':
+    t = TestOrderbook()
+    unittest.main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Save the state of services to a snapshot file, to restart warm.
+
+"""
+
+import os
+import simplejson
+import tempfile
+import time
+import unittest
+
+import tornado.ioloop
+
+from decimal import Decimal
+
+class Snapshotter(object):
+    """Save the rates, order books and update times of the given services
+to a JSON file, and restore them on start.  Restored rates are flagged
+as stale in service.stale until the service update them, and the
+restored update times let guessperiod() give useful answers at once.
+The file is replaced atomically, so a crash while saving leave the
+previous snapshot in place.  Call start() to save every interval
+seconds from the IOLoop, and save() on shutdown.
+
+    """
+    version = 1
+    def __init__(self, services, path, interval = 60):
+        self.services = services
+        self.path = path
+        self.interval = interval
+        self.periodic = None
+    def save(self):
+        state = {
+            'version': self.version,
+            'saved': time.time(),
+            'services': dict((service.servicename(), service.snapshot())
+                             for service in self.services),
+        }
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmppath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                simplejson.dump(state, f)
+            os.replace(tmppath, self.path)
+        except Exception:
+            os.unlink(tmppath)
+            raise
+    def restore(self):
+        """Restore the services found in the snapshot file, if it exist.
+Return the list of (service, pair) with restored rates.
+
+        """
+        try:
+            with open(self.path) as f:
+                state = simplejson.load(f)
+        except FileNotFoundError:
+            return []
+        if self.version != state.get('version'):
+            raise ValueError('unsupported snapshot version %s in %s' %
+                             (state.get('version'), self.path))
+        restored = []
+        for service in self.services:
+            servicestate = state['services'].get(service.servicename())
+            if servicestate is not None:
+                for pair in service.restore(servicestate):
+                    restored.append((service, pair))
+        return restored
+    def start(self):
+        """Save the snapshot every interval seconds from the IOLoop."""
+        self.stop()
+        self.periodic = tornado.ioloop.PeriodicCallback(self.save,
+                                                        self.interval * 1000)
+        self.periodic.start()
+    def stop(self):
+        if self.periodic is not None:
+            self.periodic.stop()
+            self.periodic = None
+
+class TestSnapshotter(unittest.TestCase):
+    """
+Run simple self test.
+"""
+    def testSaveRestore(self):
+        from valutakrambod.service.dummyservice import DummyService
+        pair = ('BTC', 'EUR')
+        s1 = DummyService()
+        s1.updateOrderbook(pair, s1.newOrderbook(
+            pair,
+            [(Decimal('101.5'), Decimal('1')), (Decimal('102'), Decimal('0.1'))],
+            [(Decimal('100'), Decimal('2'))], 10))
+        for when in (20, 30, 45, 50):
+            s1.updateRates(pair, Decimal('101.5') + when, Decimal('100'), when)
+        # A side without price
+        s1.updateRates(('BTC', 'NOK'), None, Decimal('1000'), 50)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'snapshot.json')
+            self.assertEqual([], Snapshotter([s1], path).restore())
+            Snapshotter([s1], path).save()
+            s2 = DummyService()
+            # Same name as the saved service
+            s2.n = s1.n
+            restored = Snapshotter([s2], path).restore()
+        self.assertEqual([(s2, pair), (s2, ('BTC', 'NOK'))], restored)
+        self.assertEqual(s1.rates[pair], s2.rates[pair])
+        self.assertEqual(None, s2.rates[('BTC', 'NOK')].ask)
+        self.assertEqual(list(s1.orderbooks[pair].ask.items()),
+                         list(s2.orderbooks[pair].ask.items()))
+        self.assertEqual(10, s2.orderbooks[pair].lastupdate)
+        self.assertEqual(s1.guessperiod(pair), s2.guessperiod(pair))
+        self.assertEqual(list(s1.updates[pair]), list(s2.updates[pair]))
+        self.assertTrue(pair in s2.stale)
+        s2.updateRates(pair, Decimal('152'), Decimal('100'), 60)
+        self.assertFalse(pair in s2.stale)
+        self.assertEqual(10, s2.periodestimator(pair).period())
+
+if __name__ == '__main__':
+    t = TestSnapshotter()
+    unittest.main()
@@ -87,6 +87,9 @@ class WebSocketClient(object):
             self.close()
             self.connect()
             return
+        recorder = getattr(self.service, 'recorder', None)
+        if recorder is not None:
+            recorder.frame(self.service, msg)
         try:
             self._on_message(msg)
         except Exception as exception: